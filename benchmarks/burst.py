@@ -0,0 +1,129 @@
+"""Measure how long burst frames take to score at several scoring sizes and
+worker counts, and check that the sharpest, best exposed frame is chosen,
+reporting the results as JSON.
+
+Frames are synthetic 1280x720 JPEGs of one scene at several blur and
+exposure levels, so no camera is needed. Use cpu_seconds_per_frame to pick
+a burst size that fits the node's CPU budget: a burst of N frames on D
+devices every capture interval costs about N * D * cpu_seconds_per_frame
+CPU seconds per interval. Run from the repository root:
+
+    python3 benchmarks/burst.py [--frames 8] [--iterations 20]
+                                [--output FILE]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pipeline import git_revision  # noqa: E402
+
+# The sizes frames are scored at, from cheapest to most detailed
+SIZES: List[Tuple[int, int]] = [(160, 90), (320, 180), (640, 360)]
+
+
+class _ReplaySession:
+    """Stands in for a capture session, handing out prepared frames."""
+
+    def __init__(self, frames: List[bytes]):
+        self.frames = frames
+        self.frame_count = 0
+
+    def grab(self, timeout: float = 5.0, newer_than: int = None) -> bytes:
+        frame = self.frames[self.frame_count % len(self.frames)]
+        self.frame_count += 1
+        return frame
+
+
+def _make_frames(count: int) -> Tuple[List[bytes], int]:
+    """Make count JPEG frames of one scene, each blurred or exposed
+    differently, and return them with the index of the sharp, well exposed
+    one."""
+    from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+    scene = Image.effect_noise((1280, 720), 20).convert('RGB')
+    draw = ImageDraw.Draw(scene)
+    for i in range(12):
+        x, y = 90 + i * 95, 120 + (i % 3) * 160
+        draw.rectangle((x, y, x + 60, y + 200), fill=(200, 180, 160))
+        draw.line((0, 40 * i, 1280, 720 - 40 * i), fill=(30, 30, 30), width=3)
+
+    frames, sharp_index = [], count // 2
+    for i in range(count):
+        image = scene
+        if i != sharp_index:
+            image = image.filter(ImageFilter.GaussianBlur(1 + i % 4))
+            image = ImageEnhance.Brightness(image).enhance(
+                (0.5, 1.0, 1.6)[i % 3])
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85)
+        frames.append(output.getvalue())
+    return frames, sharp_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=8,
+                        help='number of frames in each burst')
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='number of bursts timed per measurement')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write results to FILE instead of stdout')
+    args = parser.parse_args()
+
+    import burst
+
+    frames, sharp_index = _make_frames(args.frames)
+    sizes: Dict[str, Dict] = {}
+    for size in SIZES:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(args.iterations):
+            scores = [burst.score_frame(frame, size) for frame in frames]
+        scored = args.iterations * len(frames)
+        best = max(range(len(scores)), key=lambda i: scores[i].score)
+        sizes['{}x{}'.format(*size)] = {
+            'seconds_per_frame': (time.perf_counter() - wall_start) / scored,
+            'cpu_seconds_per_frame':
+                (time.process_time() - cpu_start) / scored,
+            'chose_sharp_frame': best == sharp_index
+        }
+
+    # Whole bursts through select_best(), with different pool sizes
+    workers: Dict[str, float] = {}
+    for count in sorted({1, 2, os.cpu_count() or 1}):
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                best, _ = burst.select_best(_ReplaySession(frames),
+                                            args.frames, executor=executor)
+            workers[str(count)] = (time.perf_counter() - start) / \
+                                    args.iterations
+
+    report = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'frames': args.frames,
+        'frame_bytes': sum(len(f) for f in frames) // len(frames),
+        'score_size': '{}x{}'.format(*burst.SCORE_SIZE),
+        'sizes': sizes,
+        'seconds_per_burst_by_workers': workers,
+        'chose_sharp_frame': best == frames[sharp_index]
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Run a collector against several simulated satellites pushing at once on one
+machine, and report upload latency, throughput and the resulting digest as
+JSON.
+
+Each node pushes its diagnostics and one frame per device every round, over
+one connection per push. In every other round a node pushes the same frames
+again, which the collector should drop as unchanged. A digest is sent to a
+local SMTP sink after the last round. Run from the repository root:
+
+    python3 benchmarks/fleet.py [--nodes 16] [--devices 4] [--rounds 4]
+                                [--output FILE]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pipeline import SMTPSink, git_revision  # noqa: E402
+
+# A raw diagnostics sample like the ones diagnostics.collect_diagnostics()
+# returns
+SAMPLE = {
+    'cpu_percent': 12.5, 'wifi_strength': 71.4, 'temperature': 118.9,
+    'memory_used_percent': 41.2, 'memory_available': 512 * 1024 * 1024,
+    'system': 'Linux 5.10.103-v7l+', 'processor': 'armv7l',
+    'boot_time': '2024-01-01 00:00:00'
+}
+
+
+def _make_frames(directory: str, count: int, seed: int) -> List[str]:
+    """Write count different 640x360 JPEGs to push as frames."""
+    from PIL import Image, ImageDraw
+    paths = []
+    for i in range(count):
+        image = Image.effect_noise((640, 360), 30).convert('RGB')
+        # A block in a different place each time, so the frames differ in
+        # their difference hash and not just in noise
+        x = (seed * 97 + i * 53) % 560
+        ImageDraw.Draw(image).rectangle((x, 60, x + 80, 300), fill='white')
+        path = os.path.join(directory, f'frame-{seed}-{i}.jpg')
+        image.save(path, quality=85)
+        paths.append(path)
+    return paths
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=16,
+                        help='number of simulated satellites')
+    parser.add_argument('--devices', type=int, default=4,
+                        help='number of frames each satellite pushes a round')
+    parser.add_argument('--rounds', type=int, default=4,
+                        help='number of pushes from each satellite')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write results to FILE instead of stdout')
+    args = parser.parse_args()
+
+    sink = SMTPSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    work = tempfile.mkdtemp(prefix='satellite-collector-bench-')
+    try:
+        import collector
+        import templates
+        from mail_transport import MailTransport
+        templates.BYTECODE_CACHE_DIRECTORY = os.path.join(work,
+                                                            'template-cache')
+        config = {
+            'satellite': 'Benchmark',
+            'sender': {'username': 'sender@example.com',
+                        'server': '127.0.0.1',
+                        'port': sink.server_address[1], 'ssl': False},
+            'recipient': {'username': 'recipient@example.com'}
+        }
+        transport = MailTransport(config,
+                                    spool_directory=os.path.join(work, 'spool'))
+        fleet_collector = collector.Collector(
+            config, transport, directory=os.path.join(work, 'collector'),
+            template_path=os.path.join(ROOT, 'static', 'email-fleet.html'))
+        server = fleet_collector.serve(port=0, host='127.0.0.1')
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        frames_directory = os.path.join(work, 'frames')
+        os.makedirs(frames_directory)
+        rounds = [
+            _make_frames(frames_directory, args.devices, seed)
+                for seed in range((args.rounds + 1) // 2)
+        ]
+
+        def push(node: int, round_number: int) -> float:
+            # Odd rounds push the previous round's frames again
+            paths = rounds[round_number // 2]
+            start = time.perf_counter()
+            collector.push_report(url, f'node-{node}', SAMPLE, [
+                (f'/dev/video{i}', path) for i, path in enumerate(paths)
+            ])
+            return time.perf_counter() - start
+
+        latencies: List[float] = []
+        push_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.nodes) as nodes:
+            for round_number in range(args.rounds):
+                latencies.extend(nodes.map(
+                    lambda node: push(node, round_number), range(args.nodes)))
+        push_time = time.perf_counter() - push_start
+        kept = len(fleet_collector.frames)
+        dropped = fleet_collector.dropped
+
+        digest_start = time.perf_counter()
+        fleet_collector.send_digest()
+        digest_time = time.perf_counter() - digest_start
+        server.shutdown()
+        server.server_close()
+        transport.close()
+        frame_bytes = sum(os.path.getsize(p) for paths in rounds
+                            for p in paths) // len(rounds)
+    finally:
+        sink.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+    uploads = args.nodes * args.rounds * args.devices
+    report: Dict = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'nodes': args.nodes,
+        'devices': args.devices,
+        'rounds': args.rounds,
+        'push_time': push_time,
+        'uploads_per_second': uploads / push_time,
+        'upload_megabytes_per_second':
+            frame_bytes * args.nodes * args.rounds / push_time / 1e6,
+        'push_latency_median': _percentile(latencies, 0.5),
+        'push_latency_p95': _percentile(latencies, 0.95),
+        'frames_kept': kept,
+        'frames_dropped': dropped,
+        'digest_time': digest_time,
+        'messages_received': sink.messages,
+        'bytes_received': sink.bytes_received
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Measure the peak memory (RSS) used to encode an email message against the
+number and size of its attachments, comparing the streaming encoder in
+communications with building the whole message through email.mime.
+
+Each case runs in a fresh interpreter so that peak RSS values don't carry over
+between cases. Run from the repository root:
+
+    python3 benchmarks/mime_memory.py [--counts 1 10 50] [--sizes 100 400]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONFIG = {
+    'satellite': 'Benchmark',
+    'sender': {'username': 'sender@example.com'},
+    'recipient': {'username': 'recipient@example.com'}
+}
+HTML = '<html><body><p>Benchmark</p></body></html>'
+
+
+def _encode_legacy(paths, sink):
+    """Encode the message the way send_email used to, as one string."""
+    message = MIMEMultipart('alternative')
+    message['Subject'] = 'Satellite Benchmark Message'
+    message.attach(MIMEText(HTML, 'html'))
+    for attachment_path in paths:
+        with open(attachment_path, 'rb') as attachment:
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(attachment.read())
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition',
+                        f'attachment; filename= {attachment_path}')
+        message.attach(part)
+    sink.write(message.as_string().encode())
+
+
+def _encode_streaming(paths, sink):
+    """Encode the message with the streaming encoder."""
+    import communications
+    for chunk in communications.iter_message_chunks(CONFIG, HTML, paths):
+        sink.write(chunk)
+
+
+def _run_case(mode, folder):
+    """Encode every file in the folder and print the peak RSS in kilobytes."""
+    paths = sorted(os.path.join(folder, f) for f in os.listdir(folder))
+    with open(os.devnull, 'wb') as sink:
+        if mode == 'legacy':
+            _encode_legacy(paths, sink)
+        else:
+            _encode_streaming(paths, sink)
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _measure(mode, folder):
+    output = subprocess.check_output(
+        [sys.executable, __file__, '--case', mode, folder], text=True)
+    return int(output.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 10, 50],
+                        help='numbers of attachments to test')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 400],
+                        help='attachment sizes to test, in kilobytes')
+    parser.add_argument('--case', nargs=2, metavar=('MODE', 'FOLDER'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        _run_case(*args.case)
+        return
+
+    results = []
+    for size in args.sizes:
+        for count in args.counts:
+            with tempfile.TemporaryDirectory() as folder:
+                for i in range(count):
+                    with open(os.path.join(folder, f'image{i}.jpg'), 'wb') as f:
+                        f.write(os.urandom(size * 1024))
+                result = {'count': count, 'size_kb': size}
+                for mode in ('legacy', 'streaming'):
+                    result[f'{mode}_peak_rss_kb'] = _measure(mode, folder)
+                results.append(result)
+                print(f'{count:4d} x {size:5d} KB: '
+                        f'legacy {result["legacy_peak_rss_kb"]:8d} KB, '
+                        f'streaming {result["streaming_peak_rss_kb"]:8d} KB',
+                        file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""Run the full capture to email pipeline against fake backends and report how
+long each stage takes, along with peak memory use, as JSON.
+
+No cameras or email account are needed: a stub fswebcam is put on PATH, a fake
+picamera module is put on the import path, device nodes are simulated with
+plain files and email is sent to a local SMTP sink. Run from the repository
+root:
+
+    python3 benchmarks/pipeline.py [--devices 8] [--runs 3] [--output FILE]
+                                   [--pipelined] [--jobs N]
+
+With --pipelined, each cycle runs through cycle.run_cycle(), where capture,
+encoding and upload overlap, and only discovery and the whole cycle are timed.
+Every simulated capture takes the same time, so without --jobs all frames
+arrive together and there is little for the overlap to hide. --jobs limits
+how many devices capture at once, as the -j option does, which staggers the
+frames the way slower or busier cameras do.
+Results from different versions can be compared by diffing their JSON output.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Stands in for fswebcam: lists one input per device, and "captures" by
+# copying a sample frame after a delay
+STUB_FSWEBCAM = '''#!{python}
+import shutil, sys, time
+args = sys.argv[1:]
+if '--list-inputs' in args:
+    print('Available inputs:')
+    print('0: Camera 1')
+    print('No input was specified')
+    sys.exit(0)
+time.sleep({delay})
+shutil.copyfile({frame!r}, args[-1])
+'''
+
+# Stands in for the picamera package
+FAKE_PICAMERA = '''import shutil, time
+
+class PiCamera:
+    def capture(self, output, **kwargs):
+        time.sleep({delay})
+        if isinstance(output, str):
+            shutil.copyfile({frame!r}, output)
+        else:
+            with open({frame!r}, 'rb') as frame:
+                output.write(frame.read())
+
+    def close(self):
+        pass
+'''
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Accepts every message and throws it away, counting bytes received."""
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'DATA':
+                self.reply('354 go ahead')
+                for data in iter(self.rfile.readline, b''):
+                    if data == b'.\r\n':
+                        break
+                    self.server.bytes_received += len(data)
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPSinkHandler)
+        self.bytes_received = 0
+        self.messages = 0
+
+
+def _make_frame(path: str):
+    """Write a 1280x720 JPEG to use as every captured frame."""
+    from PIL import Image
+    Image.effect_noise((1280, 720), 40).convert('RGB').save(path, quality=90)
+
+
+def _set_up(work: str, devices: int, delay: float, port: int) -> str:
+    """Create the fake backends in the given folder and return the path of
+    the config file pointing at the SMTP sink."""
+    frame = os.path.join(work, 'frame.jpg')
+    _make_frame(frame)
+
+    bin_directory = os.path.join(work, 'bin')
+    os.makedirs(bin_directory)
+    fswebcam = os.path.join(bin_directory, 'fswebcam')
+    with open(fswebcam, 'w') as stub:
+        stub.write(STUB_FSWEBCAM.format(python=sys.executable, delay=delay,
+                                        frame=frame))
+    os.chmod(fswebcam, os.stat(fswebcam).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = bin_directory + os.pathsep + os.environ['PATH']
+
+    with open(os.path.join(work, 'picamera.py'), 'w') as fake:
+        fake.write(FAKE_PICAMERA.format(delay=delay, frame=frame))
+    sys.path.insert(0, work)
+
+    os.makedirs(os.path.join(work, 'dev'))
+    for i in range(devices):
+        open(os.path.join(work, 'dev', f'video{i}'), 'w').close()
+
+    config_path = os.path.join(work, 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump({
+            'satellite': 'Benchmark',
+            'sender': {'username': 'sender@example.com',
+                        'server': '127.0.0.1', 'port': port, 'ssl': False},
+            'recipient': {'username': 'recipient@example.com'}
+        }, config_file)
+    return config_path
+
+
+def _timed(stages: Dict[str, float], name: str, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    stages[name] = time.perf_counter() - start
+    return result
+
+
+def run_cycle(work: str, config_path: str, jobs: int = None) -> Dict:
+    """Run one capture to email cycle, timing each stage."""
+    import communications
+    import diagnostics
+    import photography
+    import templates
+    from mail_transport import MailTransport
+
+    stages: Dict[str, float] = {}
+    images = os.path.join(work, 'images') + os.sep
+    _timed(stages, 'discovery', photography.find_devices, max_age=0)
+    results = _timed(stages, 'capture', photography.capture,
+                        images_directory=images, max_workers=jobs)
+    sample = _timed(stages, 'diagnostics', diagnostics.collect_diagnostics)
+
+    template_path = os.path.join(ROOT, 'static', 'email-message.html')
+    html = _timed(stages, 'template_render', templates.render, template_path,
+                    diagnostics=diagnostics.format_diagnostics(sample))
+
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    transport = MailTransport(config,
+                                spool_directory=os.path.join(work, 'spool'))
+    paths = communications.get_file_paths(images)
+    _timed(stages, 'mime_encoding', transport.enqueue,
+            communications.iter_message_chunks(config, html, paths))
+    _timed(stages, 'smtp_transfer', transport.drain, force=True)
+    transport.close()
+
+    return {
+        'stages': stages,
+        'capture_per_device': {
+            os.path.basename(r.device): r.duration for r in results
+        },
+        'capture_failures': sum(1 for r in results if r.returncode != 0),
+        'attachment_bytes': sum(os.path.getsize(p) for p in paths)
+    }
+
+
+def run_pipelined_cycle(work: str, config_path: str, jobs: int = None
+                        ) -> Dict:
+    """Run one pipelined capture to email cycle, timing discovery and the
+    cycle as a whole."""
+    import cycle
+    import photography
+    from mail_transport import MailTransport
+
+    stages: Dict[str, float] = {}
+    images = os.path.join(work, 'images') + os.sep
+    _timed(stages, 'discovery', photography.find_devices, max_age=0)
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    transport = MailTransport(config,
+                                spool_directory=os.path.join(work, 'spool'))
+    result = _timed(stages, 'cycle', cycle.run_cycle, config, transport,
+                    images_directory=images, max_workers=jobs,
+                    html_message_path=os.path.join(ROOT, 'static',
+                                                    'email-message.html'))
+    transport.close()
+
+    return {
+        'stages': stages,
+        'capture_per_device': {
+            os.path.basename(r.device): r.duration for r in result.captures
+        },
+        'capture_failures': sum(1 for r in result.captures
+                                if r.returncode != 0),
+        'attachment_bytes': sum(os.path.getsize(r.image_path)
+                                for r in result.captures if r.returncode == 0)
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                        cwd=ROOT, text=True,
+                                        stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=8,
+                        help='number of simulated /dev/video devices')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='number of cycles to run')
+    parser.add_argument('--capture-delay', type=float, default=0.5,
+                        help='seconds each simulated capture takes')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='run each cycle through cycle.run_cycle()')
+    parser.add_argument('--jobs', type=int,
+                        help='number of devices to capture on at once '
+                            '(default all)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write results to FILE instead of stdout')
+    args = parser.parse_args()
+
+    sink = SMTPSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    work = tempfile.mkdtemp(prefix='satellite-bench-')
+    try:
+        config_path = _set_up(work, args.devices, args.capture_delay,
+                                sink.server_address[1])
+        import photography
+        photography.DEVICE_GLOB = os.path.join(work, 'dev', 'video*')
+        import templates
+        templates.BYTECODE_CACHE_DIRECTORY = os.path.join(work, 
+                                                            'template-cache')
+
+        tracemalloc.start()
+        runs: List[Dict] = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            run = (run_pipelined_cycle if args.pipelined else run_cycle)(
+                work, config_path, args.jobs)
+            run['total'] = time.perf_counter() - start
+            runs.append(run)
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        photography.close_camera()
+    finally:
+        sink.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'devices': args.devices,
+        'capture_delay': args.capture_delay,
+        'pipelined': args.pipelined,
+        'jobs': args.jobs,
+        'runs': runs,
+        'median_stages': {
+            stage: sorted(run['stages'][stage] for run in runs)[len(runs) // 2]
+                for stage in runs[0]['stages']
+        },
+        'peak_traced_bytes': peak_traced,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'messages_received': sink.messages,
+        'bytes_received': sink.bytes_received
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
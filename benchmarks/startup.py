@@ -0,0 +1,103 @@
+"""Check that main.py's subcommands start quickly and only import what they
+need, using python -X importtime.
+
+Each subcommand is run several times in a fresh interpreter. The median time
+spent importing modules and the median wall-clock time of the whole command
+are compared against the targets in startup_targets.json, and the command
+fails if a subcommand imports a module it is not allowed to, such as the
+email stack when only listing devices. Run from the repository root:
+
+    python3 benchmarks/startup.py [--runs 5] [--targets FILE]
+
+The exit status is 1 if any target is missed, so this can run in CI.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TARGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'startup_targets.json')
+
+
+def _run(args: List[str]) -> Tuple[float, float, Dict[str, int]]:
+    """Run main.py with the given arguments under -X importtime.
+
+    Returns:
+        Tuple[float, float, Dict[str, int]]: the wall-clock time and total
+        import time in milliseconds, and the cumulative import time in
+        microseconds of every module imported
+    """
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', 'main.py'] + args, cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = (time.perf_counter() - start) * 1000
+
+    modules = {}
+    total = 0
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only top level imports are counted towards the total, since their
+        # cumulative times include everything they import
+        depth = len(name) - len(name.lstrip(' '))
+        modules[name.strip()] = int(cumulative)
+        if depth == 1:
+            total += int(cumulative)
+    return wall, total / 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of times to run each subcommand')
+    parser.add_argument('--targets', default=DEFAULT_TARGETS, metavar='FILE',
+                        help='JSON file of per-subcommand targets')
+    args = parser.parse_args()
+
+    with open(args.targets) as targets_file:
+        targets = json.load(targets_file)
+
+    results = {}
+    failures = []
+    for name, target in targets.items():
+        runs = [_run(target['args']) for _ in range(args.runs)]
+        wall = sorted(run[0] for run in runs)[len(runs) // 2]
+        imports = sorted(run[1] for run in runs)[len(runs) // 2]
+        imported = set().union(*(run[2] for run in runs))
+        forbidden = sorted(
+            module for module in target.get('forbidden_imports', [])
+                if module in imported
+        )
+        slowest = sorted(runs[-1][2].items(), key=lambda item: -item[1])[:5]
+        results[name] = {
+            'wall_ms': wall,
+            'import_ms': imports,
+            'modules_imported': len(imported),
+            'slowest_imports_us': dict(slowest),
+            'forbidden_imports': forbidden
+        }
+
+        if imports > target['max_import_ms']:
+            failures.append(f'{name}: imports took {imports:.1f} ms, '
+                            f'target {target["max_import_ms"]} ms')
+        if wall > target['max_wall_ms']:
+            failures.append(f'{name}: took {wall:.1f} ms, '
+                            f'target {target["max_wall_ms"]} ms')
+        if forbidden:
+            failures.append(f'{name}: imported {", ".join(forbidden)}')
+
+    print(json.dumps(results, indent=2))
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Compare the size and encoding time of a telemetry packet with the HTML
+report it replaces, and report both as JSON.
+
+The report is rendered from the full template with a diagnostics sample, a
+24 hour rollup and no attachments, and both are measured as the email message
+that would be sent. Run from the repository root:
+
+    python3 benchmarks/telemetry.py [--frames 8] [--iterations 2000]
+                                    [--output FILE]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pipeline import git_revision  # noqa: E402
+
+CONFIG = {
+    'satellite': 'Benchmark',
+    'sender': {'username': 'sender@example.com'},
+    'recipient': {'username': 'recipient@example.com'}
+}
+
+
+def _time_per_call(func: Callable, iterations: int) -> float:
+    """Get the median time, in seconds, of one call over five batches."""
+    batches = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        batches.append((time.perf_counter() - start) / iterations)
+    return sorted(batches)[2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=8,
+                        help='number of frames described in each payload')
+    parser.add_argument('--iterations', type=int, default=2000,
+                        help='number of calls timed per batch')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write results to FILE instead of stdout')
+    args = parser.parse_args()
+
+    import communications
+    import diagnostics
+    import telemetry
+    import templates
+    from diagnostics_history import DiagnosticsHistory, format_rollups
+
+    work = tempfile.TemporaryDirectory(prefix='satellite-telemetry-bench-')
+    templates.BYTECODE_CACHE_DIRECTORY = os.path.join(work.name,
+                                                        'template-cache')
+    sample = diagnostics.collect_diagnostics()
+    history = DiagnosticsHistory(capacity=1440)
+    for _ in range(1440):
+        history.append(sample)
+    frames = [
+        telemetry.FrameTelemetry(f'/dev/video{i}', time.time(), 0.52,
+                                    180000 + i, 0)
+            for i in range(args.frames)
+    ]
+    template_path = os.path.join(ROOT, 'static', 'email-message.html')
+
+    def render() -> str:
+        return templates.render(
+            template_path, diagnostics=diagnostics.format_diagnostics(sample),
+            rollups=format_rollups(history.rollups(24 * 60 * 60)),
+            window='last 24 hours')
+
+    def html_message() -> bytes:
+        return b''.join(communications.iter_message_chunks(CONFIG, render(),
+                                                           []))
+
+    def packet(compress: bool) -> bytes:
+        return telemetry.encode('Benchmark', sample, frames,
+                                compress=compress)
+
+    def telemetry_message(compress: bool) -> bytes:
+        return b''.join(communications.iter_telemetry_message(
+            CONFIG, packet(compress)))
+
+    packed = packet(True)
+    payloads: Dict[str, Dict] = {
+        'html': {
+            'payload_bytes': len(render().encode('utf-8')),
+            'message_bytes': len(html_message()),
+            'seconds_per_message': _time_per_call(html_message,
+                                                    args.iterations // 10)
+        }
+    }
+    for name, compress in (('telemetry', False), ('telemetry_zlib', True)):
+        payloads[name] = {
+            'payload_bytes': len(packet(compress)),
+            'message_bytes': len(telemetry_message(compress)),
+            'seconds_per_message': _time_per_call(
+                lambda: telemetry_message(compress), args.iterations),
+            'seconds_per_encode': _time_per_call(lambda: packet(compress),
+                                                    args.iterations)
+        }
+    payloads['telemetry_zlib']['seconds_per_decode'] = _time_per_call(
+        lambda: telemetry.decode(packed), args.iterations)
+    payloads['telemetry_zlib']['seconds_per_format'] = _time_per_call(
+        lambda: telemetry.format_telemetry(telemetry.decode(packed)),
+        args.iterations)
+    history.close()
+    work.cleanup()
+
+    report = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'frames': args.frames,
+        'payloads': payloads,
+        'message_size_ratio': payloads['html']['message_bytes'] /
+                                payloads['telemetry_zlib']['message_bytes']
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
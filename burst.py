@@ -0,0 +1,191 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import instrumentation
+from photography import CaptureResult
+from sessions import PiCameraSession, V4L2Session
+
+# The size (width, height) frames are shrunk to, in grayscale, before they
+# are scored. The JPEG decoder is asked for a reduced size, so most of the
+# full decode work is skipped.
+SCORE_SIZE: Tuple[int, int] = (320, 180)
+
+# Pixel values at or below CLIP_LOW or at or above CLIP_HIGH count as
+# clipped shadows or highlights
+CLIP_LOW: int = 8
+CLIP_HIGH: int = 247
+
+# The number of seconds a V4L2 device streams for before frames are kept,
+# when no capture profile is given. Matches photography.CAPTURE_ARGS.
+WARM_UP_DELAY: float = 1.0
+
+# Scores frames alongside each other. NumPy and the JPEG decoder release the
+# GIL, so threads are enough.
+_score_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                        thread_name_prefix='burst')
+
+
+class FrameScore(NamedTuple):
+    """How good a frame is. Sharpness is the variance of the frame's
+    Laplacian, and exposure runs from 0 (all black, all white or clipped) to
+    1 (centred on mid grey with nothing clipped). The score is their product,
+    so a sharp frame only wins if it is also reasonably exposed."""
+    sharpness: float
+    exposure: float
+    score: float
+
+
+def _decode_grayscale(jpeg: bytes,
+                        size: Tuple[int, int] = SCORE_SIZE) -> np.ndarray:
+    with Image.open(io.BytesIO(jpeg)) as image:
+        image.draft('L', size)
+        image = image.convert('L')
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR)
+        return np.asarray(image, dtype=np.float32)
+
+
+def score_frame(jpeg: bytes,
+                size: Tuple[int, int] = SCORE_SIZE) -> FrameScore:
+    """Score a JPEG frame's sharpness and exposure on a small grayscale copy.
+
+    Args:
+        jpeg (bytes): the frame's JPEG data
+        size (Tuple[int, int], optional): the size to score the frame at.
+        Defaults to SCORE_SIZE.
+
+    Returns:
+        FrameScore: the frame's sharpness, exposure and overall score
+    """
+    pixels = _decode_grayscale(jpeg, size)
+    # A 4-neighbour Laplacian: edges that are in focus have large second
+    # derivatives, so a sharp frame's Laplacian varies more
+    laplacian = (pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] +
+                    pixels[2:, 1:-1] - 4 * pixels[1:-1, 1:-1])
+    sharpness = float(laplacian.var())
+    clipped = np.count_nonzero((pixels <= CLIP_LOW) |
+                                (pixels >= CLIP_HIGH)) / pixels.size
+    exposure = max(0.0, 1.0 - abs(float(pixels.mean()) - 127.5) / 127.5 -
+                            clipped)
+    return FrameScore(sharpness, exposure, sharpness * exposure)
+
+
+def select_best(session, frames: int, timeout: float = 5.0,
+                executor: Optional[ThreadPoolExecutor] = None
+                ) -> Tuple[Optional[bytes], List[FrameScore]]:
+    """Grab consecutive frames from a session, scoring each in the worker
+    pool as soon as it arrives, while the next one is grabbed, and keep only
+    the best one. Frames that lose are dropped as soon as they are scored, so
+    no more than three frames are held at once.
+
+    Args:
+        session: a sessions.V4L2Session or sessions.PiCameraSession
+        frames (int): the number of frames to grab
+        timeout (float, optional): how many seconds to wait for each frame.
+        Defaults to 5.0.
+        executor (ThreadPoolExecutor, optional): the pool to score frames in.
+        Defaults to None, which uses the module's shared pool.
+
+    Returns:
+        Tuple[Optional[bytes], List[FrameScore]]: the best frame's JPEG data,
+        or None if no frame arrived, and the score of each frame grabbed, in
+        order. Frames that couldn't be decoded are skipped.
+    """
+    executor = executor if executor is not None else _score_executor
+    best, best_score, scores = None, None, []
+
+    def keep_better(jpeg: bytes, future):
+        nonlocal best, best_score
+        try:
+            score = future.result()
+        except Exception:
+            return
+        scores.append(score)
+        if best_score is None or score.score > best_score:
+            best, best_score = jpeg, score.score
+
+    scoring = None
+    seen = session.frame_count
+    for _ in range(frames):
+        jpeg = session.grab(timeout, newer_than=seen)
+        if jpeg is None:
+            break
+        seen = session.frame_count
+        if scoring is not None:
+            keep_better(*scoring)
+        scoring = (jpeg, executor.submit(score_frame, jpeg))
+    if scoring is not None:
+        keep_better(*scoring)
+    return best, scores
+
+
+def _grab_burst(device: str, frames: int, channel: int, profile,
+                timeout: float) -> Tuple[Optional[bytes], List[FrameScore]]:
+    """Open a session on the device just for the burst and grab it (see
+    select_best())."""
+    if device == 'RPi Camera Module':
+        session = PiCameraSession()
+        delay = 0.0
+    else:
+        session = V4L2Session(device, channel)
+        delay = profile.delay if profile is not None else WARM_UP_DELAY
+    if profile is not None:
+        session.set_profile(profile)
+
+    with session:
+        # Frames from the first moments of a stream are often dark or out of
+        # focus
+        time.sleep(delay)
+        return select_best(session, frames, timeout)
+
+
+def capture_burst(device: str, image_file_path: str, frames: int,
+                    channel: int = 0, profile=None,
+                    timeout: float = 5.0) -> CaptureResult:
+    """Grab a burst of frames from a device in one session and save only the
+    best one (see select_best()). The other frames never leave memory.
+
+    Args:
+        device (str): the device to capture on, for example /dev/video0, or
+        'RPi Camera Module'
+        image_file_path (str): the path and filename of the file to store the
+        best frame in, without the '.jpg' extension
+        frames (int): the number of frames to grab
+        channel (int, optional): the input (camera) on the device to capture
+        from. Defaults to 0.
+        profile (profiles.CaptureProfile, optional): the resolution, JPEG
+        quality and warm-up delay to capture with. Defaults to None.
+        timeout (float, optional): how many seconds to wait for each frame.
+        Defaults to 5.0.
+
+    Returns:
+        CaptureResult: the burst's timing, exit status and output
+    """
+    start = time.perf_counter()
+    image_path = image_file_path + '.jpg'
+    try:
+        best, scores = _grab_burst(device, frames, channel, profile, timeout)
+        if best is None:
+            return CaptureResult(device, image_path, 1,
+                                    time.perf_counter() - start,
+                                    'No frame received\n')
+        with open(image_path, 'wb') as image_file:
+            image_file.write(best)
+    except Exception as err:
+        return CaptureResult(device, image_path, 1,
+                                time.perf_counter() - start, f'{err}\n')
+
+    best_score = max(scores, key=lambda s: s.score)
+    instrumentation.record('burst', duration=time.perf_counter() - start,
+                            device=device, size=len(best),
+                            frames=len(scores), best=scores.index(best_score),
+                            sharpness=round(best_score.sharpness, 1),
+                            exposure=round(best_score.exposure, 3))
+    return CaptureResult(device, image_path, 0, time.perf_counter() - start,
+                            '')
@@ -0,0 +1,502 @@
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import communications
+import diagnostics
+import instrumentation
+import packing
+import telemetry
+import templates
+from frame_store import CHANGE_THRESHOLD, difference_hash, hamming_distance
+from mail_transport import MailTransport
+
+# The port the collector listens on when the config file doesn't give one
+DEFAULT_PORT: int = 8750
+
+# The address the collector listens on when the config file doesn't give one.
+# Listening on other addresses needs a token (see Collector.serve()).
+DEFAULT_HOST: str = '127.0.0.1'
+
+# The number of bytes of an uploaded frame read at a time
+UPLOAD_CHUNK_SIZE: int = 64 * 1024
+
+# The largest accepted uploads, in bytes
+MAX_FRAME_SIZE: int = 20 * 1000 * 1000
+MAX_DIAGNOSTICS_SIZE: int = 64 * 1000
+
+# The longest accepted satellite or device name, and the characters it may
+# contain
+MAX_NAME_LENGTH: int = 64
+NAME_CHARACTERS = frozenset('abcdefghijklmnopqrstuvwxyz'
+                            'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ._:/-')
+
+# The most satellites, and devices across all satellites, kept at once.
+# Pushes from new ones are refused beyond this.
+MAX_NODES: int = 256
+MAX_DEVICES: int = 1024
+
+
+class PendingFrame(NamedTuple):
+    """The newest frame from one of a node's devices, waiting for the next
+    digest."""
+    satellite: str
+    device: str
+    path: str
+    timestamp: float
+    dhash: int
+
+
+def _get_safe_name(name: str) -> str:
+    return ''.join(c if c.isalnum() else '_' for c in name).strip('_')
+
+
+def _check_name(name, kind: str) -> str:
+    """Check a satellite or device name pushed by a node, which is used as a
+    key and shown in the digest.
+
+    Raises:
+        ValueError: if the name is empty, too long or has characters outside
+        NAME_CHARACTERS
+    """
+    if not isinstance(name, str) or not name.strip() or \
+            len(name) > MAX_NAME_LENGTH or not set(name) <= NAME_CHARACTERS:
+        raise ValueError(f'Bad {kind} name')
+    return name
+
+
+class Collector:
+    """Gathers diagnostics and frames pushed by satellite nodes and emails
+    them as one fleet digest at a fixed interval, through one mail
+    connection. Only the newest frame from each device is kept between
+    digests, and frames that haven't changed since the device's previous frame
+    are dropped when they arrive.
+    """
+
+    def __init__(self, config: Dict, transport: MailTransport,
+                    directory: str = './collector/',
+                    change_threshold: int = CHANGE_THRESHOLD,
+                    template_path: Optional[str] = None):
+        """Create a collector.
+
+        Args:
+            config (Dict): the loaded config file. Its "collector" section can
+            set a "token" that nodes must send.
+            transport (MailTransport): the transport to send digests through
+            directory (str, optional): the path to the folder to keep pending
+            frames in. Defaults to './collector/'.
+            change_threshold (int, optional): the number of differing
+            difference hash bits above which a frame counts as changed.
+            Defaults to CHANGE_THRESHOLD.
+            template_path (str, optional): the path to the digest template.
+            Defaults to None, which uses the 'fleet' report template.
+        """
+        self.config = config
+        self.transport = transport
+        self.directory = directory
+        self.change_threshold = change_threshold
+        self.template_path = template_path if template_path else \
+                                templates.get_template_path('fleet')
+        self.token = config.get('collector', {}).get('token')
+        self.incoming_directory = os.path.join(directory, 'incoming')
+        self.pending_directory = os.path.join(directory, 'pending')
+        os.makedirs(self.incoming_directory, exist_ok=True)
+        os.makedirs(self.pending_directory, exist_ok=True)
+        # Each node's latest raw diagnostics, the time they arrived and the
+        # number of samples since the last digest
+        self.nodes: Dict[str, Dict] = {}
+        self.frames: Dict[Tuple[str, str], PendingFrame] = {}
+        # The difference hash of each device's last emailed frame
+        self._sent_hashes: Dict[Tuple[str, str], int] = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add_diagnostics(self, satellite: str, values: Dict,
+                        timestamp: Optional[float] = None):
+        """Keep a node's latest raw diagnostics (see
+        diagnostics.collect_diagnostics()).
+
+        Raises:
+            ValueError: if the satellite's name isn't allowed (see
+            _check_name()), too many satellites are already kept, or the
+            diagnostics are missing values or have values of the wrong type
+        """
+        _check_name(satellite, 'satellite')
+        try:
+            formatted = diagnostics.format_diagnostics(values)
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            raise ValueError(f'Bad diagnostics: {err!r}')
+        with self._lock:
+            self._check_capacity(satellite)
+            node = self.nodes.setdefault(satellite, {'samples': 0})
+            node['values'] = values
+            node['diagnostics'] = formatted
+            node['timestamp'] = time.time() if timestamp is None \
+                                    else timestamp
+            node['samples'] += 1
+
+    def _check_capacity(self, satellite: str,
+                        device: Optional[str] = None):
+        """Refuse a new satellite or device once MAX_NODES or MAX_DEVICES are
+        kept. Must be called with the lock held."""
+        if satellite not in self.nodes and len(self.nodes) >= MAX_NODES:
+            raise ValueError('Too many satellites')
+        if device is not None and (satellite, device) not in self.frames \
+                and len(self.frames) >= MAX_DEVICES:
+            raise ValueError('Too many devices')
+
+    def add_frame(self, satellite: str, device: str, stream, length: int,
+                    timestamp: Optional[float] = None) -> bool:
+        """Read an uploaded frame from the stream to disk, a chunk at a time,
+        and keep it for the next digest unless it hasn't changed.
+
+        Args:
+            satellite (str): the name of the node that captured the frame
+            device (str): the device the frame was captured on
+            stream: a file-like object to read the frame from
+            length (int): the frame's size in bytes
+            timestamp (float, optional): when the frame was captured, in
+            seconds since the epoch. Defaults to None, which uses the current
+            time.
+
+        Returns:
+            bool: whether the frame was kept
+
+        Raises:
+            ValueError: if a name isn't allowed (see _check_name()), too many
+            satellites or devices are already kept, or the upload is cut short
+            or isn't an image
+        """
+        _check_name(satellite, 'satellite')
+        _check_name(device, 'device')
+        with tempfile.NamedTemporaryFile(dir=self.incoming_directory,
+                                            suffix='.jpg',
+                                            delete=False) as incoming:
+            remaining = length
+            while remaining > 0:
+                data = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                incoming.write(data)
+                remaining -= len(data)
+        if remaining > 0:
+            os.remove(incoming.name)
+            raise ValueError('The upload ended early')
+        try:
+            dhash = difference_hash(incoming.name)
+        except OSError:
+            os.remove(incoming.name)
+            raise ValueError('The upload is not an image')
+
+        key = (satellite, device)
+        with self._lock:
+            # Compared with the frame still waiting from the device, or else
+            # the device's last emailed frame
+            pending = self.frames.get(key)
+            previous = pending.dhash if pending is not None \
+                        else self._sent_hashes.get(key)
+            if previous is not None and \
+                    hamming_distance(dhash, previous) <= self.change_threshold:
+                self.dropped += 1
+                os.remove(incoming.name)
+                return False
+            try:
+                self._check_capacity(satellite, device)
+            except ValueError:
+                os.remove(incoming.name)
+                raise
+            # A newer frame replaces any frame from the device still waiting
+            path = os.path.join(self.pending_directory,
+                                f'{_get_safe_name(satellite)}-'
+                                f'{_get_safe_name(device)}.jpg')
+            os.replace(incoming.name, path)
+            self.frames[key] = PendingFrame(
+                satellite, device, path,
+                time.time() if timestamp is None else timestamp, dhash)
+            node = self.nodes.setdefault(satellite, {'samples': 0})
+            node.setdefault('timestamp', self.frames[key].timestamp)
+        return True
+
+    def send_digest(self) -> bool:
+        """Email every node's latest diagnostics and the frames waiting since
+        the last digest, as one digest.
+
+        Returns:
+            bool: whether the digest was sent. If not, it stays spooled in
+            the transport, and the frames are dropped from the collector
+            either way.
+        """
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory(dir=self.directory) as work_directory:
+            # Pending frames are moved out of the way, so uploads can go on
+            # while the digest is sent
+            with self._lock:
+                nodes = {name: dict(node) for name, node in self.nodes.items()}
+                frames = sorted(self.frames.values())
+                self.frames = {}
+                for node in self.nodes.values():
+                    node['samples'] = 0
+                dropped, self.dropped = self.dropped, 0
+                for frame in frames:
+                    self._sent_hashes[(frame.satellite, frame.device)] = \
+                        frame.dhash
+                    os.replace(frame.path, os.path.join(
+                        work_directory, os.path.basename(frame.path)))
+            if not nodes:
+                return True
+            attachment_paths = [
+                os.path.join(work_directory, os.path.basename(f.path))
+                    for f in frames
+            ]
+
+            now = time.time()
+            fleet = [{
+                'satellite': name,
+                'age': int(now - nodes[name]['timestamp']),
+                'samples': nodes[name]['samples'],
+                'diagnostics': nodes[name].get('diagnostics', {}),
+                'frames': [f.device for f in frames if f.satellite == name]
+            } for name in sorted(nodes)]
+            html = templates.render(self.template_path, fleet=fleet,
+                                    frames=len(frames), dropped=dropped)
+
+            max_message_size = self.config.get(
+                'max_message_size', packing.DEFAULT_MAX_MESSAGE_SIZE)
+            overhead = 2000 + packing.encoded_size(len(html.encode('utf-8')))
+            messages = packing.pack_attachments(
+                attachment_paths, max_message_size, work_directory,
+                overhead) or [[]]
+            sent = True
+            for part, paths in enumerate(messages, start=1):
+                subject = f'Satellite {self.config["satellite"]} Fleet ' \
+                            f'Digest ({len(fleet)} nodes)'
+                if len(messages) > 1:
+                    subject += f' ({part}/{len(messages)})'
+                sent = self.transport.send(communications.iter_message_chunks(
+                    self.config, html, paths, subject)) and sent
+        instrumentation.record('digest', duration=time.perf_counter() - start,
+                                exit_code=0 if sent else 1, nodes=len(fleet),
+                                frames=len(frames), dropped=dropped)
+        return sent
+
+    def serve(self, port: int = DEFAULT_PORT,
+                host: str = DEFAULT_HOST) -> ThreadingHTTPServer:
+        """Accept pushes from nodes on the given port, handling each
+        connection in its own thread, until the returned server is shut down.
+
+        Nodes push with POST /diagnostics, whose body is JSON with the node's
+        "satellite" name, "values" and "timestamp", and POST
+        /frames?satellite=...&device=...&timestamp=..., whose body is the
+        JPEG frame. A node can push POST /telemetry, whose body is a telemetry
+        packet (see telemetry.encode()), in place of its diagnostics.
+
+        Raises:
+            ValueError: if asked to listen on an address other than loopback
+            without a token set in the config file
+        """
+        if not self.token and host not in ('127.0.0.1', '::1', 'localhost'):
+            raise ValueError(f'The collector needs a token in the config '
+                                f'file to listen on {host}')
+        collector = self
+
+        class CollectorHandler(BaseHTTPRequestHandler):
+            # Keeps connections open, so a node pushes a whole report over
+            # one connection
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, code: int, body: Optional[Dict] = None):
+                data = json.dumps(body if body else {}).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = self.headers.get('Content-Length')
+                if collector.token and \
+                        self.headers.get('X-Satellite-Token') != collector.token:
+                    self.close_connection = True
+                    self._reply(403, {'error': 'Bad token'})
+                    return
+                if length is None:
+                    self.close_connection = True
+                    self._reply(411, {'error': 'Content-Length required'})
+                    return
+                length = int(length)
+                start = time.perf_counter()
+                try:
+                    if url.path == '/diagnostics':
+                        if length > MAX_DIAGNOSTICS_SIZE:
+                            raise OverflowError()
+                        report = json.loads(self.rfile.read(length))
+                        collector.add_diagnostics(report['satellite'],
+                                                    report['values'],
+                                                    report.get('timestamp'))
+                        self._reply(200, {'kept': True})
+                    elif url.path == '/telemetry':
+                        if length > MAX_DIAGNOSTICS_SIZE:
+                            raise OverflowError()
+                        packet = telemetry.decode(self.rfile.read(length))
+                        collector.add_diagnostics(packet.satellite,
+                                                    packet.diagnostics,
+                                                    packet.timestamp)
+                        self._reply(200, {'kept': True})
+                    elif url.path == '/frames':
+                        if length > MAX_FRAME_SIZE:
+                            raise OverflowError()
+                        timestamp = query.get('timestamp')
+                        kept = collector.add_frame(
+                            query['satellite'], query['device'], self.rfile,
+                            length, float(timestamp) if timestamp else None)
+                        instrumentation.record(
+                            'collector_upload',
+                            duration=time.perf_counter() - start,
+                            device=query['device'], size=length,
+                            exit_code=0, satellite=query['satellite'],
+                            kept=kept)
+                        self._reply(200, {'kept': kept})
+                    else:
+                        self.close_connection = True
+                        self._reply(404, {'error': 'Not found'})
+                except OverflowError:
+                    self.close_connection = True
+                    self._reply(413, {'error': 'Upload too large'})
+                except (KeyError, ValueError) as err:
+                    self.close_connection = True
+                    self._reply(400, {'error': str(err)})
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), CollectorHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True,
+                            name='collector').start()
+        return server
+
+    def run(self, stop_event: threading.Event, digest_interval: float = 900.0,
+            port: int = DEFAULT_PORT, host: str = DEFAULT_HOST):
+        """Accept pushes and send a digest every digest_interval seconds until
+        the stop event is set, then send a last digest.
+
+        Args:
+            stop_event (threading.Event): set to stop collecting
+            digest_interval (float, optional): the number of seconds between
+            digests. Defaults to 900.0.
+            port (int, optional): the port to listen on. Defaults to
+            DEFAULT_PORT.
+            host (str, optional): the address to listen on. Defaults to
+            DEFAULT_HOST, which only accepts pushes from this machine.
+        """
+        server = self.serve(port, host)
+        try:
+            while not stop_event.wait(digest_interval):
+                self.send_digest()
+                self.transport.drain()
+        finally:
+            server.shutdown()
+            server.server_close()
+            self.send_digest()
+
+
+def _connect(url: str, timeout: float) -> http.client.HTTPConnection:
+    parts = urllib.parse.urlsplit(url)
+    return http.client.HTTPConnection(parts.hostname,
+                                        parts.port or DEFAULT_PORT,
+                                        timeout=timeout)
+
+
+def _post(connection: http.client.HTTPConnection, path: str, body,
+            length: int, content_type: str,
+            token: Optional[str] = None) -> Dict:
+    """Make a POST request to a collector and return its JSON reply, raising
+    http.client.HTTPException if the request was rejected."""
+    headers = {'Content-Type': content_type, 'Content-Length': str(length)}
+    if token:
+        headers['X-Satellite-Token'] = token
+    connection.request('POST', path, body=body, headers=headers)
+    response = connection.getresponse()
+    reply = json.loads(response.read() or b'{}')
+    if response.status != 200:
+        raise http.client.HTTPException(
+            f'{response.status}: {reply.get("error")}')
+    return reply
+
+
+def push_report(url: str, satellite: str, diagnostics_values: Dict,
+                frames: List[Tuple[str, str]], token: Optional[str] = None,
+                timeout: float = 30.0) -> int:
+    """Push a node's raw diagnostics and frames to a collector over one
+    connection. Frames are streamed from disk.
+
+    Args:
+        url (str): the collector's URL, such as 'http://collector.local:8750'
+        satellite (str): the node's name
+        diagnostics_values (Dict): the node's raw diagnostics (see
+        diagnostics.collect_diagnostics())
+        frames (List[Tuple[str, str]]): the device and image path of each
+        frame
+        token (str, optional): the collector's token. Defaults to None.
+        timeout (float, optional): the socket timeout, in seconds. Defaults to
+        30.0.
+
+    Returns:
+        int: the number of frames the collector kept
+
+    Raises:
+        OSError: if the collector couldn't be reached
+        http.client.HTTPException: if the collector rejected a push
+    """
+    connection = _connect(url, timeout)
+    kept = 0
+    try:
+        body = json.dumps({'satellite': satellite, 'timestamp': time.time(),
+                            'values': diagnostics_values},
+                            default=str).encode()
+        _post(connection, '/diagnostics', body, len(body), 'application/json',
+                token)
+        for device, image_path in frames:
+            query = urllib.parse.urlencode({
+                'satellite': satellite, 'device': device,
+                'timestamp': os.path.getmtime(image_path)
+            })
+            with open(image_path, 'rb') as image_file:
+                kept += _post(connection, f'/frames?{query}', image_file,
+                                os.path.getsize(image_path), 'image/jpeg',
+                                token)['kept']
+    finally:
+        connection.close()
+    return kept
+
+
+def push_telemetry(url: str, packet: bytes, token: Optional[str] = None,
+                    timeout: float = 30.0):
+    """Push a telemetry packet (see telemetry.encode()) to a collector, in
+    place of a node's diagnostics and frames.
+
+    Args:
+        url (str): the collector's URL, such as 'http://collector.local:8750'
+        packet (bytes): the telemetry packet
+        token (str, optional): the collector's token. Defaults to None.
+        timeout (float, optional): the socket timeout, in seconds. Defaults to
+        30.0.
+
+    Raises:
+        OSError: if the collector couldn't be reached
+        http.client.HTTPException: if the collector rejected the packet
+    """
+    connection = _connect(url, timeout)
+    try:
+        _post(connection, '/telemetry', packet, len(packet),
+                'application/octet-stream', token)
+    finally:
+        connection.close()
@@ -1,18 +1,27 @@
+import base64
 import json
-import smtplib
-import ssl
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import tempfile
+import uuid
+from email.header import Header
+from email.utils import formatdate, make_msgid
 from os import path, walk
-from typing import List
-from jinja2 import Template
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import diagnostics
+import packing
+import templates
+from mail_transport import MailTransport
 
 
-def _get_file_paths(folder_path: str) -> List[str]:
+class ReportFrame(NamedTuple):
+    """A captured frame shown as an inline thumbnail in a report."""
+    caption: str
+    thumbnail_path: str
+    # The full size frame to attach, or None to only show the thumbnail
+    image_path: Optional[str] = None
+
+
+def get_file_paths(folder_path: str) -> List[str]:
     """Get the paths to all files in the folder given by the path 
     folder_path.
 
@@ -30,34 +39,241 @@ def _get_file_paths(folder_path: str) -> List[str]:
         paths.append(path.join(folder_path, filename))
     return paths
 
-def _attach_file(message: MIMEMultipart, attachment_path: str):
-    """Attach the attachment with given file path to the given email message.
+# The number of attachment bytes encoded per chunk. A multiple of 57 bytes 
+# encodes to whole 76 character base64 lines.
+ENCODE_CHUNK_SIZE: int = 57 * 1024
+
+def _encode_base64_lines(data: bytes) -> bytes:
+    """Encode the given bytes as base64, split into CRLF terminated lines."""
+    return base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+def iter_attachment_chunks(attachment_path: str, 
+                           boundary: str) -> Iterator[bytes]:
+    """Yield the MIME part for the attachment with the given file path, 
+    reading and encoding the file a chunk at a time.
 
     Args:
-        message (MIMEMultipart): the email message to add an attachment to
         attachment_path (str): the path to the attachment file
+        boundary (str): the boundary string of the enclosing multipart message
+
+    Yields:
+        bytes: the part's headers, followed by its base64 encoded content
+    """
+
+    yield (
+        f'--{boundary}\r\n'
+        'Content-Type: application/octet-stream\r\n'
+        'MIME-Version: 1.0\r\n'
+        'Content-Transfer-Encoding: base64\r\n'
+        'Content-Disposition: attachment; '
+        f'filename= {path.basename(attachment_path)}\r\n'
+        '\r\n'
+    ).encode()
+    with open(attachment_path, 'rb') as attachment:
+        while True:
+            data = attachment.read(ENCODE_CHUNK_SIZE)
+            if not data:
+                break
+            yield _encode_base64_lines(data)
+
+def _iter_inline_image_chunks(image_path: str, content_id: str,
+                              boundary: str) -> Iterator[bytes]:
+    """Yield the MIME part for a JPEG image shown inline in the HTML part,
+    which refers to it as cid:<content_id>."""
+
+    yield (
+        f'--{boundary}\r\n'
+        'Content-Type: image/jpeg\r\n'
+        'MIME-Version: 1.0\r\n'
+        'Content-Transfer-Encoding: base64\r\n'
+        f'Content-ID: <{content_id}>\r\n'
+        'Content-Disposition: inline; '
+        f'filename= {path.basename(image_path)}\r\n'
+        '\r\n'
+    ).encode()
+    with open(image_path, 'rb') as image:
+        yield _encode_base64_lines(image.read())
+
+def get_subject(config: Dict, part: int = 1, parts: int = 1) -> str:
+    """Get the subject line for a message, numbered if the report is split
+    across several messages."""
+    subject = f'Satellite {config["satellite"]} Message'
+    if parts > 1:
+        subject += f' ({part}/{parts})'
+    return subject
+
+def iter_message_head(config: Dict, html: str, boundary: str,
+                      subject: Optional[str] = None,
+                      inline_images: Optional[List[Tuple[str, str]]] = None
+                      ) -> Iterator[bytes]:
+    """Yield the start of an email message: its headers and HTML part, along
+    with any inline images. Attachment parts and the closing boundary follow
+    (see iter_message_chunks()).
+
+    Args:
+        config (Dict): the loaded config file, used for the message's headers
+        html (str): the message's HTML content
+        boundary (str): the boundary string of the message's parts
+        subject (str, optional): the message's subject. Defaults to None, which
+        uses the satellite's name.
+        inline_images (List[Tuple[str, str]], optional): the content ID and 
+        path of each JPEG image the HTML refers to. These are sent alongside 
+        the HTML in a multipart/related part. Defaults to None.
+
+    Yields:
+        bytes: the next chunk of the message
+    """
+
+    if subject is None:
+        subject = get_subject(config)
+    subject = Header(subject).encode()
+    content_type = 'multipart/mixed' if inline_images else \
+                    'multipart/alternative'
+    yield (
+        f'Content-Type: {content_type}; boundary="{boundary}"\r\n'
+        'MIME-Version: 1.0\r\n'
+        f'Subject: {subject}\r\n'
+        f'From: {config["sender"]["username"]}\r\n'
+        f'To: {config["recipient"]["username"]}\r\n'
+        f'Date: {formatdate(localtime=True)}\r\n'
+        f'Message-ID: {make_msgid()}\r\n'
+        '\r\n'
+    ).encode()
+    html_boundary = boundary
+    if inline_images:
+        html_boundary = f'==============={uuid.uuid4().hex}=='
+        yield (
+            f'--{boundary}\r\n'
+            'Content-Type: multipart/related; '
+            f'boundary="{html_boundary}"; type="text/html"\r\n'
+            'MIME-Version: 1.0\r\n'
+            '\r\n'
+        ).encode()
+    yield (
+        f'--{html_boundary}\r\n'
+        'Content-Type: text/html; charset="utf-8"\r\n'
+        'MIME-Version: 1.0\r\n'
+        'Content-Transfer-Encoding: base64\r\n'
+        '\r\n'
+    ).encode()
+    yield _encode_base64_lines(html.encode('utf-8'))
+    if inline_images:
+        for content_id, image_path in inline_images:
+            yield from _iter_inline_image_chunks(image_path, content_id, 
+                                                    html_boundary)
+        yield f'--{html_boundary}--\r\n'.encode()
+
+def iter_message_chunks(config: Dict, html: str, 
+                        attachment_paths: Iterable[str],
+                        subject: Optional[str] = None,
+                        inline_images: Optional[List[Tuple[str, str]]] = None
+                        ) -> Iterator[bytes]:
+    """Yield the email message with the given HTML content and attachments,
+    encoded a chunk at a time so that the message never has to be held in 
+    memory in full. Every chunk ends with a CRLF line ending.
+
+    Args:
+        config (Dict): the loaded config file, used for the message's headers
+        html (str): the message's HTML content
+        attachment_paths (Iterable[str]): the paths to the attachment files
+        subject (str, optional): the message's subject. Defaults to None, which
+        uses the satellite's name.
+        inline_images (List[Tuple[str, str]], optional): the content ID and 
+        path of each JPEG image the HTML refers to. These are sent alongside 
+        the HTML in a multipart/related part. Defaults to None.
+
+    Yields:
+        bytes: the next chunk of the message
     """
 
-    # Open the attachment in binary reading mode
-    with open(attachment_path, "rb") as attachment:
-        part = MIMEBase("application", "octet-stream")
-        part.set_payload(attachment.read())
+    boundary = f'==============={uuid.uuid4().hex}=='
+    yield from iter_message_head(config, html, boundary, subject, 
+                                 inline_images)
+    for attachment_path in attachment_paths:
+        yield from iter_attachment_chunks(attachment_path, boundary)
+    yield f'--{boundary}--\r\n'.encode()
 
-    # Encode file in ASCII characters to send by email
-    encoders.encode_base64(part)
+def iter_telemetry_message(config: Dict, packet: bytes,
+                           filename: str = 'telemetry.stlm'
+                           ) -> Iterator[bytes]:
+    """Yield an email message whose only content is the given telemetry packet
+    (see telemetry.encode()), with no HTML part, so the message is only a few
+    hundred bytes more than the packet.
 
-    # Add header as key/value pair to attachment part
-    part.add_header(
-        "Content-Disposition",
-        f"attachment; filename= {attachment_path}",
-    )
+    Args:
+        config (Dict): the loaded config file, used for the message's headers
+        packet (bytes): the telemetry packet
+        filename (str, optional): the packet's filename. Defaults to
+        'telemetry.stlm'.
+
+    Yields:
+        bytes: the next chunk of the message
+    """
+
+    subject = Header(f'Satellite {config["satellite"]} Telemetry').encode()
+    yield (
+        'Content-Type: application/octet-stream\r\n'
+        'MIME-Version: 1.0\r\n'
+        'Content-Transfer-Encoding: base64\r\n'
+        f'Content-Disposition: attachment; filename="{filename}"\r\n'
+        f'Subject: {subject}\r\n'
+        f'From: {config["sender"]["username"]}\r\n'
+        f'To: {config["recipient"]["username"]}\r\n'
+        f'Date: {formatdate(localtime=True)}\r\n'
+        f'Message-ID: {make_msgid()}\r\n'
+        '\r\n'
+    ).encode()
+    yield _encode_base64_lines(packet)
+
+def send_telemetry(packet: bytes, config_path: str = './static/config.json',
+                   verbose: bool = False,
+                   transport: Optional[MailTransport] = None) -> bool:
+    """Email a telemetry packet (see telemetry.encode()) in place of a report.
+
+    Args:
+        packet (bytes): the telemetry packet
+        config_path (str, optional): the path to the config file to draw sender,
+        receiver, and email server information from. Defaults to 
+        './static/config.json'.
+        verbose (bool, optional): whether to output information to stdout while
+        emailing the packet. Defaults to False.
+        transport (MailTransport, optional): the transport to send the packet
+        through. Its connection is left open. Defaults to None, which opens a
+        new connection for this packet only.
+
+    Returns:
+        bool: whether the packet was sent, rather than spooled
+    """
+
+    config = _load_config(config_path)
+    own_transport = transport is None
+    if own_transport:
+        transport = MailTransport(config)
+    try:
+        sent = transport.send(iter_telemetry_message(config, packet))
+    finally:
+        if own_transport:
+            transport.close()
+    if verbose:
+        print(f'{"Sent" if sent else "Spooled"} the telemetry '
+                f'({len(packet)} bytes)')
+    return sent
 
-    message.attach(part) # attach attachment
+def _load_config(config_path: str) -> Dict:
+    """Load the JSON config file with the given path."""
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
 
 def send_email(attachments_folder_path: str, 
-                html_message_path: str = './static/email-message.html', 
-                config_path: str = './static/config.json',
-                verbose:bool = False):
+               html_message_path: str = './static/email-message.html', 
+               config_path: str = './static/config.json',
+               verbose:bool = False,
+               transport: Optional[MailTransport] = None,
+               diagnostics_values: Optional[Dict[str, any]] = None,
+               rollups: Optional[Dict[str, Dict[str, str]]] = None,
+               rollup_window: Optional[str] = None,
+               frames: Optional[List[ReportFrame]] = None,
+               alert: Optional[str] = None):
     """Use the config file to send an email containing the given message and
     attachments to a recipient, also defined in the config file.
 
@@ -65,59 +281,89 @@ def send_email(attachments_folder_path: str,
         attachments_folder_path (str): the path to the folder containing files
         to be attached
         html_message_path (str, optional): the path to the message's HTML 
-        content. Defaults to './static/email-message.html'.
+        template (see templates.REPORT_TEMPLATES). Defaults to 
+        './static/email-message.html'.
         config_path (str, optional): the path to the config file to draw sender,
         receiver, and email server information from. Defaults to 
         './static/config.json'.
         verbose (bool, optional): whether to output information to stdout while
         emailing the message. Defaults to False.
+        transport (MailTransport, optional): the transport to send the email
+        through. Its connection is left open. Defaults to None, which opens a
+        new connection for this email only. Either way, messages that can't
+        be sent are spooled and sent with the next email.
+        diagnostics_values (Dict[str, any], optional): formatted diagnostics to
+        include in the message. Defaults to None, which collects them now.
+        rollups (Dict[str, Dict[str, str]], optional): formatted diagnostics
+        history rollups (see diagnostics_history.format_rollups()) to include
+        in the message. Defaults to None.
+        rollup_window (str, optional): a description of the period the rollups
+        cover, such as 'last 24 hours'. Defaults to None.
+        frames (List[ReportFrame], optional): frames to show as inline 
+        thumbnails. When given, only the full size frames these list are 
+        attached, instead of every file in the attachments folder. Defaults to
+        None.
+        alert (str, optional): a short notice for the alert template to show.
+        Defaults to None.
     """
 
-    with open(config_path, 'r') as config_file:
-        config = json.load(config_file)
-
-    message = MIMEMultipart("alternative")
-    message["Subject"] = f'Satellite {config["satellite"]} Message'
-    message["From"] = config['sender']['username']
-    message["To"] = config['recipient']['username']
+    config = _load_config(config_path)
 
     """
         Create the HTML part of the message
     """
-    with open(html_message_path, 'r') as template_file:
-        template = Template(template_file.read())
-    html = template.render(diagnostics=diagnostics.get_formatted_diagnostics())
+    if diagnostics_values is None:
+        diagnostics_values = diagnostics.get_formatted_diagnostics()
+    inline_images = []
+    thumbnails = []
+    full_size_paths = get_file_paths(attachments_folder_path)
+    if frames is not None:
+        full_size_paths = [f.image_path for f in frames if f.image_path]
+        for number, frame in enumerate(frames):
+            if path.exists(frame.thumbnail_path):
+                content_id = make_msgid(f'thumbnail{number}')[1:-1]
+                inline_images.append((content_id, frame.thumbnail_path))
+                thumbnails.append({'cid': content_id, 
+                                    'caption': frame.caption})
+    html = templates.render(html_message_path, diagnostics=diagnostics_values,
+                            rollups=rollups, window=rollup_window, 
+                            thumbnails=thumbnails, alert=alert)
 
-    html_obj = MIMEText(html, "html")
+    # Messages are encoded a chunk at a time into the transport's spool, so
+    # attachments are streamed from disk rather than held in memory
+    max_message_size = config.get('max_message_size', 
+                                    packing.DEFAULT_MAX_MESSAGE_SIZE)
+    # Headers, the HTML part and its inline images, which are repeated in
+    # every message
+    message_overhead = 2000 + packing.encoded_size(len(html.encode('utf-8')))
+    for _, image_path in inline_images:
+        message_overhead += 500 + packing.encoded_size(
+            path.getsize(image_path))
 
-    message.attach(html_obj)
+    with tempfile.TemporaryDirectory() as work_directory:
+        messages = packing.pack_attachments(
+            full_size_paths, max_message_size, work_directory, 
+            message_overhead)
+        if not messages:
+            messages = [[]]
 
-    for attachment_path in _get_file_paths(attachments_folder_path):
-        _attach_file(message, attachment_path)
-    
-    """ 
-        Send the email
-    """
-    context = ssl.create_default_context() # Create a secure SSL context
-    with smtplib.SMTP_SSL(
-        config['sender']['server'], config['sender']['port'], context=context
-    ) as server:
+        own_transport = transport is None
+        if own_transport:
+            transport = MailTransport(config)
+
+        """ 
+            Send the email
+        """
         try:
-            server.login(config['sender']['username'], 
-                            config['sender']['password'])
-            if verbose:
-                print('Logged into the email server')
-            try:
-                server.sendmail(config['sender']['username'], 
-                                config['recipient']['username'], 
-                                message.as_string())
+            for part, attachment_paths in enumerate(messages, start=1):
+                subject = get_subject(config, part, len(messages))
+                sent = transport.send(iter_message_chunks(config, html, 
+                                                          attachment_paths,
+                                                          subject,
+                                                          inline_images))
                 if verbose:
-                    print("Sent the email")
-            except smtplib.SMTPException as err:
-                print('An error occurred while sending the email: \n', err)
-        except smtplib.SMTPException as err:
-            print("Could not log into the email server. Please check \
-                that the 'sender' values are correct in the config file.")
-            print('Error:\n', err)
+                    status = 'Sent' if sent else 'Spooled'
+                    print(f'{status} the email ({part}/{len(messages)})')
         finally:
-            server.quit()
+            if own_transport:
+                transport.close()
@@ -0,0 +1,348 @@
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import communications
+import diagnostics
+import instrumentation
+import packing
+import photography
+from mail_transport import MailTransport
+from photography import CaptureResult
+
+# The number of encoded message chunks (each about 75 KB) that can wait for
+# the uplink. Encoding pauses once this many are queued, which bounds memory
+# use however slow the uplink is.
+QUEUE_SIZE: int = 16
+
+# Marks the end of one message in the chunk queue, when a report is split
+# across several messages
+_END_OF_MESSAGE = object()
+
+# Tells the uploader that the cycle failed, so the message it is sending must
+# be dropped rather than finished
+_ABORT = object()
+
+
+class CycleAborted(Exception):
+    """Raised in the uploader when the cycle fails part way through a
+    message."""
+
+
+class CycleResult(NamedTuple):
+    """The outcome of one pipelined capture to email cycle."""
+    captures: List[CaptureResult]
+    diagnostics: Dict[str, any]
+    attached: int
+    sent: List[bool]
+
+
+async def _run_blocking(func: Callable, *args):
+    """Run a blocking function in the event loop's default thread pool."""
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def _take_fswebcam_picture(device: str, image_file_path: str,
+                                    profile=None) -> CaptureResult:
+    """Take a picture with fswebcam like photography.take_fswebcam_picture()
+    does, without tying up a thread while it runs."""
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *photography.get_fswebcam_capture_args(device, image_file_path,
+                                               profile),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    output, _ = await process.communicate()
+    return CaptureResult(device, image_file_path + '.jpg', process.returncode,
+                            time.perf_counter() - start,
+                            output.decode(errors='replace'))
+
+
+async def _capture_device(jobs: List, frames: asyncio.Queue,
+                            limit: Optional[asyncio.Semaphore] = None,
+                            get_profile: Optional[Callable] = None):
+    """Run a device's capture jobs one after another, queueing each frame for
+    the next stage as soon as it is taken."""
+    if limit is not None:
+        async with limit:
+            await _capture_device(jobs, frames, get_profile=get_profile)
+        return
+    for device, image_file_path in jobs:
+        profile = get_profile(device) if get_profile is not None else None
+        if device == 'RPi Camera Module':
+            result = await _run_blocking(photography.take_pi_camera_picture,
+                                         image_file_path, profile)
+        else:
+            result = await _take_fswebcam_picture(device, image_file_path,
+                                                    profile)
+        photography.record_capture(result)
+        await frames.put(result)
+
+
+class _Cycle:
+    """The stages of one cycle, which share the config, the chunk queue and
+    the list of results."""
+
+    def __init__(self, config: Dict, transport: MailTransport,
+                    render: Callable[[Dict], str], pipeline, frame_store,
+                    work_directory: str):
+        self.config = config
+        self.transport = transport
+        self.render = render
+        self.pipeline = pipeline
+        self.frame_store = frame_store
+        self.work_directory = work_directory
+        self.max_message_size = config.get('max_message_size',
+                                            packing.DEFAULT_MAX_MESSAGE_SIZE)
+        self.chunks: Optional[asyncio.Queue] = None
+        self.captures: List[CaptureResult] = []
+        self.attached = 0
+        self.overhead = 0
+
+    async def _put_all(self, chunks):
+        for chunk in chunks:
+            await self.chunks.put(chunk)
+
+    async def _start_message(self, html: str, part: int) -> str:
+        boundary = f'==============={uuid.uuid4().hex}=='
+        subject = communications.get_subject(self.config)
+        if part > 1:
+            subject += f' (part {part})'
+        await self._put_all(communications.iter_message_head(
+            self.config, html, boundary, subject))
+        return boundary
+
+    async def _prepare_frame(self, result: CaptureResult) -> Optional[str]:
+        """Run a captured frame through processing and change detection, and
+        shrink it if it is too big to email. Returns the path of the file to
+        attach, or None to leave the frame out."""
+        if result.returncode != 0:
+            return None
+        if self.pipeline is not None:
+            await _run_blocking(self.pipeline.process, result.device,
+                                result.image_path)
+        if self.frame_store is not None and await _run_blocking(
+                self.frame_store.add, result.device,
+                result.image_path) is None:
+            return None
+        image_path = result.image_path
+        budget = self.max_message_size - self.overhead
+        if packing.encoded_size(os.path.getsize(image_path)) > budget:
+            image_path = await _run_blocking(
+                packing.transcode, image_path, budget,
+                os.path.join(self.work_directory,
+                                os.path.basename(image_path))) or image_path
+        return image_path
+
+    async def _prepare_frames(self, frames: asyncio.Queue, frame_count: int,
+                                prepared: asyncio.Queue):
+        """Start preparing each frame as soon as it is captured, so processing
+        one frame overlaps with encoding and uploading the ones before it.
+        The preparations are queued in capture order."""
+        for _ in range(frame_count):
+            result = await frames.get()
+            self.captures.append(result)
+            await prepared.put(asyncio.ensure_future(
+                self._prepare_frame(result)))
+
+    async def encode(self, frames: asyncio.Queue, frame_count: int,
+                        diagnostics_task: asyncio.Future):
+        """Build the report as frames arrive: the HTML part once diagnostics
+        are in, then each frame's attachment part, starting a new message when
+        the next frame wouldn't fit."""
+        html = self.render(await diagnostics_task)
+        self.overhead = 2000 + packing.encoded_size(len(html.encode('utf-8')))
+        prepared: asyncio.Queue = asyncio.Queue()
+        preparer = asyncio.ensure_future(
+            self._prepare_frames(frames, frame_count, prepared))
+        try:
+            await self._encode_frames(html, frame_count, prepared)
+        finally:
+            preparer.cancel()
+            while not prepared.empty():
+                prepared.get_nowait().cancel()
+
+    async def _encode_frames(self, html: str, frame_count: int,
+                                prepared: asyncio.Queue):
+        part = 1
+        boundary = await self._start_message(html, part)
+        message_size = self.overhead
+        attachments = 0
+
+        for _ in range(frame_count):
+            preparation = await prepared.get()
+            try:
+                image_path = await preparation
+            except Exception as err:
+                # One bad frame shouldn't cost the rest of the report
+                print('Error: could not prepare an image:\n', err)
+                continue
+            if image_path is None:
+                continue
+            size = packing.encoded_size(os.path.getsize(image_path))
+            if attachments and message_size + size > self.max_message_size:
+                await self.chunks.put(f'--{boundary}--\r\n'.encode())
+                await self.chunks.put(_END_OF_MESSAGE)
+                part += 1
+                boundary = await self._start_message(html, part)
+                message_size = self.overhead
+                attachments = 0
+            # The file is read and encoded a chunk at a time off the loop
+            encoder = communications.iter_attachment_chunks(image_path,
+                                                            boundary)
+            while True:
+                chunk = await _run_blocking(next, encoder, None)
+                if chunk is None:
+                    break
+                await self.chunks.put(chunk)
+            message_size += size
+            attachments += 1
+            self.attached += 1
+        await self.chunks.put(f'--{boundary}--\r\n'.encode())
+        await self.chunks.put(None)
+
+    def upload(self, loop: asyncio.AbstractEventLoop) -> List[bool]:
+        """Stream each message to the server as its chunks are queued. This
+        runs in its own thread, since smtplib blocks."""
+        def next_chunk():
+            return asyncio.run_coroutine_threadsafe(self.chunks.get(),
+                                                    loop).result()
+
+        sent = []
+        chunk = next_chunk()
+        while chunk is not None:
+            def message():
+                nonlocal chunk
+                while chunk is not None and chunk is not _END_OF_MESSAGE:
+                    if chunk is _ABORT:
+                        raise CycleAborted()
+                    yield chunk
+                    chunk = next_chunk()
+            try:
+                sent.append(self.transport.stream(message()))
+            except CycleAborted:
+                return sent
+            if chunk is _END_OF_MESSAGE:
+                chunk = next_chunk()
+        return sent
+
+
+async def _run(cycle: _Cycle, device_jobs: Dict[str, List],
+                collect: Callable[[], Dict], max_workers: Optional[int],
+                get_profile: Optional[Callable]) -> CycleResult:
+    loop = asyncio.get_event_loop()
+    cycle.chunks = asyncio.Queue(QUEUE_SIZE)
+    frames: asyncio.Queue = asyncio.Queue()
+    frame_count = sum(len(jobs) for jobs in device_jobs.values())
+    limit = asyncio.Semaphore(max_workers) if max_workers else None
+
+    diagnostics_task = asyncio.ensure_future(_run_blocking(collect))
+    captures = [
+        asyncio.ensure_future(_capture_device(jobs, frames, limit,
+                                                get_profile))
+            for jobs in device_jobs.values()
+    ]
+    encoder = asyncio.ensure_future(
+        cycle.encode(frames, frame_count, diagnostics_task))
+    uploader = loop.run_in_executor(None, cycle.upload, loop)
+    try:
+        _, _, sent = await asyncio.gather(asyncio.gather(*captures), encoder,
+                                            uploader)
+    except BaseException:
+        for task in captures + [encoder]:
+            task.cancel()
+        if not uploader.done():
+            # The queued chunks are dropped along with the unfinished message
+            while not cycle.chunks.empty():
+                cycle.chunks.get_nowait()
+            cycle.chunks.put_nowait(_ABORT)
+            await asyncio.wait([uploader])
+        raise
+    return CycleResult(cycle.captures, diagnostics_task.result(),
+                        cycle.attached, sent)
+
+
+def run_cycle(config: Dict, transport: MailTransport,
+                camera_device: str = 'all',
+                images_directory: str = './images/',
+                html_message_path: str = './static/email-message.html',
+                render: Optional[Callable[[Dict], str]] = None,
+                collect: Callable[[], Dict] = diagnostics.collect_diagnostics,
+                pipeline=None, frame_store=None,
+                max_workers: Optional[int] = None,
+                get_profile: Optional[Callable] = None) -> CycleResult:
+    """Capture on the given devices and email the frames, with every stage
+    overlapping the others. Captures run as asyncio subprocesses, and each
+    frame is processed and encoded into the report as soon as it is taken,
+    while diagnostics are collected alongside. Encoded chunks are streamed to
+    the email server as they are made, through a bounded queue that pauses
+    encoding when the uplink falls behind.
+
+    Frames are attached in the order they are captured, and a new message is
+    started whenever the next frame wouldn't fit in the config file's
+    max_message_size.
+
+    Overlapping only hides time spent waiting, mostly on cameras and the
+    uplink. Encoding and the upload's own work still need a CPU, so on a
+    single core the cycle is only shorter than a sequential one by the
+    encoding and upload that fits into waits for captures. When every device
+    finishes at once there is almost none (see benchmarks/pipeline.py).
+
+    Args:
+        config (Dict): the loaded config file
+        transport (MailTransport): the transport to stream the report through
+        camera_device (str, optional): the device to capture on, or 'all'.
+        Defaults to 'all'.
+        images_directory (str, optional): the path to the folder to store
+        captured images in. Defaults to './images/'.
+        html_message_path (str, optional): the path to the report template.
+        Defaults to './static/email-message.html'.
+        render (Callable[[Dict], str], optional): called with the raw
+        diagnostics sample to render the report's HTML. Defaults to None,
+        which renders the template with the formatted diagnostics.
+        collect (Callable[[], Dict], optional): collects the raw diagnostics
+        sample. Defaults to diagnostics.collect_diagnostics.
+        pipeline (processing.Pipeline, optional): the pipeline to run each
+        frame through before it is attached. Defaults to None.
+        frame_store (frame_store.FrameStore, optional): if given, frames are
+        kept in the store and ones that haven't changed aren't attached.
+        Defaults to None.
+        max_workers (int, optional): the maximum number of devices to capture
+        on at the same time. Defaults to None, which captures on every device
+        at once.
+        get_profile (Callable[[str], profiles.CaptureProfile], optional):
+        called with each device to get the profile to capture with. Defaults
+        to None, which captures with photography.CAPTURE_ARGS.
+
+    Returns:
+        CycleResult: the captures, the diagnostics sample, the number of
+        frames attached and whether each message was sent
+    """
+    if render is None:
+        import templates
+
+        def render(sample: Dict) -> str:
+            return templates.render(
+                html_message_path,
+                diagnostics=diagnostics.format_diagnostics(sample))
+
+    photography.prepare_directory(images_directory)
+    device_jobs = photography.get_capture_jobs(camera_device, images_directory)
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as work_directory:
+        cycle = _Cycle(config, transport, render, pipeline, frame_store,
+                        work_directory)
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(_run(cycle, device_jobs,
+                                                    collect, max_workers,
+                                                    get_profile))
+        finally:
+            loop.close()
+    instrumentation.record('cycle', duration=time.perf_counter() - start,
+                            exit_code=0 if all(result.sent) else 1,
+                            frames=len(result.captures),
+                            attached=result.attached)
+    return result
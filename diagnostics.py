@@ -1,14 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import lru_cache
 from os import system
 import subprocess
-from typing import Dict
+from typing import Callable, Dict, Optional
 import psutil
 import humanize
 import platform
 import time
 
+# The number of seconds to wait for a slow diagnostic, such as one that runs
+# an external command, before reporting it as unavailable
+PROBE_TIMEOUT: float = 3.0
+
+# Shown in place of a diagnostic that couldn't be collected
+PLACEHOLDER: str = 'Unavailable'
+
+# Runs slow diagnostics alongside each other
+_probe_executor = ThreadPoolExecutor(max_workers=2, 
+                                        thread_name_prefix='diagnostics')
+
+# The number of seconds CPU usage is measured over the first time it is read
+# in a process, when there is no earlier reading to measure from
+CPU_SAMPLE_INTERVAL: float = 0.1
+
+# Whether CPU usage has been read in this process yet
+_cpu_sampled = False
+
 
 def get_cpu_usage_percent() -> float:
-    """Get the system's CPU utilization percentage."""
+    """Get the system's CPU utilization percentage since the previous call,
+    or over CPU_SAMPLE_INTERVAL seconds the first time this is called."""
+    global _cpu_sampled
+    if not _cpu_sampled:
+        _cpu_sampled = True
+        return psutil.cpu_percent(interval=CPU_SAMPLE_INTERVAL)
     return psutil.cpu_percent()
 
 
@@ -20,29 +45,39 @@ def get_wifi_signal_strength() -> float:
         float: the wifi signal strength percentage
     """
     output = subprocess.check_output(['iwconfig'], text=True, 
-                                        stderr=subprocess.DEVNULL)
+                                        stderr=subprocess.DEVNULL,
+                                        timeout=PROBE_TIMEOUT)
     strength_fraction = output.split('Link Quality=')[1].split()[0]
     numerator, denominator = map(float, strength_fraction.split('/', 1))
     return (numerator / denominator) * 100
 
 
-def get_memory_used_percent() -> float:
+def get_memory_used_percent(mem=None) -> float:
     """Get the percentage of memory on the system that has been used out of the
     total available memory.
 
+    Args:
+        mem (optional): a psutil.virtual_memory() snapshot to use. Defaults to
+        None, which takes a new snapshot.
+
     Returns:
         float: the system's memory used percentage
     """
-    mem = psutil.virtual_memory()
+    if mem is None:
+        mem = psutil.virtual_memory()
     used_percent = (float(mem.used) / mem.available) * 100
     return used_percent
 
 
-def get_memory_available() -> int:
-    """Return the system's available memory in bytes."""
-    return psutil.virtual_memory().available
+def get_memory_available(mem=None) -> int:
+    """Return the system's available memory in bytes, from the given
+    psutil.virtual_memory() snapshot if one is given."""
+    if mem is None:
+        mem = psutil.virtual_memory()
+    return mem.available
 
 
+@lru_cache(maxsize=None)
 def get_system() -> str:
     """Return the platform's system (Linux, Windows, etc.) if it can be found, 
     otherwise 'Unknown'
@@ -50,20 +85,23 @@ def get_system() -> str:
     Returns:
         str: the platform's system or 'Unknown'
     """
-    return platform.system() if platform.system() else 'Unknown'
+    return platform.system() or 'Unknown'
 
 
+@lru_cache(maxsize=None)
 def get_processor() -> str:
     """Return the platform's processor if it can be found, otherwise 'Unknown'
 
     Returns:
         str: the platform's processor or 'Unknown'
     """
-    return platform.processor() if platform.processor() else 'Unknown'
+    return platform.processor() or 'Unknown'
 
 
+@lru_cache(maxsize=None)
 def get_boot_time() -> str:
-    """Get the system's last boot time as a human readable string.
+    """Get the system's last boot time as a human readable string. The boot
+    time can't change while the program runs, so it is only looked up once.
 
     Returns:
         str: the system's last boot time, formatted as mm/dd/yyy HR:MM AM/PM
@@ -86,22 +124,106 @@ def get_temperature() -> float:
     return first_temp
 
 
-def get_formatted_diagnostics() -> Dict[str, any]:
-    """Get computer diagnostics as a dictionary with attributes as keys and 
-    their formatted values as values.
+def _call_safely(getter: Callable, *args) -> Optional[any]:
+    """Call the given diagnostic getter, returning None if it fails."""
+    try:
+        return getter(*args)
+    except Exception:
+        return None
+
+
+def collect_diagnostics(timeout: float = PROBE_TIMEOUT) -> Dict[str, any]:
+    """Take one sample of the computer's diagnostics as raw values. Memory
+    figures come from a single snapshot, facts that can't change are only 
+    looked up once per process, and slow diagnostics run at the same time as
+    each other, each limited to the given timeout. A diagnostic that fails or
+    times out is None.
+
+    Args:
+        timeout (float, optional): the number of seconds to wait for the slow
+        diagnostics. Defaults to PROBE_TIMEOUT.
+
+    Returns:
+        Dict[str, any]: the diagnostics, with the keys 'cpu_percent', 
+        'wifi_strength', 'temperature', 'memory_used_percent', 
+        'memory_available', 'system', 'processor' and 'boot_time'
+    """
+
+    slow_probes = {
+        'wifi_strength': _probe_executor.submit(
+            _call_safely, get_wifi_signal_strength),
+        'temperature': _probe_executor.submit(_call_safely, get_temperature)
+    }
+
+    mem = _call_safely(psutil.virtual_memory)
+    values = {
+        'cpu_percent': _call_safely(get_cpu_usage_percent),
+        'memory_used_percent': _call_safely(get_memory_used_percent, mem)
+                                if mem else None,
+        'memory_available': _call_safely(get_memory_available, mem)
+                                if mem else None,
+        'system': _call_safely(get_system),
+        'processor': _call_safely(get_processor),
+        'boot_time': _call_safely(get_boot_time)
+    }
+
+    deadline = time.monotonic() + timeout
+    for key, future in slow_probes.items():
+        try:
+            values[key] = future.result(max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            values[key] = None
+    return values
+
+
+def _format(value: Optional[any], format_spec: str = '', 
+            suffix: str = '') -> str:
+    """Format a diagnostic value for display, or return PLACEHOLDER if it 
+    couldn't be collected."""
+    if value is None:
+        return PLACEHOLDER
+    return f'{value:{format_spec}}{suffix}'
+
+
+def format_diagnostics(values: Dict[str, any]) -> Dict[str, any]:
+    """Format a diagnostics sample for display. Diagnostics that couldn't be
+    collected are shown as PLACEHOLDER.
+
+    Args:
+        values (Dict[str, any]): the sample, as returned by 
+        collect_diagnostics()
 
     Returns:
         Dict[str, any]: a dictionary of diagnostic attributes, where values have
         been formatted so as to be displayable to a user
     """
 
+    memory_available = values['memory_available']
     return {
-        'CPU Usage': f'{get_cpu_usage_percent():.1f}%',
-        'Wifi Strength': f'{get_wifi_signal_strength():.1f}%',
-        'Temperature': f'{get_temperature():.1f}\u00b0F',
-        'Memory Used': f'{get_memory_used_percent():.1f}%',
-        'Memory Available': f'{humanize.naturalsize(get_memory_available())}',
-        'System': get_system(),
-        'Processor': get_processor(),
-        'Boot Time': get_boot_time()
-    }
\ No newline at end of file
+        'CPU Usage': _format(values['cpu_percent'], '.1f', '%'),
+        'Wifi Strength': _format(values['wifi_strength'], '.1f', '%'),
+        'Temperature': _format(values['temperature'], '.1f', '\u00b0F'),
+        'Memory Used': _format(values['memory_used_percent'], '.1f', '%'),
+        'Memory Available': humanize.naturalsize(memory_available) 
+                            if memory_available is not None else PLACEHOLDER,
+        'System': _format(values['system']),
+        'Processor': _format(values['processor']),
+        'Boot Time': _format(values['boot_time'])
+    }
+
+
+def get_formatted_diagnostics(timeout: float = PROBE_TIMEOUT) -> Dict[str, any]:
+    """Get computer diagnostics as a dictionary with attributes as keys and 
+    their formatted values as values. Diagnostics that couldn't be collected 
+    are shown as PLACEHOLDER.
+
+    Args:
+        timeout (float, optional): the number of seconds to wait for the slow
+        diagnostics. Defaults to PROBE_TIMEOUT.
+
+    Returns:
+        Dict[str, any]: a dictionary of diagnostic attributes, where values have
+        been formatted so as to be displayable to a user
+    """
+
+    return format_diagnostics(collect_diagnostics(timeout))
@@ -0,0 +1,197 @@
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+# The diagnostics kept for each sample, after its timestamp
+FIELDS = ('cpu_percent', 'memory_used_percent', 'temperature', 'wifi_strength')
+
+# How each field is shown in rollup tables
+FIELD_LABELS: Dict[str, str] = {
+    'cpu_percent': 'CPU Usage (%)',
+    'memory_used_percent': 'Memory Used (%)',
+    'temperature': 'Temperature (°F)',
+    'wifi_strength': 'Wifi Strength (%)'
+}
+
+# magic, version, fields per record, capacity, next record index, record count
+_HEADER = struct.Struct('<4sHHIII4x')
+_MAGIC = b'SDRB'
+_VERSION = 1
+_RECORD_FIELDS = 1 + len(FIELDS)
+_RECORD_SIZE = _RECORD_FIELDS * 8
+
+
+class DiagnosticsHistory:
+    """A fixed-size ring buffer of diagnostics samples. Each sample is stored
+    as a row of doubles (its timestamp followed by FIELDS) in one flat array,
+    with NaN for values that couldn't be collected, so the buffer never grows
+    once created. The buffer can be backed by a memory-mapped file so that
+    history survives restarts.
+    """
+
+    def __init__(self, capacity: int = 1440, path: Optional[str] = None):
+        """Create a history, or reopen the one stored in the given file.
+
+        Args:
+            capacity (int, optional): the number of samples to keep. Once full,
+            the oldest sample is overwritten. Defaults to 1440.
+            path (str, optional): the path to the file to keep the history in.
+            If the file holds a history with a different capacity or layout,
+            it is started over. Defaults to None, which keeps the history in
+            memory only.
+        """
+        self.capacity = capacity
+        self.path = path
+        self._lock = threading.Lock()
+        size = _HEADER.size + capacity * _RECORD_SIZE
+        self._file = None
+        if path is None:
+            self._buffer = bytearray(size)
+            self._reset()
+        else:
+            exists = os.path.exists(path) and os.path.getsize(path) == size
+            self._file = open(path, 'r+b' if exists else 'w+b')
+            if not exists:
+                self._file.truncate(size)
+            self._buffer = mmap.mmap(self._file.fileno(), size)
+            magic, version, fields, stored_capacity, _, _ = \
+                _HEADER.unpack_from(self._buffer)
+            if (magic, version, fields, stored_capacity) != \
+                    (_MAGIC, _VERSION, _RECORD_FIELDS, capacity):
+                self._reset()
+        self._values = memoryview(self._buffer)[_HEADER.size:].cast('d')
+
+    def _reset(self):
+        _HEADER.pack_into(self._buffer, 0, _MAGIC, _VERSION, _RECORD_FIELDS,
+                            self.capacity, 0, 0)
+
+    def _get_position(self):
+        """Get the index the next sample is written to and the number of
+        samples stored."""
+        _, _, _, _, head, count = _HEADER.unpack_from(self._buffer)
+        return head, count
+
+    def __len__(self) -> int:
+        return self._get_position()[1]
+
+    def append(self, values: Dict[str, Optional[float]],
+                timestamp: Optional[float] = None):
+        """Add a sample, overwriting the oldest one if the history is full.
+
+        Args:
+            values (Dict[str, Optional[float]]): the sample's diagnostics, as
+            returned by diagnostics.collect_diagnostics(). Missing or None
+            values are stored as NaN.
+            timestamp (float, optional): the sample's time, in seconds since the
+            epoch. Defaults to None, which uses the current time.
+        """
+        with self._lock:
+            head, count = self._get_position()
+            offset = head * _RECORD_FIELDS
+            self._values[offset] = time.time() if timestamp is None \
+                                    else timestamp
+            for i, field in enumerate(FIELDS, start=1):
+                value = values.get(field)
+                self._values[offset + i] = math.nan if value is None \
+                                            else float(value)
+            _HEADER.pack_into(self._buffer, 0, _MAGIC, _VERSION,
+                                _RECORD_FIELDS, self.capacity,
+                                (head + 1) % self.capacity,
+                                min(count + 1, self.capacity))
+
+    def window(self, seconds: Optional[float] = None,
+                now: Optional[float] = None) -> Dict[str, List[float]]:
+        """Get the values of each field over a recent window, oldest first,
+        leaving out values that couldn't be collected.
+
+        Args:
+            seconds (float, optional): the length of the window. Defaults to
+            None, which uses every stored sample.
+            now (float, optional): the end of the window, in seconds since the
+            epoch. Defaults to None, which uses the current time.
+
+        Returns:
+            Dict[str, List[float]]: each field's values in the window
+        """
+        now = time.time() if now is None else now
+        start = -math.inf if seconds is None else now - seconds
+        series: Dict[str, List[float]] = {field: [] for field in FIELDS}
+        with self._lock:
+            head, count = self._get_position()
+            for n in range(count):
+                offset = ((head - count + n) % self.capacity) * _RECORD_FIELDS
+                if not start <= self._values[offset] <= now:
+                    continue
+                for i, field in enumerate(FIELDS, start=1):
+                    value = self._values[offset + i]
+                    if not math.isnan(value):
+                        series[field].append(value)
+        return series
+
+    def rollups(self, seconds: Optional[float] = None,
+                now: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        """Summarise each field over a recent window.
+
+        Args:
+            seconds (float, optional): the length of the window. Defaults to
+            None, which uses every stored sample.
+            now (float, optional): the end of the window, in seconds since the
+            epoch. Defaults to None, which uses the current time.
+
+        Returns:
+            Dict[str, Dict[str, float]]: the 'min', 'avg', 'max' and 'p95' of
+            each field that has values in the window, along with the number of
+            values ('count')
+        """
+        summary = {}
+        for field, values in self.window(seconds, now).items():
+            if not values:
+                continue
+            values.sort()
+            p95_index = max(0, math.ceil(0.95 * len(values)) - 1)
+            summary[field] = {
+                'min': values[0],
+                'avg': sum(values) / len(values),
+                'max': values[-1],
+                'p95': values[p95_index],
+                'count': len(values)
+            }
+        return summary
+
+    def flush(self):
+        """Write the history to its file, if it has one."""
+        if self._file is not None:
+            self._buffer.flush()
+
+    def close(self):
+        """Flush and close the history's file, if it has one."""
+        if self._file is not None:
+            self._values.release()
+            self._buffer.flush()
+            self._buffer.close()
+            self._file.close()
+            self._file = None
+
+
+def format_rollups(
+        rollups: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, str]]:
+    """Format rollups for display, keyed by each field's label.
+
+    Args:
+        rollups (Dict[str, Dict[str, float]]): rollups, as returned by
+        DiagnosticsHistory.rollups()
+
+    Returns:
+        Dict[str, Dict[str, str]]: the formatted 'min', 'avg', 'max' and 'p95'
+        of each field
+    """
+    return {
+        FIELD_LABELS[field]: {
+            stat: f'{summary[stat]:.1f}' for stat in ('min', 'avg', 'max', 'p95')
+        }
+        for field, summary in rollups.items()
+    }
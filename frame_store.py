@@ -0,0 +1,300 @@
+import hashlib
+import os
+import shutil
+import struct
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from PIL import Image
+
+# timestamp, size in bytes, difference hash, SHA-256 digest
+_RECORD = struct.Struct('<dQQ32s')
+
+# The number of differing difference hash bits above which a frame counts as
+# changed from the device's previous frame
+CHANGE_THRESHOLD: int = 6
+
+
+class FrameRecord(NamedTuple):
+    """A frame kept in the frame store."""
+    device: str
+    timestamp: float
+    size: int
+    dhash: int
+    digest: str
+
+
+def difference_hash(image_path: str) -> int:
+    """Get a 64-bit perceptual hash of an image. The image is shrunk to 9x8
+    grayscale pixels and each bit records whether a pixel is brighter than its
+    right-hand neighbour, so small amounts of sensor noise or recompression
+    don't change the hash but a change in the scene does.
+
+    Args:
+        image_path (str): the path to the image
+
+    Returns:
+        int: the image's difference hash
+    """
+    with Image.open(image_path) as image:
+        # Lets the JPEG decoder skip most of the work of a full decode
+        image.draft('L', (72, 64))
+        pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR)
+                        .getdata())
+    dhash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            dhash = (dhash << 1) | (left > right)
+    return dhash
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Get the number of bits that differ between two hashes."""
+    return bin(a ^ b).count('1')
+
+
+def _get_digest(image_path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(65536), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+class FrameStore:
+    """Keeps captured frames under their content hashes, so identical frames
+    are only stored once, with a compact binary index per device of each
+    frame's timestamp, size and hashes. Frames are evicted, oldest first,
+    once a device has too many, they are too old or the store is too large.
+    The indexes are read once and then kept in memory, so adding a frame only
+    evicts what the new frame pushes out.
+    """
+
+    def __init__(self, root: str = './frames/', max_frames: int = 500,
+                    max_age: float = 7 * 24 * 60 * 60,
+                    max_bytes: int = 500 * 1000 * 1000,
+                    change_threshold: int = CHANGE_THRESHOLD):
+        """Open the frame store in the given folder, creating it if needed.
+
+        Args:
+            root (str, optional): the path to the folder to keep frames in.
+            Defaults to './frames/'.
+            max_frames (int, optional): the most frames to keep per device.
+            Defaults to 500.
+            max_age (float, optional): the age in seconds after which frames
+            are evicted. Defaults to 7 days.
+            max_bytes (int, optional): the most bytes of frames to keep across
+            all devices. Defaults to 500 MB.
+            change_threshold (int, optional): the number of differing
+            difference hash bits above which a frame counts as changed.
+            Defaults to CHANGE_THRESHOLD.
+        """
+        self.root = root
+        self.max_frames = max_frames
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.change_threshold = change_threshold
+        self.objects_directory = os.path.join(root, 'objects')
+        self.index_directory = os.path.join(root, 'index')
+        os.makedirs(self.objects_directory, exist_ok=True)
+        os.makedirs(self.index_directory, exist_ok=True)
+        # The records of each index, the number of records that refer to each
+        # stored frame and the total size of the stored frames, read on first
+        # use (see _load()) and then kept up to date
+        self._indexes: Optional[Dict[str, List[FrameRecord]]] = None
+        self._references: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _get_index_path(self, device: str) -> str:
+        name = ''.join(c if c.isalnum() else '_' for c in device).strip('_')
+        return os.path.join(self.index_directory, f'{name}.idx')
+
+    def get_object_path(self, digest: str) -> str:
+        """Get the path a frame with the given SHA-256 hex digest is kept at."""
+        return os.path.join(self.objects_directory, digest[:2],
+                            f'{digest}.jpg')
+
+    def _read_index(self, index_path: str, device: str) -> List[FrameRecord]:
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path, 'rb') as index_file:
+            data = index_file.read()
+        return [
+            FrameRecord(device, timestamp, size, dhash, digest.hex())
+                for timestamp, size, dhash, digest in
+                    _RECORD.iter_unpack(data[:len(data) - len(data) %
+                                                _RECORD.size])
+        ]
+
+    def _write_index(self, index_path: str, records: List[FrameRecord]):
+        with open(index_path + '.tmp', 'wb') as index_file:
+            for record in records:
+                index_file.write(_RECORD.pack(record.timestamp, record.size,
+                                                record.dhash,
+                                                bytes.fromhex(record.digest)))
+        os.replace(index_path + '.tmp', index_path)
+
+    def _load(self):
+        """Read every index into memory, if they haven't been read yet."""
+        if self._indexes is not None:
+            return
+        self._indexes = {}
+        self._references = {}
+        self._total_bytes = 0
+        for name in os.listdir(self.index_directory):
+            if name.endswith('.idx'):
+                index_path = os.path.join(self.index_directory, name)
+                records = self._read_index(index_path, name[:-4])
+                self._indexes[index_path] = records
+                for record in records:
+                    self._add_reference(record)
+
+    def _add_reference(self, record: FrameRecord):
+        if self._references.get(record.digest, 0) == 0:
+            self._total_bytes += record.size
+        self._references[record.digest] = \
+            self._references.get(record.digest, 0) + 1
+
+    def _pop_oldest(self, index_path: str) -> Optional[str]:
+        """Drop the oldest record of an index from memory. Returns the digest
+        of its frame if no other record refers to it any more."""
+        record = self._indexes[index_path].pop(0)
+        self._references[record.digest] -= 1
+        if self._references[record.digest] > 0:
+            return None
+        del self._references[record.digest]
+        self._total_bytes -= record.size
+        return record.digest
+
+    def get_last_frame(self, device: str) -> Optional[FrameRecord]:
+        """Get the most recent frame kept for a device, reading only the last
+        record of its index."""
+        index_path = self._get_index_path(device)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, 'rb') as index_file:
+            size = index_file.seek(0, os.SEEK_END)
+            size -= size % _RECORD.size
+            if size == 0:
+                return None
+            index_file.seek(size - _RECORD.size)
+            timestamp, frame_size, dhash, digest = _RECORD.unpack(
+                index_file.read(_RECORD.size))
+        return FrameRecord(device, timestamp, frame_size, dhash, digest.hex())
+
+    def has_changed(self, device: str, image_path: str,
+                    dhash: Optional[int] = None) -> bool:
+        """Check whether an image differs noticeably from the most recent
+        frame kept for the device, by comparing difference hashes.
+
+        Args:
+            device (str): the device the image was captured on
+            image_path (str): the path to the image
+            dhash (int, optional): the image's difference hash, if already
+            known. Defaults to None.
+
+        Returns:
+            bool: whether the image has changed, or True if the device has no
+            frames kept
+        """
+        last = self.get_last_frame(device)
+        if last is None:
+            return True
+        if dhash is None:
+            dhash = difference_hash(image_path)
+        return hamming_distance(dhash, last.dhash) > self.change_threshold
+
+    def add(self, device: str, image_path: str,
+            timestamp: Optional[float] = None) -> Optional[FrameRecord]:
+        """Keep a captured frame, unless it hasn't changed since the device's
+        most recent frame, in which case nothing is written.
+
+        Args:
+            device (str): the device the frame was captured on
+            image_path (str): the path to the captured frame
+            timestamp (float, optional): when the frame was captured, in seconds
+            since the epoch. Defaults to None, which uses the current time.
+
+        Returns:
+            Optional[FrameRecord]: the kept frame, or None if it was unchanged
+        """
+        try:
+            dhash = difference_hash(image_path)
+        except OSError:
+            # Frames that can't be decoded are always treated as changed
+            dhash = 0
+        else:
+            if not self.has_changed(device, image_path, dhash):
+                return None
+
+        digest = _get_digest(image_path).hex()
+        index_path = self._get_index_path(device)
+        with self._lock:
+            self._load()
+            object_path = self.get_object_path(digest)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                shutil.copyfile(image_path, object_path + '.tmp')
+                os.replace(object_path + '.tmp', object_path)
+
+            record = FrameRecord(device,
+                                    time.time() if timestamp is None
+                                        else timestamp,
+                                    os.path.getsize(object_path), dhash, digest)
+            with open(index_path, 'ab') as index_file:
+                index_file.write(_RECORD.pack(record.timestamp, record.size,
+                                                record.dhash,
+                                                bytes.fromhex(digest)))
+            self._indexes.setdefault(index_path, []).append(record)
+            self._add_reference(record)
+            self._evict_oldest(index_path)
+        return record
+
+    def _evict_oldest(self, index_path: str, now: Optional[float] = None):
+        """Evict the frames pushed out by a frame just added to an index,
+        using the indexes kept in memory. Only the oldest records of each
+        index are looked at, and only the indexes that change are written.
+
+        Args:
+            index_path (str): the index the frame was added to
+            now (float, optional): the current time, in seconds since the
+            epoch. Defaults to None, which uses the current time.
+        """
+        now = time.time() if now is None else now
+        changed = set()
+        unreferenced = []
+
+        def pop_oldest(path: str):
+            changed.add(path)
+            digest = self._pop_oldest(path)
+            if digest is not None:
+                unreferenced.append(digest)
+
+        while len(self._indexes[index_path]) > self.max_frames:
+            pop_oldest(index_path)
+        for path, records in self._indexes.items():
+            while records and now - records[0].timestamp > self.max_age:
+                pop_oldest(path)
+        # Evict the oldest frames across all devices until under the limit
+        while self._total_bytes > self.max_bytes:
+            oldest = [
+                (records[0].timestamp, path)
+                    for path, records in self._indexes.items() if records
+            ]
+            if not oldest:
+                break
+            pop_oldest(min(oldest)[1])
+
+        # Indexes are written first, so a frame is never deleted while an
+        # index still refers to it
+        for path in changed:
+            self._write_index(path, self._indexes[path])
+        for digest in unreferenced:
+            try:
+                os.remove(self.get_object_path(digest))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,320 @@
+import bisect
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# Events are logged through this logger, which only has a handler once
+# configure() is called
+logger = logging.getLogger('satellite.events')
+logger.propagate = False
+logger.setLevel(logging.WARNING)
+
+# The upper bounds, in seconds, of the stage duration histogram's buckets
+DURATION_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+# Labels, as sorted (name, value) pairs, identifying one series of a metric
+Labels = Tuple[Tuple[str, str], ...]
+
+_listener = None
+
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()
+                    ) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                            .replace('\n', '\\n'))
+            for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter:
+    """A value that only goes up, such as the number of frames captured."""
+    type = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        """Add to the counter's series with the given labels."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def export(self) -> List[str]:
+        with self._lock:
+            return [
+                f'{self.name}{_format_labels(labels)} {value}'
+                    for labels, value in self._values.items()
+            ]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as the CPU temperature."""
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        """Set the gauge's series with the given labels."""
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """Counts observations, such as stage durations, in cumulative buckets."""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str,
+                    buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # Per series: a count for each bucket, the sum and the total count
+        self._series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """Add an observation to the histogram's series with the given
+        labels."""
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self._series[key]
+            counts[index] += 1
+            total[0] += value
+
+    def export(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for labels, (counts, total) in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),),
+                                        counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{self.name}_bucket'
+                                    f'{_format_labels(labels, (("le", le),))} '
+                                    f'{cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(labels)} '
+                                f'{total[0]}')
+                lines.append(f'{self.name}_count{_format_labels(labels)} '
+                                f'{cumulative}')
+        return lines
+
+
+_metrics: Dict[str, object] = {}
+_metrics_lock = threading.Lock()
+
+
+def _get_metric(metric_class, name: str, help: str, **kwargs):
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = metric_class(name, help, **kwargs)
+        return _metrics[name]
+
+
+def counter(name: str, help: str) -> Counter:
+    """Get the counter with the given name, creating it if needed."""
+    return _get_metric(Counter, name, help)
+
+
+def gauge(name: str, help: str) -> Gauge:
+    """Get the gauge with the given name, creating it if needed."""
+    return _get_metric(Gauge, name, help)
+
+
+def histogram(name: str, help: str,
+                buckets: Tuple[float, ...] = DURATION_BUCKETS) -> Histogram:
+    """Get the histogram with the given name, creating it if needed."""
+    return _get_metric(Histogram, name, help, buckets=buckets)
+
+
+_events = counter('satellite_events_total', 'Events recorded, by stage')
+_failures = counter('satellite_event_failures_total',
+                    'Events with a non-zero exit code, by stage')
+_durations = histogram('satellite_stage_duration_seconds',
+                        'How long each stage took')
+_bytes = counter('satellite_stage_bytes_total',
+                    'Bytes produced or transferred, by stage')
+
+
+def record(stage: str, duration: Optional[float] = None,
+            device: Optional[str] = None, size: Optional[int] = None,
+            exit_code: Optional[int] = None, **fields):
+    """Record an event: update the stage's metrics and, if event logging is
+    configured, queue a structured record for the logging thread. Nothing is
+    written on the calling thread, so this is safe to use on hot paths.
+
+    Args:
+        stage (str): what happened, such as 'capture' or 'smtp_send'
+        duration (float, optional): how long it took, in seconds. Defaults to
+        None.
+        device (str, optional): the device it happened on. Defaults to None.
+        size (int, optional): the number of bytes produced or transferred.
+        Defaults to None.
+        exit_code (int, optional): the exit status, where anything but 0 is a
+        failure. Defaults to None.
+        **fields: any other values to include in the logged record. Fields
+        that are None are left out.
+    """
+    _events.inc(stage=stage)
+    if exit_code:
+        _failures.inc(stage=stage)
+    if duration is not None:
+        _durations.observe(duration, stage=stage)
+    if size is not None:
+        _bytes.inc(size, stage=stage)
+
+    if logger.isEnabledFor(logging.INFO):
+        event = {'stage': stage}
+        for key, value in (('device', device), ('duration', duration),
+                            ('bytes', size), ('exit_code', exit_code)):
+            if value is not None:
+                event[key] = value
+        event.update((key, value) for key, value in fields.items()
+                        if value is not None)
+        logger.info(stage, extra={'event': event})
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats events as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = getattr(record, 'event', {'message': record.getMessage()})
+        return json.dumps({'time': round(record.created, 3), **event},
+                            default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Formats events as short human readable lines."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = dict(getattr(record, 'event', {}))
+        parts = [event.pop('stage', record.getMessage())]
+        if 'device' in event:
+            parts.append(str(event.pop('device')))
+        if 'duration' in event:
+            parts.append(f'{event.pop("duration"):.2f} seconds')
+        if 'bytes' in event:
+            parts.append(f'{event.pop("bytes")} bytes')
+        if 'exit_code' in event:
+            parts.append(f'exit status {event.pop("exit_code")}')
+        log = event.pop('log', None)
+        parts.extend(f'{key}={value}' for key, value in event.items())
+        line = ', '.join(parts)
+        return f'{line}\n{log.rstrip()}' if log else line
+
+
+def configure(log_file_path: Optional[str] = None, verbose: bool = False):
+    """Start logging events. Records are passed through a queue to a
+    background thread, which does all formatting and writing.
+
+    Args:
+        log_file_path (str, optional): the path to the file to append events
+        to, as JSON lines. Defaults to None.
+        verbose (bool, optional): whether to print events to stdout. Defaults
+        to False.
+    """
+    global _listener
+    from logging.handlers import QueueHandler, QueueListener
+
+    shutdown()
+    handlers = []
+    if log_file_path is not None:
+        file_handler = logging.FileHandler(log_file_path, delay=True)
+        file_handler.setFormatter(JSONFormatter())
+        handlers.append(file_handler)
+    if verbose:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+    if not handlers:
+        return
+
+    event_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(event_queue))
+    logger.setLevel(logging.INFO)
+    _listener = QueueListener(event_queue, *handlers)
+    _listener.start()
+
+
+def shutdown():
+    """Write any queued events and stop logging them."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(logging.WARNING)
+
+
+def export_metrics() -> str:
+    """Get every metric in the Prometheus text exposition format."""
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        samples = metric.export()
+        if samples:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(metrics_path: str):
+    """Write every metric to the given file, for example for the Prometheus
+    node exporter's textfile collector. The file is replaced in one step, so
+    readers never see a partly written file."""
+    with open(metrics_path + '.tmp', 'w') as metrics_file:
+        metrics_file.write(export_metrics())
+    os.replace(metrics_path + '.tmp', metrics_path)
+
+
+def serve_metrics(port: int, host: str = '127.0.0.1'):
+    """Serve every metric at http://<host>:<port>/metrics from a background
+    thread.
+
+    Returns:
+        http.server.ThreadingHTTPServer: the server, which can be stopped with
+        shutdown()
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = export_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                                'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True,
+                        name='metrics').start()
+    return server
@@ -0,0 +1,390 @@
+import os
+import re
+import smtplib
+import ssl
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import instrumentation
+
+# The number of bytes of a spooled message sent to the server at a time
+SEND_CHUNK_SIZE: int = 64 * 1024
+
+
+def _send_streaming(server: smtplib.SMTP, sender: str, recipient: str,
+                    chunks: Iterable[bytes]):
+    """Send a message to the email server as it is generated, one chunk at a
+    time, instead of building it in memory first as smtplib.sendmail does.
+
+    Args:
+        server (smtplib.SMTP): a logged in connection to the email server
+        sender (str): the sender's address
+        recipient (str): the recipient's address
+        chunks (Iterable[bytes]): the message, as CRLF terminated chunks
+
+    Raises:
+        smtplib.SMTPException: if the server rejects the message
+    """
+
+    server.ehlo_or_helo_if_needed()
+    code, response = server.mail(sender)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    code, response = server.rcpt(recipient)
+    if code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+    server.putcmd('data')
+    code, response = server.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, response)
+    for chunk in chunks:
+        # Lines starting with a period are escaped by doubling the period
+        server.send(re.sub(rb'(?m)^\.', b'..', chunk))
+    server.send(b'.\r\n')
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+
+def _get_smtp_code(err: Exception) -> int:
+    """Get the SMTP reply code of a failed send, or 0 if there isn't one.
+    SMTPRecipientsRefused has no code of its own, so the highest code any
+    recipient was refused with is used."""
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return max((code for code, _ in err.recipients.values()), default=0)
+    return getattr(err, 'smtp_code', 0)
+
+
+def _iter_file_chunks(file_path: str) -> Iterator[bytes]:
+    """Yield the spooled message with the given path in chunks of whole
+    lines."""
+    with open(file_path, 'rb') as message_file:
+        while True:
+            chunk = message_file.read(SEND_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk += message_file.readline()
+            yield chunk
+
+
+class MailTransport:
+    """Sends email messages over one logged in SMTP session that is reused
+    across sends, kept alive with NOOP and reopened when it fails. Every
+    message is written to a spool folder before it is sent and only removed
+    once the server accepts it, so reports that can't be sent while the link
+    is down are sent later, with exponential backoff between attempts.
+    """
+
+    def __init__(self, config: Dict, spool_directory: str = './spool/',
+                    keepalive_interval: float = 60.0,
+                    retry_delay: float = 30.0, max_retry_delay: float = 1800.0,
+                    timeout: float = 60.0):
+        """Create a transport. No connection is made until a message is sent.
+
+        Args:
+            config (Dict): the loaded config file, used for sender, recipient
+            and email server information. If config['sender']['ssl'] is false,
+            a plain SMTP connection is used, which is useful for testing
+            against a local server.
+            spool_directory (str, optional): the path to the folder to keep
+            unsent messages in. Defaults to './spool/'.
+            keepalive_interval (float, optional): the number of idle seconds
+            after which the connection is checked with NOOP before use.
+            Defaults to 60.0.
+            retry_delay (float, optional): the number of seconds to wait after
+            the first failed send before trying again. The delay doubles after
+            each further failure. Defaults to 30.0.
+            max_retry_delay (float, optional): the longest delay between
+            attempts, in seconds. Defaults to 1800.0.
+            timeout (float, optional): the socket timeout for the connection,
+            in seconds. Defaults to 60.0.
+        """
+        self.config = config
+        self.spool_directory = spool_directory
+        self.failed_directory = os.path.join(spool_directory, 'failed')
+        self.keepalive_interval = keepalive_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.timeout = timeout
+        self.sent = 0
+        self.failures = 0
+        self.last_latency: Optional[float] = None
+        self._total_latency = 0.0
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self._next_attempt = 0.0
+        self._lock = threading.RLock()
+        os.makedirs(self.failed_directory, exist_ok=True)
+
+    def _connect(self) -> smtplib.SMTP:
+        """Open a connection to the email server and log in as the sender.
+
+        Raises:
+            smtplib.SMTPException: if the sender couldn't log in
+            OSError: if the server couldn't be reached
+        """
+        sender = self.config['sender']
+        if sender.get('ssl', True):
+            context = ssl.create_default_context() # Create a secure SSL context
+            server = smtplib.SMTP_SSL(sender['server'], sender['port'],
+                                        context=context, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(sender['server'], sender['port'],
+                                    timeout=self.timeout)
+        try:
+            if sender.get('password'):
+                server.login(sender['username'], sender['password'])
+        except smtplib.SMTPException:
+            server.close()
+            raise
+        return server
+
+    def _get_server(self) -> smtplib.SMTP:
+        """Get a working connection, checking an idle connection with NOOP and
+        reconnecting if it has dropped."""
+        if self._server is not None and \
+                time.monotonic() - self._last_used > self.keepalive_interval:
+            self.keepalive()
+        if self._server is None:
+            self._server = self._connect()
+        self._last_used = time.monotonic()
+        return self._server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                self._server.close()
+            self._server = None
+
+    def keepalive(self):
+        """Send NOOP on an open connection, dropping it if the server doesn't
+        answer so that the next send reconnects."""
+        with self._lock:
+            if self._server is None:
+                return
+            try:
+                code, _ = self._server.noop()
+                if code != 250:
+                    raise smtplib.SMTPServerDisconnected()
+                self._last_used = time.monotonic()
+            except (smtplib.SMTPException, OSError):
+                self._server.close()
+                self._server = None
+
+    def enqueue(self, chunks: Iterable[bytes]) -> str:
+        """Write a message to the spool folder without sending it.
+
+        Args:
+            chunks (Iterable[bytes]): the message, as CRLF terminated chunks
+
+        Returns:
+            str: the path to the spooled message
+        """
+        name = f'{time.time():.6f}-{uuid.uuid4().hex}.eml'
+        message_path = os.path.join(self.spool_directory, name)
+        # Written under a temporary name so a partial message is never sent
+        with open(message_path + '.tmp', 'wb') as message_file:
+            for chunk in chunks:
+                message_file.write(chunk)
+        os.replace(message_path + '.tmp', message_path)
+        return message_path
+
+    def queue(self) -> List[str]:
+        """Get the paths to the spooled messages, oldest first."""
+        return sorted(
+            os.path.join(self.spool_directory, f)
+                for f in os.listdir(self.spool_directory) if f.endswith('.eml')
+        )
+
+    def drain(self, force: bool = False) -> int:
+        """Send spooled messages, oldest first, stopping at the first failure.
+        Nothing is attempted while a failed attempt's backoff hasn't passed.
+
+        Args:
+            force (bool, optional): whether to ignore the backoff. Defaults to
+            False.
+
+        Returns:
+            int: the number of messages sent
+        """
+        with self._lock:
+            if not force and time.monotonic() < self._next_attempt:
+                return 0
+            sent = 0
+            for message_path in self.queue():
+                start = time.perf_counter()
+                size = os.path.getsize(message_path)
+                try:
+                    _send_streaming(self._get_server(),
+                                    self.config['sender']['username'],
+                                    self.config['recipient']['username'],
+                                    _iter_file_chunks(message_path))
+                except (smtplib.SMTPSenderRefused,
+                        smtplib.SMTPRecipientsRefused,
+                        smtplib.SMTPDataError) as err:
+                    code = _get_smtp_code(err)
+                    if 500 <= code < 600:
+                        # Rejected outright, so retrying won't help
+                        try:
+                            self._server.rset()
+                        except (smtplib.SMTPException, OSError):
+                            self._disconnect()
+                        os.replace(message_path, os.path.join(
+                            self.failed_directory,
+                            os.path.basename(message_path)))
+                        print('The email server rejected a message:\n', err)
+                        instrumentation.record(
+                            'smtp_send', duration=time.perf_counter() - start,
+                            size=size, exit_code=code, status='rejected')
+                        continue
+                    self._fail(err, time.perf_counter() - start)
+                    break
+                except (smtplib.SMTPException, OSError) as err:
+                    self._fail(err, time.perf_counter() - start)
+                    break
+                os.remove(message_path)
+                self.last_latency = time.perf_counter() - start
+                instrumentation.record('smtp_send', duration=self.last_latency,
+                                        size=size, exit_code=0, 
+                                        status='sent')
+                self._total_latency += self.last_latency
+                self.sent += 1
+                self.failures = 0
+                self._next_attempt = 0.0
+                sent += 1
+            return sent
+
+    def _fail(self, err: Exception, duration: float):
+        """Drop the connection and back off after a failed send."""
+        instrumentation.record('smtp_send', duration=duration, 
+                                exit_code=_get_smtp_code(err) or 1, 
+                                status='retrying', 
+                                queue_depth=len(self.queue()))
+        self._disconnect()
+        self.failures += 1
+        delay = min(self.max_retry_delay,
+                    self.retry_delay * 2 ** (self.failures - 1))
+        self._next_attempt = time.monotonic() + delay
+        print(f'An error occurred while sending the email, retrying in '
+                f'{int(delay)} seconds:\n', err)
+
+    def send(self, chunks: Iterable[bytes]) -> bool:
+        """Spool a message and try to send it, along with any messages
+        spooled before it.
+
+        Args:
+            chunks (Iterable[bytes]): the message, as CRLF terminated chunks
+
+        Returns:
+            bool: whether the message was sent. If not, it stays spooled, or
+            is moved to the failed folder if the server rejected it.
+        """
+        message_path = self.enqueue(chunks)
+        self.drain(force=True)
+        # Messages the server rejected are moved to the failed folder
+        return not os.path.exists(message_path) and \
+            not os.path.exists(os.path.join(self.failed_directory,
+                                            os.path.basename(message_path)))
+
+    def stream(self, chunks: Iterable[bytes]) -> bool:
+        """Send a message to the server as it is generated, so sending can
+        start before the whole message exists. The message is written to the
+        spool at the same time and, if sending fails, the rest of it is
+        spooled to be sent later. If older messages are waiting in the spool
+        or a failed attempt's backoff hasn't passed, the message is spooled
+        and sent as send() would.
+
+        Args:
+            chunks (Iterable[bytes]): the message, as CRLF terminated chunks
+
+        Returns:
+            bool: whether the message was sent. If not, it stays spooled, or
+            is moved to the failed folder if the server rejected it.
+        """
+        with self._lock:
+            if self.queue() or time.monotonic() < self._next_attempt:
+                return self.send(chunks)
+
+            chunks = iter(chunks)
+            name = f'{time.time():.6f}-{uuid.uuid4().hex}.eml'
+            message_path = os.path.join(self.spool_directory, name)
+            start = time.perf_counter()
+            size = 0
+            error: Optional[Exception] = None
+            with open(message_path + '.tmp', 'wb') as message_file:
+                def tee() -> Iterator[bytes]:
+                    nonlocal size
+                    for chunk in chunks:
+                        message_file.write(chunk)
+                        size += len(chunk)
+                        yield chunk
+
+                try:
+                    _send_streaming(self._get_server(),
+                                    self.config['sender']['username'],
+                                    self.config['recipient']['username'],
+                                    tee())
+                except (smtplib.SMTPException, OSError) as err:
+                    error = err
+                    # The rest of the message is spooled for the next attempt
+                    for chunk in chunks:
+                        message_file.write(chunk)
+                except BaseException:
+                    # The message couldn't be generated, so it can't be sent
+                    # or spooled, and the connection is mid-message
+                    self._disconnect()
+                    message_file.close()
+                    os.remove(message_path + '.tmp')
+                    raise
+
+            if error is None:
+                os.remove(message_path + '.tmp')
+                self.last_latency = time.perf_counter() - start
+                instrumentation.record('smtp_send', duration=self.last_latency,
+                                        size=size, exit_code=0,
+                                        status='streamed')
+                self._total_latency += self.last_latency
+                self.sent += 1
+                self.failures = 0
+                return True
+
+            os.replace(message_path + '.tmp', message_path)
+            code = _get_smtp_code(error)
+            if 500 <= code < 600:
+                # Rejected outright, so it is kept aside like in drain()
+                self._disconnect()
+                os.replace(message_path, os.path.join(
+                    self.failed_directory, os.path.basename(message_path)))
+                print('The email server rejected a message:\n', error)
+                instrumentation.record(
+                    'smtp_send', duration=time.perf_counter() - start,
+                    size=size, exit_code=code, status='rejected')
+            else:
+                self._fail(error, time.perf_counter() - start)
+            return False
+
+    def stats(self) -> Dict[str, float]:
+        """Get the transport's send latency and queue depth.
+
+        Returns:
+            Dict[str, float]: the number of queued and sent messages, the
+            number of consecutive failures and the last and average send
+            latency in seconds
+        """
+        return {
+            'queue_depth': len(self.queue()),
+            'sent': self.sent,
+            'failures': self.failures,
+            'last_latency': self.last_latency,
+            'average_latency': self._total_latency / self.sent
+                                if self.sent else None
+        }
+
+    def close(self):
+        """Close the connection. Spooled messages are kept."""
+        with self._lock:
+            self._disconnect()
@@ -1,9 +1,15 @@
 import argparse
+import os
 import time
 
-import communications
-import diagnostics
-import photography
+# The modules used by each command are imported when the command runs, so
+# that, for example, listing devices doesn't load the email stack
+
+# The file that diagnostics history is kept in between runs
+HISTORY_PATH = './diagnostics-history.bin'
+
+# The period that one-shot reports summarise diagnostics history over
+HISTORY_WINDOW = 24 * 60 * 60
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -36,43 +42,733 @@ def get_parser() -> argparse.ArgumentParser:
                         action='store_true')
     parser.add_argument('-o', '--output', type=str, default=None, 
                         metavar='FILE',
-                        help='output logs to the given file')
+                        help='append events to the given file as JSON lines')
+    parser.add_argument('--metrics-file', type=str, default=None, 
+                        metavar='FILE',
+                        help='write metrics to the given file in the \
+                            Prometheus text format')
+    parser.add_argument('--metrics-port', type=int, default=None, 
+                        metavar='PORT',
+                        help='in daemon and motion mode, serve metrics at \
+                            http://127.0.0.1:PORT/metrics')
+    parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                        help='capture on at most N devices at the same time \
+                            (defaults to all devices at once)')
+    parser.add_argument('--burst', type=int, default=1, metavar='N',
+                        help='grab N frames from each device in one session \
+                            and keep only the sharpest, best exposed one \
+                            (default 1)')
+    parser.add_argument('-s', '--skip-unchanged',
+                        help="keep captured frames in the frame store and \
+                            don't email frames that haven't changed since the \
+                            device's last frame", 
+                        action='store_true')
+    parser.add_argument('--thumbnails',
+                        help='email inline thumbnails of every frame, only \
+                            attaching full size frames that changed since the \
+                            last capture or come from devices listed in the \
+                            config file', 
+                        action='store_true')
+    parser.add_argument('--report-template', default=None,
+                        choices=['full', 'compact', 'alert'],
+                        help='which report template to email (default full, \
+                            or alert in motion mode)')
+    parser.add_argument('--pipelined',
+                        help='overlap capture, image processing, diagnostics \
+                            and upload, streaming each frame to the email \
+                            server as soon as it is taken', 
+                        action='store_true')
+    parser.add_argument('--daemon',
+                        help='keep running, capturing and reporting on a \
+                            schedule until stopped', 
+                        action='store_true')
+    parser.add_argument('--capture-interval', type=float, default=300, 
+                        metavar='SECONDS',
+                        help='seconds between captures in daemon mode \
+                            (default 300)')
+    parser.add_argument('--diagnostics-interval', type=float, default=60,
+                        metavar='SECONDS',
+                        help='seconds between diagnostics samples in daemon \
+                            mode (default 60)')
+    parser.add_argument('--report-interval', type=float, default=900,
+                        metavar='SECONDS',
+                        help='seconds between emailed reports in daemon mode \
+                            (default 900)')
+    parser.add_argument('--adaptive',
+                        help='in daemon mode, step capture profiles down when \
+                            temperature, CPU, memory, uplink latency or \
+                            failed sends go over the thresholds in the config \
+                            file, and back up once they recover', 
+                        action='store_true')
+    parser.add_argument('--motion',
+                        help='keep running, capturing and reporting whenever \
+                            a device sees motion', 
+                        action='store_true')
+    parser.add_argument('--push',
+                        help="push diagnostics and frames to the collector \
+                            in the config file instead of emailing them", 
+                        action='store_true')
+    parser.add_argument('--telemetry-only',
+                        help="send only a compact binary telemetry packet of \
+                            the diagnostics and frame metadata, without frames \
+                            or HTML, for slow or metered uplinks", 
+                        action='store_true')
+    parser.add_argument('--collector',
+                        help='keep running as a collector, gathering pushes \
+                            from satellites and emailing one fleet digest \
+                            every report interval', 
+                        action='store_true')
+    parser.add_argument('--persistent',
+                        help='in daemon mode, keep a capture session open on \
+                            each device instead of running fswebcam per frame',
+                        action='store_true')
     return parser
 
 
+def get_frame_store(args: argparse.Namespace):
+    """Get the frame_store.FrameStore for the --skip-unchanged and 
+    --thumbnails options, or None if neither is given. Each run opens one 
+    store and keeps it, so the indexes are only read from disk once."""
+
+    if not (args.skip_unchanged or args.thumbnails):
+        return None
+    from frame_store import FrameStore
+    return FrameStore()
+
+
+def skip_unchanged_frames(results: list, store, keep_devices: tuple = ()):
+    """Add successfully captured frames to the frame store, removing any that
+    haven't changed since their device's last frame from the images folder so
+    they aren't emailed again.
+
+    Args:
+        results (list): the photography.CaptureResult of each capture
+        store (frame_store.FrameStore): the frame store to add frames to (see
+        get_frame_store())
+        keep_devices (tuple, optional): devices whose frames are never removed.
+        Defaults to ().
+    """
+
+    for result in results:
+        if result.returncode == 0 and store.add(result.device, 
+                                                result.image_path) is None \
+                and result.device not in keep_devices:
+            os.remove(result.image_path)
+
+
+def record_diagnostics(sample: dict):
+    """Set a gauge for each numeric value in a raw diagnostics sample (see
+    diagnostics.collect_diagnostics()), so they are exported with the other
+    metrics."""
+
+    import instrumentation
+
+    gauge = instrumentation.gauge('satellite_diagnostics', 
+                                    'The latest diagnostics sample, by field')
+    for field, value in sample.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauge.set(value, field=field)
+
+
+def get_report_frames(results: list) -> list:
+    """Get the thumbnail of each successful capture to show in a report. 
+    Frames still in the images folder (see skip_unchanged_frames()) are 
+    attached at full size too.
+
+    Args:
+        results (list): the photography.CaptureResult of each capture
+
+    Returns:
+        list: a communications.ReportFrame for each frame
+    """
+
+    import communications
+    import photography
+
+    frames = []
+    for result in results:
+        if result.returncode != 0:
+            continue
+        if os.path.exists(result.image_path):
+            frames.append(communications.ReportFrame(
+                f'{result.device} (attached)', 
+                photography.get_thumbnail_path(result.image_path),
+                result.image_path))
+        else:
+            frames.append(communications.ReportFrame(
+                result.device, 
+                photography.get_thumbnail_path(result.image_path)))
+    return frames
+
+
+def get_full_size_devices() -> tuple:
+    """Get the devices whose frames are always attached at full size in 
+    thumbnail reports, from the config file's "thumbnails" section."""
+
+    import json
+
+    with open('./static/config.json', 'r') as config_file:
+        config = json.load(config_file)
+    return tuple(config.get('thumbnails', {}).get('full_size_devices', []))
+
+
+def get_pipeline(add_banner: bool, thumbnails: bool = False):
+    """Get the post-capture pipeline for the -p/--process-images and 
+    --thumbnails options and the config file's "processing" section, or None
+    if there is nothing for it to do."""
+
+    import json
+
+    import photography
+    import processing
+
+    with open('./static/config.json', 'r') as config_file:
+        settings = json.load(config_file).get('processing', {})
+    if not (add_banner or thumbnails or settings.get('max_size') or 
+            settings.get('quality')):
+        return None
+    return processing.get_default_pipeline(
+        add_banner=add_banner,
+        thumbnails_directory=os.path.join('./images/', 
+                                            photography.THUMBNAILS_FOLDER)
+            if thumbnails else None,
+        settings=settings)
+
+
+def get_profile_controller(adaptive: bool = False):
+    """Get a profiles.ProfileController for the capture profiles in the 
+    config file's "profiles" section, or None if frames should be captured
+    as they always have been: profiles are only used with --adaptive or when
+    the section caps the profile of some device under "devices"."""
+
+    import json
+
+    import profiles
+
+    with open('./static/config.json', 'r') as config_file:
+        config = json.load(config_file)
+    if not (adaptive or config.get('profiles', {}).get('devices')):
+        return None
+    return profiles.load_controller(config)
+
+
+def get_collector_settings() -> tuple:
+    """Get the satellite's name, and the collector's URL and token from the
+    config file's "collector" section."""
+
+    import json
+
+    import collector
+
+    with open('./static/config.json', 'r') as config_file:
+        config = json.load(config_file)
+    settings = config.get('collector', {})
+    return (config['satellite'], 
+            settings.get('url', f'http://localhost:{collector.DEFAULT_PORT}'),
+            settings.get('token') or None)
+
+
+def push_to_collector(results: list, sample: dict) -> int:
+    """Push a raw diagnostics sample and the frames still in the images
+    folder (see skip_unchanged_frames()) to the collector given in the config
+    file's "collector" section.
+
+    Args:
+        results (list): the photography.CaptureResult of each capture
+        sample (dict): the raw diagnostics sample (see 
+        diagnostics.collect_diagnostics())
+
+    Returns:
+        int: the number of frames the collector kept
+    """
+
+    import collector
+
+    satellite, url, token = get_collector_settings()
+    return collector.push_report(
+        url, satellite, sample, 
+        [(r.device, r.image_path) for r in results 
+            if r.returncode == 0 and os.path.exists(r.image_path)],
+        token=token)
+
+
+def send_telemetry(args: argparse.Namespace, results: list, sample: dict,
+                    transport=None):
+    """Send a telemetry packet of a raw diagnostics sample and the captures'
+    frame metadata, pushing it to the collector with --push or emailing it
+    otherwise (see telemetry.encode()).
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+        results (list): the photography.CaptureResult of each capture
+        sample (dict): the raw diagnostics sample (see 
+        diagnostics.collect_diagnostics())
+        transport (MailTransport, optional): the transport to email the packet
+        through. Defaults to None, which opens a new connection.
+    """
+
+    import telemetry
+
+    satellite, url, token = get_collector_settings()
+    packet = telemetry.encode(satellite, sample, 
+                                telemetry.get_frame_telemetry(results))
+    if args.push:
+        import collector
+        collector.push_telemetry(url, packet, token=token)
+    else:
+        import communications
+        communications.send_telemetry(packet, verbose=args.verbose, 
+                                        transport=transport)
+
+
+def run_daemon(args: argparse.Namespace):
+    """Capture, sample diagnostics and email reports on separate schedules
+    until SIGTERM or SIGINT is received. The PiCamera, discovered devices and
+    email server connection are kept open between runs, and reports that
+    couldn't be sent are retried from the spool.
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    """
+
+    import json
+    import signal
+    import threading
+
+    import communications
+    import diagnostics
+    import instrumentation
+    import photography
+    import templates
+    from diagnostics_history import DiagnosticsHistory, format_rollups
+    from mail_transport import MailTransport
+    from scheduler import Scheduler
+
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+
+    # Captures and reports both use the images folder, so they take turns
+    images_lock = threading.Lock()
+    state = {'diagnostics': None, 'frames': None, 'sample': {}, 
+                'results': []}
+    history = DiagnosticsHistory(path=HISTORY_PATH)
+    with open('./static/config.json', 'r') as config_file:
+        transport = MailTransport(json.load(config_file))
+
+    # One pipeline is kept for the whole run, so its worker pool and fonts are
+    # only set up once
+    pipeline = get_pipeline(args.process_images, args.thumbnails)
+    full_size_devices = get_full_size_devices() if args.thumbnails else ()
+    store = get_frame_store(args)
+    controller = get_profile_controller(args.adaptive)
+
+    supervisor = None
+    if args.persistent:
+        from sessions import SessionSupervisor
+        supervisor = SessionSupervisor()
+        # Sessions are opened on the same devices and inputs, and with the
+        # same profiles, as one-shot captures would use
+        supervisor.open({device: len(jobs) for device, jobs in 
+                            photography.get_capture_jobs(args.device, 
+                                                        './images/').items()},
+                        get_profile=controller.get_profile 
+                            if controller is not None else None)
+
+    def capture_job():
+        with images_lock:
+            if supervisor is not None:
+                photography.prepare_directory('./images/')
+                results = supervisor.grab_all('./images/', 
+                                                burst_frames=args.burst)
+                if pipeline is not None:
+                    for future in [
+                        pipeline.submit(r.device, r.image_path)
+                            for r in results if r.returncode == 0
+                    ]:
+                        future.result()
+            else:
+                results = photography.capture(camera_device=args.device, 
+                                                add_processing=
+                                                    args.process_images, 
+                                                max_workers=args.jobs,
+                                                pipeline=pipeline,
+                                                get_profile=
+                                                    controller.get_profile
+                                                    if controller is not None
+                                                    else None,
+                                                burst_frames=args.burst)
+            if store is not None:
+                skip_unchanged_frames(results, store, full_size_devices)
+            if args.thumbnails:
+                state['frames'] = get_report_frames(results)
+            state['results'] = results
+
+    def diagnostics_job():
+        sample = diagnostics.collect_diagnostics()
+        history.append(sample)
+        record_diagnostics(sample)
+        state['sample'] = sample
+        state['diagnostics'] = diagnostics.format_diagnostics(sample)
+        if controller is not None and args.adaptive:
+            controller.update(sample, transport.stats())
+
+    def report_job():
+        if args.telemetry_only:
+            send_telemetry(args, state['results'], state['sample'], transport)
+            return
+        if args.push:
+            with images_lock:
+                push_to_collector(state['results'], state['sample'])
+            return
+        rollups = format_rollups(history.rollups(args.report_interval))
+        history.flush()
+        with images_lock:
+            communications.send_email('images/', html_message_path=
+                                            templates.get_template_path(
+                                                args.report_template or 
+                                                'full'),
+                                        verbose=args.verbose, 
+                                        transport=transport,
+                                        diagnostics_values=state['diagnostics'],
+                                        rollups=rollups,
+                                        rollup_window=f'last '
+                                            f'{int(args.report_interval)} '
+                                            'seconds',
+                                        frames=state['frames'])
+
+    def mail_job():
+        transport.keepalive()
+        transport.drain()
+
+    scheduler = Scheduler(stop_event, verbose=args.verbose)
+    scheduler.add_job('capture', args.capture_interval, capture_job)
+    scheduler.add_job('diagnostics', args.diagnostics_interval, 
+                        diagnostics_job)
+    if not args.no_email:
+        scheduler.add_job('report', args.report_interval, report_job,
+                            delay=args.report_interval)
+        scheduler.add_job('mail', transport.keepalive_interval, mail_job,
+                            delay=transport.keepalive_interval)
+    if args.metrics_file is not None:
+        scheduler.add_job('metrics', args.diagnostics_interval, 
+                            lambda: instrumentation.write_metrics(
+                                args.metrics_file))
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = instrumentation.serve_metrics(args.metrics_port)
+    scheduler.run()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+    if supervisor is not None:
+        supervisor.close()
+    if pipeline is not None:
+        pipeline.close()
+    transport.close()
+    history.close()
+    photography.close_camera()
+
+
+def run_motion(args: argparse.Namespace):
+    """Watch every device for motion until SIGTERM or SIGINT is received,
+    emailing each motion-triggered capture. Motion settings are read from the
+    config file's "motion" section.
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    """
+
+    import json
+    import shutil
+    import signal
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    import communications
+    import instrumentation
+    import photography
+    import templates
+    from mail_transport import MailTransport
+    from motion import MotionMonitor
+
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+
+    with open('./static/config.json', 'r') as config_file:
+        config = json.load(config_file)
+    transport = MailTransport(config)
+    # Reports are sent one at a time, away from the monitoring loop
+    reporter = ThreadPoolExecutor(max_workers=1)
+
+    def report(device: str, image_path: str):
+        capture_directory = os.path.dirname(image_path)
+        if not args.no_email:
+            communications.send_email(capture_directory, html_message_path=
+                                            templates.get_template_path(
+                                                args.report_template or 
+                                                'alert'),
+                                        verbose=args.verbose,
+                                        transport=transport,
+                                        alert=f'Motion on {device}')
+        shutil.rmtree(capture_directory, ignore_errors=True)
+        if args.metrics_file is not None:
+            instrumentation.write_metrics(args.metrics_file)
+
+    def on_capture(device: str, image_path: str):
+        reporter.submit(report, device, image_path)
+
+    motion_settings = config.get('motion', {})
+    monitor = MotionMonitor(on_capture, motion_settings,
+                            cpu_budget=motion_settings.get('cpu_budget', 0.25))
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = instrumentation.serve_metrics(args.metrics_port)
+    monitor.open()
+    try:
+        monitor.run(stop_event)
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        monitor.close()
+        reporter.shutdown(wait=True)
+        transport.close()
+        photography.close_camera()
+
+
+def run_collector(args: argparse.Namespace):
+    """Gather diagnostics and frames pushed by satellites, emailing one fleet
+    digest every report interval until SIGTERM or SIGINT is received (see
+    collector.Collector).
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    """
+
+    import json
+    import signal
+    import threading
+
+    import collector
+    import instrumentation
+    from mail_transport import MailTransport
+
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+
+    with open('./static/config.json', 'r') as config_file:
+        config = json.load(config_file)
+    transport = MailTransport(config)
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = instrumentation.serve_metrics(args.metrics_port)
+    try:
+        collector.Collector(config, transport).run(
+            stop_event, digest_interval=args.report_interval,
+            port=config.get('collector', {}).get('port', 
+                                                    collector.DEFAULT_PORT),
+            host=config.get('collector', {}).get('host',
+                                                    collector.DEFAULT_HOST))
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        transport.close()
+
+
+def run_pipelined(args: argparse.Namespace):
+    """Capture on the chosen devices and email a report once, with capture,
+    image processing, diagnostics and upload all overlapping (see
+    cycle.run_cycle()).
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    """
+
+    import json
+
+    import cycle
+    import diagnostics
+    import instrumentation
+    import photography
+    import templates
+    from diagnostics_history import DiagnosticsHistory, format_rollups
+    from mail_transport import MailTransport
+
+    with open('./static/config.json', 'r') as config_file:
+        config = json.load(config_file)
+    template_path = templates.get_template_path(args.report_template or 'full')
+    history = DiagnosticsHistory(path=HISTORY_PATH)
+
+    def collect() -> dict:
+        sample = diagnostics.collect_diagnostics()
+        history.append(sample)
+        record_diagnostics(sample)
+        return sample
+
+    def render(sample: dict) -> str:
+        return templates.render(
+            template_path, diagnostics=diagnostics.format_diagnostics(sample),
+            rollups=format_rollups(history.rollups(HISTORY_WINDOW)),
+            window='last 24 hours')
+
+    pipeline = get_pipeline(args.process_images)
+    store = get_frame_store(args)
+
+    controller = get_profile_controller()
+
+    transport = MailTransport(config)
+    try:
+        cycle.run_cycle(config, transport, camera_device=args.device,
+                        html_message_path=template_path, render=render,
+                        collect=collect, pipeline=pipeline, frame_store=store,
+                        max_workers=args.jobs,
+                        get_profile=controller.get_profile
+                            if controller is not None else None)
+    finally:
+        transport.close()
+        history.close()
+        if pipeline is not None:
+            pipeline.close()
+        photography.close_camera()
+    if args.metrics_file is not None:
+        instrumentation.write_metrics(args.metrics_file)
+
+
+def run_once(args: argparse.Namespace):
+    """Capture on the chosen devices, sample diagnostics and email a report
+    once.
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    """
+
+    import diagnostics
+    import instrumentation
+    import photography
+    from diagnostics_history import DiagnosticsHistory, format_rollups
+
+    capture_start = time.perf_counter()
+    pipeline = get_pipeline(args.process_images, args.thumbnails)
+    controller = get_profile_controller()
+    try:
+        results = photography.capture(camera_device=args.device, 
+                                        max_workers=args.jobs,
+                                        pipeline=pipeline,
+                                        get_profile=controller.get_profile
+                                            if controller is not None 
+                                            else None,
+                                        burst_frames=args.burst
+        )
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+    frames = None
+    store = get_frame_store(args)
+    if store is not None:
+        skip_unchanged_frames(results, store, get_full_size_devices() 
+                                                if args.thumbnails else ())
+    if args.thumbnails:
+        frames = get_report_frames(results)
+    instrumentation.record('capture_all', 
+                            duration=time.perf_counter() - capture_start,
+                            exit_code=sum(1 for r in results 
+                                            if r.returncode != 0),
+                            frames=len(results))
+
+    # Each run adds a sample, so reports summarise the runs before them
+    history = DiagnosticsHistory(path=HISTORY_PATH)
+    sample = diagnostics.collect_diagnostics()
+    history.append(sample)
+    record_diagnostics(sample)
+    rollups = format_rollups(history.rollups(HISTORY_WINDOW))
+    history.close()
+
+    if args.telemetry_only and (args.push or not args.no_email):
+        send_start = time.perf_counter()
+        send_telemetry(args, results, sample)
+        instrumentation.record('telemetry', 
+                                duration=time.perf_counter() - send_start)
+    elif args.push:
+        push_start = time.perf_counter()
+        kept = push_to_collector(results, sample)
+        instrumentation.record('push', 
+                                duration=time.perf_counter() - push_start,
+                                frames=kept)
+    elif not args.no_email:
+        import communications
+        import templates
+        email_start = time.perf_counter()
+        communications.send_email(
+            'images/', verbose=args.verbose,
+            html_message_path=templates.get_template_path(
+                args.report_template or 'full'),
+            diagnostics_values=diagnostics.format_diagnostics(sample),
+            rollups=rollups, rollup_window='last 24 hours', frames=frames)
+        instrumentation.record('email', 
+                                duration=time.perf_counter() - email_start)
+
+    photography.close_camera()
+    if args.metrics_file is not None:
+        instrumentation.write_metrics(args.metrics_file)
+
+
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.pipelined and args.thumbnails:
+        parser.error('--pipelined attaches frames as they are captured, so '
+                        'it can\'t be used with --thumbnails')
+    
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be >= 1')
+    if args.burst < 1:
+        parser.error('--burst must be at least 1')
+    for option, interval in (('--capture-interval', args.capture_interval),
+                                ('--diagnostics-interval',
+                                    args.diagnostics_interval),
+                                ('--report-interval', args.report_interval)):
+        if not interval > 0:
+            parser.error(f'{option} must be more than 0 seconds')
+    if args.pipelined and args.burst > 1:
+        parser.error('--pipelined attaches frames as they are captured, so '
+                        'it can\'t be used with --burst')
+    if args.pipelined and (args.push or args.telemetry_only):
+        parser.error('--pipelined streams frames to the email server, so it '
+                        'can\'t be used with --push or --telemetry-only')
+    if args.pipelined and (args.daemon or args.motion or args.collector):
+        parser.error('--pipelined runs a single capture to email cycle, so '
+                        'it can\'t be used with --daemon, --motion or '
+                        '--collector')
     
     if args.list_devices or args.diagnostics:
         if args.list_devices:
+            import photography
             print('Device: Input Count')
             for device, cameras in photography.find_devices().items():
                 print(f'{device}: {cameras}')
         elif args.diagnostics:
+            import diagnostics
             for key, value in diagnostics.get_formatted_diagnostics().items():
                 print(f'{key}: {value}')
     else:
-        capture_start = time.time()
-        photography.capture(camera_device=args.device, 
-                            add_processing=args.process_images, 
-                            verbose=args.verbose,
-                            log_file_path=args.output
-        )
-        capture_end = time.time()
-        if args.verbose:
-            print(f'Taking pictures: \t{int(capture_end-capture_start)} \
-                    seconds')
-        
-
-        if not args.no_email:
-            email_start = time.time()
-            communications.send_email('images/', verbose=args.verbose)
-            email_end = time.time()
-            if args.verbose:
-                print(f'Sending email: \t\t{int(email_end - email_start)} \
-                        seconds')
-        
-        photography.close_camera()
+        import instrumentation
+        instrumentation.configure(args.output, args.verbose)
+        try:
+            if args.collector:
+                run_collector(args)
+            elif args.daemon:
+                run_daemon(args)
+            elif args.motion:
+                run_motion(args)
+            elif args.pipelined and not args.no_email:
+                run_pipelined(args)
+            else:
+                run_once(args)
+        finally:
+            instrumentation.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,307 @@
+import io
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import numpy as np
+import psutil
+from PIL import Image
+
+import instrumentation
+import photography
+from sessions import V4L2Session
+
+# The size (width, height) of the grayscale frames compared for motion. The
+# PiCamera needs the width to be a multiple of 32 and the height of 16.
+PREVIEW_SIZE = (160, 96)
+
+# The resolution V4L2 devices stream previews at. Frames are only shrunk
+# further when decoded, so this keeps ffmpeg's encoding work small.
+PREVIEW_VIDEO_SIZE = '320x180'
+
+# Default motion settings, each of which can be set per device in the config
+# file's "motion" section
+DEFAULT_SETTINGS: Dict[str, float] = {
+    # The fraction of preview pixels that must change to trigger a capture
+    'threshold': 0.02,
+    # How much a pixel's brightness (0-255) must change to count as changed
+    'pixel_delta': 25,
+    # The minimum number of seconds between captures on a device
+    'cooldown': 60.0
+}
+
+
+class MotionDetector:
+    """Detects motion in a stream of small grayscale frames by comparing each
+    frame against a running average of the previous ones, which absorbs
+    gradual lighting changes and sensor noise.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_SETTINGS['threshold'],
+                    pixel_delta: float = DEFAULT_SETTINGS['pixel_delta'],
+                    cooldown: float = DEFAULT_SETTINGS['cooldown'],
+                    learning_rate: float = 0.1):
+        """Create a detector.
+
+        Args:
+            threshold (float, optional): the fraction of pixels that must
+            change to count as motion. Defaults to 0.02.
+            pixel_delta (float, optional): how much a pixel's brightness must
+            differ from the background to count as changed. Defaults to 25.
+            cooldown (float, optional): the minimum number of seconds between
+            detections. Defaults to 60.0.
+            learning_rate (float, optional): how quickly the background adapts
+            to new frames, from 0 to 1. Defaults to 0.1.
+        """
+        self.threshold = threshold
+        self.pixel_delta = pixel_delta
+        self.cooldown = cooldown
+        self.learning_rate = learning_rate
+        self.last_change = 0.0
+        self._background: Optional[np.ndarray] = None
+        self._last_detection = -float('inf')
+
+    def update(self, frame: np.ndarray, now: Optional[float] = None) -> bool:
+        """Compare a frame against the background and add it to the
+        background.
+
+        Args:
+            frame (np.ndarray): a 2D array of grayscale pixel values
+            now (float, optional): the frame's time, in seconds. Defaults to
+            None, which uses time.monotonic().
+
+        Returns:
+            bool: whether the frame shows motion and the cooldown has passed
+        """
+        now = time.monotonic() if now is None else now
+        frame = frame.astype(np.float32)
+        if self._background is None or self._background.shape != frame.shape:
+            self._background = frame
+            return False
+        difference = frame - self._background
+        self.last_change = np.count_nonzero(
+            np.abs(difference) > self.pixel_delta) / frame.size
+        self._background += self.learning_rate * difference
+        if self.last_change >= self.threshold and \
+                now - self._last_detection >= self.cooldown:
+            self._last_detection = now
+            return True
+        return False
+
+
+def _decode_preview(jpeg: bytes) -> np.ndarray:
+    """Decode a JPEG frame straight to a small grayscale array. The JPEG
+    decoder is asked for a reduced size, so only a fraction of the full
+    decode work is done."""
+    with Image.open(io.BytesIO(jpeg)) as image:
+        image.draft('L', PREVIEW_SIZE)
+        return np.asarray(image.convert('L').resize(PREVIEW_SIZE,
+                                                    Image.NEAREST))
+
+
+def _get_cpu_time() -> float:
+    """Get the CPU time used by this process and its child processes, such as
+    the ffmpeg processes streaming previews, in seconds."""
+    process = psutil.Process()
+    times = process.cpu_times()
+    used = times.user + times.system + times.children_user + \
+            times.children_system
+    # Children that are still running aren't counted in children_user or
+    # children_system until they exit
+    for child in process.children(recursive=True):
+        try:
+            child_times = child.cpu_times()
+        except psutil.Error:
+            continue
+        used += child_times.user + child_times.system
+    return used
+
+
+class _V4L2Source:
+    """Previews from a V4L2 device through a low resolution session, pausing
+    it for a full resolution capture with fswebcam."""
+
+    def __init__(self, device: str, framerate: int):
+        self.device = device
+        self.session = V4L2Session(device, video_size=PREVIEW_VIDEO_SIZE,
+                                    framerate=framerate)
+        self._seen = 0
+
+    def preview(self) -> Optional[np.ndarray]:
+        # Only frames that haven't been checked yet are decoded
+        frame = self.session.grab(timeout=1.0, newer_than=self._seen)
+        if frame is None:
+            return None
+        self._seen = self.session.frame_count
+        return _decode_preview(frame)
+
+    def capture(self, image_path: str):
+        # The preview stream holds the device open
+        self.session.close()
+        try:
+            result = photography.take_fswebcam_picture(
+                self.device, os.path.splitext(image_path)[0])
+        finally:
+            self._seen = 0
+            self.session.start()
+        if result.returncode != 0:
+            raise OSError(f'fswebcam failed with exit status '
+                            f'{result.returncode}: {result.log.strip()}')
+
+
+class _PiCameraSource:
+    """Previews from the PiCamera's video port at a low resolution and captures
+    at full resolution from its still port."""
+
+    def __init__(self):
+        self.session = None
+
+    def preview(self) -> Optional[np.ndarray]:
+        camera = photography.get_pi_camera()
+        if camera is None:
+            return None
+        stream = io.BytesIO()
+        camera.capture(stream, format='yuv', resize=PREVIEW_SIZE,
+                        use_video_port=True)
+        # The Y (brightness) plane comes first and is already grayscale
+        width, height = PREVIEW_SIZE
+        return np.frombuffer(stream.getvalue(), dtype=np.uint8,
+                                count=width * height).reshape(height, width)
+
+    def capture(self, image_path: str):
+        photography.get_pi_camera().capture(image_path)
+
+
+class MotionMonitor:
+    """Watches every device for motion, capturing a full resolution frame from
+    a device when its preview frames change by more than the device's
+    threshold. The monitor sleeps as needed to keep its own CPU use within a
+    budget.
+    """
+
+    def __init__(self, on_capture: Callable[[str, str], None],
+                    settings: Optional[Dict] = None,
+                    images_directory: str = './images/motion/',
+                    cpu_budget: float = 0.25, interval: float = 0.5,
+                    framerate: int = 2):
+        """Create a monitor.
+
+        Args:
+            on_capture (Callable[[str, str], None]): called with the device
+            name and image path after each motion-triggered capture. Each
+            capture is saved in a folder of its own.
+            settings (Dict, optional): the config file's "motion" section,
+            with defaults for 'threshold', 'pixel_delta' and 'cooldown' and a
+            'devices' mapping of device names to overrides. Defaults to None,
+            which uses DEFAULT_SETTINGS for every device.
+            images_directory (str, optional): the path to the folder to save
+            captures in. Defaults to './images/motion/'.
+            cpu_budget (float, optional): the largest fraction of one CPU core
+            the monitor may use. Defaults to 0.25.
+            interval (float, optional): the number of seconds between preview
+            checks when within the CPU budget. Defaults to 0.5.
+            framerate (int, optional): the number of frames each V4L2 device
+            streams per second. Defaults to 2.
+        """
+        self.on_capture = on_capture
+        self.settings = settings if settings else {}
+        self.images_directory = images_directory
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.framerate = framerate
+        self.sources: Dict[str, object] = {}
+        self.detectors: Dict[str, MotionDetector] = {}
+
+    def _get_device_settings(self, device: str) -> Dict[str, float]:
+        device_settings = dict(DEFAULT_SETTINGS)
+        device_settings.update({
+            key: value for key, value in self.settings.items()
+                if key in DEFAULT_SETTINGS
+        })
+        device_settings.update({
+            key: value for key, value in 
+                self.settings.get('devices', {}).get(device, {}).items()
+                if key in DEFAULT_SETTINGS
+        })
+        return device_settings
+
+    def open(self, devices: Optional[Dict[str, int]] = None):
+        """Start previewing on each of the given devices.
+
+        Args:
+            devices (Dict[str, int], optional): device names and their number
+            of inputs, as returned by photography.find_devices(). Defaults to
+            None, which uses every detected device.
+        """
+        if devices is None:
+            devices = photography.find_devices()
+        for device in devices:
+            if device == 'RPi Camera Module':
+                self.sources[device] = _PiCameraSource()
+            else:
+                self.sources[device] = _V4L2Source(device, self.framerate)
+                self.sources[device].session.start()
+            self.detectors[device] = MotionDetector(
+                **self._get_device_settings(device))
+        os.makedirs(self.images_directory, exist_ok=True)
+
+    def check(self):
+        """Check every device once, capturing on any that show motion. A
+        device that fails is skipped until the next check."""
+        for device, source in self.sources.items():
+            try:
+                self._check_device(device, source)
+            except Exception as err:
+                print(f'Error: could not check {device} for motion:\n', err)
+                instrumentation.record('motion_error', device=device,
+                                        error=str(err))
+
+    def _check_device(self, device: str, source):
+        if source.session is not None and not source.session.is_alive():
+            source.session.close()
+            source.session.start()
+        frame = source.preview()
+        if frame is None or not self.detectors[device].update(frame):
+            return
+        name = ''.join(c if c.isalnum() else '_' for c in device)
+        capture_directory = os.path.join(
+            self.images_directory,
+            f'{name.strip("_")}-{time.strftime("%Y%m%d-%H%M%S")}')
+        os.makedirs(capture_directory, exist_ok=True)
+        image_path = os.path.join(capture_directory, 'image0.jpg')
+        start = time.perf_counter()
+        source.capture(image_path)
+        instrumentation.record('motion_capture', 
+                                duration=time.perf_counter() - start,
+                                device=device, 
+                                size=os.path.getsize(image_path),
+                                change=round(
+                                    self.detectors[device].last_change, 4),
+                                path=image_path)
+        self.on_capture(device, image_path)
+
+    def run(self, stop_event: threading.Event):
+        """Check devices until the stop event is set.
+
+        Args:
+            stop_event (threading.Event): set to stop monitoring
+        """
+        while not stop_event.is_set():
+            start_wall = time.monotonic()
+            start_cpu = _get_cpu_time()
+            self.check()
+            elapsed = time.monotonic() - start_wall
+            used = _get_cpu_time() - start_cpu
+            # Wait long enough that CPU time over the whole cycle stays
+            # within the budget
+            stop_event.wait(max(self.interval - elapsed,
+                                used / self.cpu_budget - elapsed))
+
+    def close(self):
+        """Stop previewing on every device."""
+        for source in self.sources.values():
+            if source.session is not None:
+                source.session.close()
+        self.sources = {}
+        self.detectors = {}
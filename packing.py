@@ -0,0 +1,140 @@
+import io
+import math
+import os
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+# The message size used when the config file doesn't give one, in bytes
+DEFAULT_MAX_MESSAGE_SIZE: int = 25 * 1000 * 1000
+
+# The smallest share of a message that an image is shrunk to before the
+# remaining images are split into another message instead, in bytes
+MIN_IMAGE_SIZE: int = 60 * 1000
+
+# (scale, JPEG quality) pairs to try when shrinking an image, in order of
+# preference. The first one that fits the image's share of the message is used.
+TRANSCODE_LADDER: List[Tuple[float, int]] = [
+    (1.0, 85), (1.0, 70), (1.0, 55),
+    (0.75, 70), (0.75, 55),
+    (0.5, 70), (0.5, 55),
+    (0.35, 50)
+]
+
+# Bytes added to each attachment by its MIME part headers
+_PART_OVERHEAD = 300
+
+
+def encoded_size(size: int) -> int:
+    """Get the number of bytes a file of the given size takes up in an email
+    message once base64 encoded into 76 character lines.
+
+    Args:
+        size (int): the file's size in bytes
+
+    Returns:
+        int: the encoded size in bytes, including the attachment's MIME headers
+    """
+    return math.ceil(size / 57) * 78 + _PART_OVERHEAD
+
+
+def _is_jpeg(file_path: str) -> bool:
+    return file_path.lower().endswith(('.jpg', '.jpeg'))
+
+
+def transcode(image_path: str, max_size: int,
+              output_path: str) -> Optional[str]:
+    """Re-encode the JPEG with the given path, at a lower quality and
+    resolution if needed, so that its encoded size is at most max_size. The
+    highest quality and resolution that fits is chosen; if none fit, the
+    smallest version is used.
+
+    Args:
+        image_path (str): the path to the JPEG to shrink
+        max_size (int): the largest encoded size to aim for, in bytes
+        output_path (str): the path to write the shrunk image to
+
+    Returns:
+        Optional[str]: output_path, or None if the image couldn't be decoded
+    """
+    try:
+        image = Image.open(image_path)
+        image.load()
+    except (OSError, ValueError):
+        return None
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    data = b''
+    for scale, quality in TRANSCODE_LADDER:
+        scaled = image
+        if scale < 1.0:
+            scaled = image.resize((max(1, int(image.width * scale)),
+                                    max(1, int(image.height * scale))),
+                                    Image.BILINEAR)
+        buffer = io.BytesIO()
+        scaled.save(buffer, 'JPEG', quality=quality, optimize=True)
+        data = buffer.getvalue()
+        if encoded_size(len(data)) <= max_size:
+            break
+
+    with open(output_path, 'wb') as output_file:
+        output_file.write(data)
+    return output_path
+
+
+def pack_attachments(attachment_paths: List[str], max_message_size: int,
+                     work_directory: str,
+                     message_overhead: int = 0) -> List[List[str]]:
+    """Split the given attachments into groups that each fit in one email
+    message of at most max_message_size bytes. JPEGs that are larger than
+    their fair share of a message are shrunk first, choosing quality and
+    resolution per image, and whatever still doesn't fit in a single message
+    is spread across as few messages as possible.
+
+    Args:
+        attachment_paths (List[str]): the paths to the attachment files
+        max_message_size (int): the largest message the email server accepts,
+        in bytes
+        work_directory (str): the path to a folder to write shrunk images to.
+        The caller is responsible for removing it once the messages are sent.
+        message_overhead (int, optional): the encoded size of everything in a
+        message besides the attachments, such as headers and HTML content.
+        Defaults to 0.
+
+    Returns:
+        List[List[str]]: the attachment paths to send in each message. Shrunk
+        images are replaced by their path in the work directory.
+    """
+    budget = max_message_size - message_overhead
+    sizes = {p: encoded_size(os.path.getsize(p)) for p in attachment_paths}
+    if sum(sizes.values()) <= budget:
+        return [list(attachment_paths)] if attachment_paths else []
+
+    share = max(budget // len(attachment_paths), MIN_IMAGE_SIZE)
+    packed = []
+    for i, attachment_path in enumerate(attachment_paths):
+        if sizes[attachment_path] > share and _is_jpeg(attachment_path):
+            output_path = os.path.join(work_directory,
+                                       os.path.basename(attachment_path))
+            if os.path.exists(output_path):
+                output_path = os.path.join(work_directory, f'{i}-' +
+                                           os.path.basename(attachment_path))
+            if transcode(attachment_path, share, output_path) is not None:
+                attachment_path = output_path
+        packed.append((encoded_size(os.path.getsize(attachment_path)),
+                        i, attachment_path))
+
+    # First fit decreasing, then restore the original order in each message
+    messages: List[List[Tuple[int, str]]] = []
+    remaining: List[int] = []
+    for size, index, attachment_path in sorted(packed, reverse=True):
+        for m, space in enumerate(remaining):
+            if size <= space:
+                messages[m].append((index, attachment_path))
+                remaining[m] -= size
+                break
+        else:
+            messages.append([(index, attachment_path)])
+            remaining.append(budget - size)
+    return [[p for _, p in sorted(message)] for message in messages]
@@ -1,37 +1,142 @@
+import glob
 import os
 import subprocess
-from datetime import datetime
-from typing import Dict, List
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from picamera import PiCamera
+import instrumentation
 
-# fswebcam arguments for image capture and processing
+# fswebcam arguments for image capture when no capture profile is given (see
+# profiles.py). Image processing is done after capture, see processing.py.
 CAPTURE_ARGS: List[str] = [
     '--resolution', '1280x720',
     '--delay', '1'
 ]
-PROCESSING_ARGS: List[str] = [
-    '--banner-colour', '#FF0000', 
-    '--font', 'sans:20',
-    '--no-shadow',
-    '--no-subtitle', 
-    '--no-info'
-]
 
-# Attempt to connect to the Raspberry Pi Camera Module
-try:
-    pi_camera = PiCamera()
-except:
-    pi_camera = None
+# The folder, inside the images folder, that thumbnails are written to
+THUMBNAILS_FOLDER: str = 'thumbnails'
+
+# Video device discovery settings
+DEVICE_GLOB: str = '/dev/video*'
+DISCOVERY_TTL: float = 300.0
+PROBE_TIMEOUT: float = 5.0
+
+class CaptureResult(NamedTuple):
+    """The outcome of a single capture on a single device."""
+    device: str
+    image_path: str
+    returncode: int
+    duration: float
+    log: str
+
+# The Raspberry Pi Camera Module, connected to on first use (see
+# get_pi_camera()) so that commands which don't capture don't lock it
+_pi_camera = None
+_pi_camera_initialized = False
+_pi_camera_lock = threading.Lock()
+
+# The most recent discovery result, keyed by the device nodes it was found on
+_device_cache = {'fingerprint': None, 'time': 0.0, 'inputs': {}}
+
+def get_pi_camera():
+    """Get the Raspberry Pi Camera Module, connecting to it the first time this
+    is called. The picamera package is only imported then too.
+
+    Returns:
+        picamera.PiCamera: the connected PiCamera, or None if it isn't 
+        connected
+    """
+
+    global _pi_camera, _pi_camera_initialized
+    with _pi_camera_lock:
+        if not _pi_camera_initialized:
+            # Attempt to connect to the Raspberry Pi Camera Module
+            try:
+                from picamera import PiCamera
+                _pi_camera = PiCamera()
+            except:
+                _pi_camera = None
+            _pi_camera_initialized = True
+        return _pi_camera
+
+def is_pi_camera_connected() -> bool:
+    """Check whether the Raspberry Pi Camera Module is connected. If this
+    process hasn't connected to it yet, the firmware is asked with 'vcgencmd
+    get_camera' instead, so the camera isn't locked just to check. If that
+    can't be done, the camera is connected to.
+
+    Returns:
+        bool: whether the PiCamera is connected
+    """
+
+    if _pi_camera_initialized:
+        return _pi_camera is not None
+    try:
+        output = subprocess.check_output(['vcgencmd', 'get_camera'], text=True,
+                                            stderr=subprocess.DEVNULL,
+                                            timeout=PROBE_TIMEOUT)
+        return 'detected=1' in output
+    except (OSError, subprocess.SubprocessError):
+        return get_pi_camera() is not None
+
+def _get_video_nodes(search_range: int) -> List[str]:
+    """Get the /dev/video{number} device nodes that exist on the system, in
+    numerical order, ignoring any whose number is outside the search range.
+
+    Args:
+        search_range (int): the number of /dev/video{number} devices to check
+
+    Returns:
+        List[str]: the paths of the existing device nodes
+    """
+
+    nodes = []
+    for node in glob.glob(DEVICE_GLOB):
+        number = node[len(DEVICE_GLOB) - 1:]
+        if number.isdigit() and int(number) < search_range:
+            nodes.append((int(number), node))
+    return [node for _, node in sorted(nodes)]
+
+def _get_nodes_fingerprint(nodes: List[str]) -> Tuple[Tuple[str, int], ...]:
+    """Identify the current state of the given device nodes by their paths and
+    modification times, so that a change in connected hardware can be noticed
+    without probing it.
 
-def find_devices(search_range: int = 10) -> Dict[str, int]:
+    Args:
+        nodes (List[str]): the paths of the device nodes
+
+    Returns:
+        Tuple[Tuple[str, int], ...]: each node's path and modification time
+    """
+
+    fingerprint = []
+    for node in nodes:
+        try:
+            fingerprint.append((node, os.stat(node).st_mtime_ns))
+        except OSError:
+            pass
+    return tuple(fingerprint)
+
+def find_devices(search_range: int = 10, max_age: float = DISCOVERY_TTL,
+                    probe_timeout: float = PROBE_TIMEOUT) -> Dict[str, int]:
     """Return a dictionary of device names as keys and the corresponding 
     number of inputs (cameras) as values. Only devices that have 1 or more 
     inputs are stored.
 
+    Only the /dev/video{number} nodes that exist are probed, all at the same
+    time. The result is cached and reused until it is older than max_age or the
+    set of device nodes (or their modification times) changes.
+
     Args:
         search_range (int, optional): the number of /dev/video{number} devices
         to check. Defaults to 10.
+        max_age (float, optional): how many seconds a cached result stays
+        valid for. Defaults to DISCOVERY_TTL. Pass 0 to always re-probe.
+        probe_timeout (float, optional): how many seconds to wait for a single
+        device to respond before treating it as having no inputs. Defaults to
+        PROBE_TIMEOUT.
 
     Returns:
         dict[str, int]: a dictionary where each key is a device name and each 
@@ -39,19 +144,30 @@ def find_devices(search_range: int = 10) -> Dict[str, int]:
         device
     """
 
-    inputs = {}
-    for i in range(search_range):
-        device_name = f'/dev/video{i}'
-        device_cameras = get_device_inputs(device_name)
-        if device_cameras > 0:
-            inputs[device_name] = device_cameras 
+    nodes = _get_video_nodes(search_range)
+    fingerprint = _get_nodes_fingerprint(nodes)
+    cache_age = time.monotonic() - _device_cache['time']
+    if fingerprint == _device_cache['fingerprint'] and cache_age < max_age:
+        inputs = dict(_device_cache['inputs'])
+    else:
+        inputs = {}
+        if nodes:
+            with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+                counts = executor.map(
+                    lambda node: get_device_inputs(node, probe_timeout), nodes)
+                for device_name, device_cameras in zip(nodes, counts):
+                    if device_cameras > 0:
+                        inputs[device_name] = device_cameras 
+        _device_cache.update(fingerprint=fingerprint, time=time.monotonic(),
+                                inputs=dict(inputs))
     
-    if pi_camera is not None:
+    if is_pi_camera_connected():
         inputs['RPi Camera Module'] = 1
 
     return inputs
 
-def get_device_inputs(device_name: str) -> int:
+def get_device_inputs(device_name: str, 
+                        timeout: Optional[float] = None) -> int:
     """Get the number of inputs (cameras) associated with the given video
     device. To find the number of inputs, this function calls fswebcam with the
     --list-inputs flag on the /dev/video{mount_num} device and parses the output
@@ -63,20 +179,27 @@ def get_device_inputs(device_name: str) -> int:
 
     Args:
         device_name (str): the name of the device to find associated inputs for
+        timeout (float, optional): how many seconds to wait for fswebcam to
+        respond. If it doesn't respond in time, the device is treated as having
+        no inputs. Defaults to None, which waits indefinitely.
 
     Returns:
         int: the number of valid inputs connected to the device
     """
 
     # Run a command to check the device's inputs and capture the output
-    cmd_output = subprocess.check_output(
-        [
-            'script', '-q', '-c', 
-            f'(fswebcam --list-inputs -d {device_name})', 
-            '/dev/null'
-        ], 
-        text=True
-    )
+    try:
+        cmd_output = subprocess.check_output(
+            [
+                'script', '-q', '-c', 
+                f'(fswebcam --list-inputs -d {device_name})', 
+                '/dev/null'
+            ], 
+            text=True,
+            timeout=timeout
+        )
+    except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
+        return 0
     error_messages = [
         'Unable to query input 0.', 
         'No such file or directory', 
@@ -93,69 +216,164 @@ def get_device_inputs(device_name: str) -> int:
             inputs_found[last_colon_index - 1: last_colon_index])
         return largest_device_index + 1
 
-def _get_fswebcam_capture_args(device: str, 
-                                add_processing: bool, 
-                                image_file_path:str) -> List[str]:
+def get_fswebcam_capture_args(device: str, 
+                              image_file_path:str,
+                              profile=None) -> List[str]:
     """Generates an array of arguments to add to the 'fswebcam' command to take 
     a picture on the given device and store it in the file given by 
-    image_file_path. The capture_args array is used to supply arguments 
-    associated with image capture, and the processing_args array is used,
-    if add_processing is True, to process the image after it is taken.  
+    image_file_path. The capture profile, or CAPTURE_ARGS if there isn't one, 
+    supplies the arguments associated with image capture.
 
     Args:
         device (str): the name of the device to use to take a picture, for
         example /dev/video0
-        add_processing (bool): whether to add image processing effects to photos 
-        after capture
         image_file_path (str): the path and filename of the file to store the
         captured image in
+        profile (profiles.CaptureProfile, optional): the resolution, quality,
+        delay and frame count to capture with. Defaults to None.
 
     Returns:
         List[str]: a list of arguments to use in conjuction with the fswebcam
         command
     """
     args = ['fswebcam', '-q', '-d', device]
-    args.extend(CAPTURE_ARGS)
-    if add_processing:
-        args.extend(PROCESSING_ARGS)
-        timestamp_text = datetime.now().strftime('%m/%d/%Y %I:%M %p')
-        args.extend([
-            '--title', f'DEVICE: {device}',
-            '--timestamp', timestamp_text
-        ]) 
+    if profile is None:
+        args.extend(CAPTURE_ARGS)
     else:
-        args.extend(['--no-banner'])
+        width, height = profile.resolution
+        args.extend(['--resolution', f'{width}x{height}',
+                        '--delay', f'{profile.delay:g}',
+                        '--frames', str(profile.frames),
+                        '--jpeg', str(profile.quality)])
+    args.extend(['--no-banner'])
     args.extend([image_file_path + '.jpg'])
     return args
 
-def _take_fswebcam_picture(device: str, add_processing: bool, 
-                            log_file_path: str, image_file_path: str):
+def take_fswebcam_picture(device: str, image_file_path: str,
+                          profile=None) -> CaptureResult:
     """Uses the 'fswebcam' command to take a picture using the given device, 
-    storing the image in the given image file path and appending the terminal
-    output to the log file given by the log file path.
+    storing the image in the given image file path. The terminal output of the
+    command is kept in memory so that concurrent captures don't interleave
+    their logs.
 
     Args:
         device (str): the device to use to take a picture
-        add_processing (bool): whether to add image processing effects to photos 
-        after capture
-        log_file_path (str): the path to the file to append logs to 
         image_file_path (str): the path and filename of the file to store the
         captured image in
+        profile (profiles.CaptureProfile, optional): the profile to capture 
+        with. Defaults to None, which uses CAPTURE_ARGS.
+
+    Returns:
+        CaptureResult: the device's capture timing, exit status and output
+    """
+
+    start = time.perf_counter()
+    completed = subprocess.run(get_fswebcam_capture_args(device, 
+                                                         image_file_path,
+                                                         profile), 
+                               stdout=subprocess.PIPE, 
+                               stderr=subprocess.STDOUT,
+                               text=True)
+    return CaptureResult(device, image_file_path + '.jpg', 
+                            completed.returncode, 
+                            time.perf_counter() - start, 
+                            completed.stdout)
+
+def set_pi_camera_profile(camera, profile):
+    """Set the PiCamera's resolution from a capture profile, letting it warm
+    up for the profile's delay if the resolution changed."""
+    if tuple(getattr(camera, 'resolution', ())) != profile.resolution:
+        camera.resolution = profile.resolution
+        time.sleep(profile.delay)
+
+def take_pi_camera_picture(image_file_path: str,
+                           profile=None) -> CaptureResult:
+    """Take a picture using the Raspberry Pi Camera Module, storing the image
+    in the given image file path.
+
+    Args:
+        image_file_path (str): the path and filename of the file to store the
+        captured image in
+        profile (profiles.CaptureProfile, optional): the resolution and 
+        quality to capture with. The camera warms up for the profile's delay
+        whenever its resolution changes. Defaults to None, which uses the 
+        camera's current settings.
+
+    Returns:
+        CaptureResult: the PiCamera's capture timing, exit status and output
     """
 
-    log_file = open(log_file_path, 'a')
-    log_file.write(f'Attempting to take a picture on the {device} device...')
-    log_file.flush()
-    subprocess.run(_get_fswebcam_capture_args(device, add_processing, 
-                                                image_file_path), 
-                                                stdout=log_file, 
-                                                stderr=log_file)
+    start = time.perf_counter()
+    try:
+        camera = get_pi_camera()
+        if profile is None:
+            camera.capture(image_file_path + '.jpg')
+        else:
+            set_pi_camera_profile(camera, profile)
+            camera.capture(image_file_path + '.jpg', quality=profile.quality)
+        returncode, log = 0, ''
+    except Exception as err:
+        returncode, log = 1, f'{err}\n'
+    return CaptureResult('RPi Camera Module', image_file_path + '.jpg', 
+                            returncode, time.perf_counter() - start, log)
 
-    log_file.write('DONE\n')
-    log_file.flush()
-    log_file.close()
+def _capture_sequentially(
+        jobs: List[Tuple[str, str]], 
+        on_capture: Optional[Callable[[CaptureResult], None]] = None,
+        get_profile: Optional[Callable] = None,
+        burst_frames: int = 1
+    ) -> List[CaptureResult]:
+    """Run the given (device, image file path) capture jobs one after another.
+    Jobs that share a device must not run at the same time, since a V4L2 device
+    can only be opened by one fswebcam process at once.
 
-def _prepare_directory(images_directory_path: str): 
+    Args:
+        jobs (List[Tuple[str, str]]): the device and image file path for each
+        capture, in order
+        on_capture (Callable[[CaptureResult], None], optional): called with
+        each successful capture as soon as it finishes. Defaults to None.
+        get_profile (Callable[[str], profiles.CaptureProfile], optional): 
+        called with each job's device to get the profile to capture with.
+        Defaults to None.
+        burst_frames (int, optional): the number of frames to grab in each
+        job, keeping only the best (see burst.capture_burst()). Defaults to 1.
+
+    Returns:
+        List[CaptureResult]: the result of each capture, in job order
+    """
+
+    results = []
+    channels: Dict[str, int] = {}
+    for device, image_file_path in jobs:
+        profile = get_profile(device) if get_profile is not None else None
+        # A device's jobs are for each of its inputs in turn
+        channel = channels[device] = channels.get(device, -1) + 1
+        if burst_frames > 1:
+            import burst
+            result = burst.capture_burst(device, image_file_path, 
+                                            burst_frames, channel, profile)
+        elif device == 'RPi Camera Module':
+            result = take_pi_camera_picture(image_file_path, profile)
+        else:
+            result = take_fswebcam_picture(device, image_file_path, profile)
+        record_capture(result)
+        if on_capture is not None and result.returncode == 0:
+            on_capture(result)
+        results.append(result)
+    return results
+
+def record_capture(result: CaptureResult):
+    """Record a capture's timing, exit status, image size and, if it failed,
+    output as an instrumentation event."""
+    size = None
+    if result.returncode == 0 and os.path.exists(result.image_path):
+        size = os.path.getsize(result.image_path)
+    instrumentation.record('capture', duration=result.duration, 
+                            device=result.device, size=size, 
+                            exit_code=result.returncode,
+                            log=result.log if result.returncode else None)
+
+def prepare_directory(images_directory_path: str): 
     """Sets up the directory with given path so that it can hold incoming
     images. If the folder exists, any file with a image extension (see
     img_extensions array) or 'image' prefix is removed. If the folder doesn't
@@ -180,41 +398,44 @@ def _prepare_directory(images_directory_path: str):
         os.makedirs(images_directory_path)
     else:
         print('Error: images directory is actually a file.') # TODO raise exception
+
+    # Thumbnails from the previous capture are removed too
+    thumbnails_directory = os.path.join(images_directory_path, 
+                                        THUMBNAILS_FOLDER)
+    if os.path.isdir(thumbnails_directory):
+        for f in os.listdir(thumbnails_directory):
+            os.remove(os.path.join(thumbnails_directory, f))
+
+def get_thumbnail_path(image_path: str) -> str:
+    """Get the path of the thumbnail made for the captured image with the 
+    given path when capturing with thumbnails (see capture())."""
+    return os.path.join(os.path.dirname(image_path), THUMBNAILS_FOLDER,
+                        os.path.basename(image_path))
     
-def capture(camera_device: str = 'all', add_processing: bool = False,
-            verbose: bool = False, log_file_path:str = './camera_logs.txt',
-            images_directory: str = './images/'):
-    """Take a picture using the given device, or on all connected devices, and
-    stores the output in the given directory. This function also generates a 
-    temporary output file, which will either be stored in the file given by
-    log_file_path or deleted on function end if log_file_path is None.
+def get_capture_jobs(camera_device: str, images_directory: str
+                        ) -> Dict[str, List[Tuple[str, str]]]:
+    """Get the (device, image file path) capture jobs for the given device, or
+    for all connected devices, grouped by device. Jobs that share a device
+    must run one after another.
 
     Args:
-        camera_device (str, optional): the device to use to take a photo. If 
-        'all' is specified, all detected devices will be used to capture photos. 
-        Defaults to 'all'.
-        add_processing (bool, optional): whether to add image processing effects
-        to photos after capture. Defaults to False.
-        verbose (bool, optional): whether to show verbose output on stdout. 
-        Defaults to False.
-        log_file_path (str, optional): the path to the file to store logs in. 
-        Defaults to './camera_logs.txt'.
-        images_directory (str, optional): the path to the folder to store
-        captured images in. Defaults to './images/'.
-    """
+        camera_device (str): the device to use to take a photo, 'picamera', or
+        'all' for every detected device
+        images_directory (str): the path to the folder to store captured 
+        images in
 
-    _prepare_directory(images_directory)
-
-    keep_output = log_file_path is not None
-    log_file_path = log_file_path if log_file_path else './camera_logs.txt'
-    
-    # Clear the camera_log.txt file if it exists
-    open(log_file_path, 'w').close()
+    Returns:
+        Dict[str, List[Tuple[str, str]]]: each device's capture jobs, in order.
+        Image file paths don't include the '.jpg' extension.
+    """
 
+    device_jobs: Dict[str, List[Tuple[str, str]]] = {}
     picture_num = 0
     if camera_device == 'picamera' or camera_device == 'all':
-        if pi_camera is not None:
-            pi_camera.capture(images_directory + f'image{picture_num}.jpg')
+        if get_pi_camera() is not None:
+            device_jobs['RPi Camera Module'] = [
+                ('RPi Camera Module', images_directory + f'image{picture_num}')
+            ]
             picture_num += 1
         elif camera_device == 'picamera':
             print('PiCamera not connected') # TODO raise an exception here
@@ -222,26 +443,105 @@ def capture(camera_device: str = 'all', add_processing: bool = False,
         # Take a picture on all connected cameras, excluding the PiCamera
         for device_name, cameras in find_devices().items():
             if device_name != 'RPi Camera Module':
+                device_jobs[device_name] = []
                 for _ in range(cameras):
-                    _take_fswebcam_picture(
-                        device_name, add_processing, log_file_path,
-                        images_directory + f'image{str(picture_num)}')
+                    device_jobs[device_name].append(
+                        (device_name, images_directory + f'image{picture_num}'))
                     picture_num += 1
     elif camera_device.startswith('/dev/video'):
-        _take_fswebcam_picture(
-            camera_device, add_processing, log_file_path, 
-            images_directory + 'image')
-    else:
+        device_jobs[camera_device] = [(camera_device, images_directory + 'image')]
+    elif camera_device != 'picamera':
         print(f'device {camera_device} is not supported')
-    
-    if verbose:
-        print('Camera Logs:')
-        with open(log_file_path, 'r') as log_file:
-            print(log_file.read())
-    if not keep_output:
-        os.remove(log_file_path)
+    return device_jobs
+
+def capture(camera_device: str = 'all', add_processing: bool = False,
+            images_directory: str = './images/', 
+            max_workers: Optional[int] = None,
+            pipeline=None, thumbnails: bool = False,
+            get_profile: Optional[Callable] = None,
+            burst_frames: int = 1) -> List[CaptureResult]:
+    """Take a picture using the given device, or on all connected devices, and
+    stores the output in the given directory. When capturing on all devices,
+    each device is captured concurrently, up to max_workers at a time. Each
+    capture's timing, exit status and output is recorded as an event (see
+    instrumentation.py).
+
+    Image processing runs in a separate worker pool, starting on each picture
+    as soon as it is taken, so it doesn't hold up the remaining captures.
+
+    Args:
+        camera_device (str, optional): the device to use to take a photo. If 
+        'all' is specified, all detected devices will be used to capture photos. 
+        Defaults to 'all'.
+        add_processing (bool, optional): whether to add image processing effects
+        to photos after capture, using processing.get_default_pipeline() unless
+        a pipeline is given. Defaults to False.
+        images_directory (str, optional): the path to the folder to store
+        captured images in. Defaults to './images/'.
+        max_workers (int, optional): the maximum number of devices to capture
+        on at the same time. Defaults to None, which captures on every device
+        at once.
+        pipeline (processing.Pipeline, optional): the post-capture pipeline to
+        run each picture through. Defaults to None.
+        thumbnails (bool, optional): whether to make a thumbnail of each 
+        picture as it is taken (see get_thumbnail_path()), if no pipeline is 
+        given. Defaults to False.
+        get_profile (Callable[[str], profiles.CaptureProfile], optional): 
+        called with each device to get the profile to capture with, such as
+        profiles.ProfileController.get_profile. Defaults to None, which 
+        captures with CAPTURE_ARGS.
+        burst_frames (int, optional): the number of frames to grab from each
+        device in one session, saving only the sharpest, best exposed one
+        (see burst.py). Defaults to 1, which takes a single picture.
+
+    Returns:
+        List[CaptureResult]: the timing, exit status and output of each capture
+    """
+
+    prepare_directory(images_directory)
+
+    device_jobs = get_capture_jobs(camera_device, images_directory)
+
+    own_pipeline = pipeline is None and (add_processing or thumbnails)
+    if own_pipeline:
+        import processing
+        pipeline = processing.get_default_pipeline(
+            add_banner=add_processing,
+            thumbnails_directory=os.path.join(images_directory, 
+                                                THUMBNAILS_FOLDER) 
+                if thumbnails else None)
+    processed: List[Future] = []
+
+    def on_capture(result: CaptureResult):
+        processed.append(pipeline.submit(result.device, result.image_path))
+
+    results: List[CaptureResult] = []
+    if device_jobs:
+        workers = max_workers if max_workers else len(device_jobs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_capture_sequentially, jobs, 
+                                on_capture if pipeline is not None else None,
+                                get_profile, burst_frames)
+                    for jobs in device_jobs.values()
+            ]
+            for future in futures:
+                results.extend(future.result())
+
+    for future in processed:
+        try:
+            future.result()
+        except Exception as err:
+            print('Error: could not process an image:\n', err)
+    if own_pipeline:
+        pipeline.close()
+    return results
 
 def close_camera():
     """Close the PiCamera if it was initialized."""
-    if pi_camera is not None:
-        pi_camera.close()
+    global _pi_camera, _pi_camera_initialized
+    with _pi_camera_lock:
+        if _pi_camera is not None:
+            _pi_camera.close()
+        _pi_camera = None
+        _pi_camera_initialized = False
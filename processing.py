@@ -0,0 +1,230 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+import instrumentation
+
+# Banner settings, matching the banner fswebcam used to draw
+BANNER_COLOUR: str = '#FF0000'
+BANNER_FONT: str = 'DejaVuSans.ttf'
+BANNER_FONT_SIZE: int = 20
+TIMESTAMP_FORMAT: str = '%m/%d/%Y %I:%M %p'
+
+
+class Frame:
+    """A decoded frame passed between pipeline stages. Stages change the
+    image in place of re-reading the file, and can store extra outputs, such
+    as thumbnail paths, for later stages and the caller."""
+
+    def __init__(self, device: str, path: str, image: Image.Image,
+                    timestamp: datetime):
+        self.device = device
+        self.path = path
+        self.image = image
+        self.timestamp = timestamp
+        self.quality = 85
+        self.modified = False
+        self.outputs: Dict[str, str] = {}
+
+
+class Stage(ABC):
+    """A step in the post-capture pipeline."""
+
+    @abstractmethod
+    def apply(self, frame: Frame):
+        """Process the frame, changing it in place."""
+
+
+class BannerStage(Stage):
+    """Draws a banner along the bottom of the frame with the device name on the
+    left and the capture time on the right."""
+
+    def __init__(self, colour: str = BANNER_COLOUR,
+                    font_size: int = BANNER_FONT_SIZE):
+        self.colour = colour
+        try:
+            self.font = ImageFont.truetype(BANNER_FONT, font_size)
+        except OSError:
+            self.font = ImageFont.load_default()
+
+    def apply(self, frame: Frame):
+        if frame.image.mode != 'RGB':
+            frame.image = frame.image.convert('RGB')
+        draw = ImageDraw.Draw(frame.image)
+        title = f'DEVICE: {frame.device}'
+        timestamp = frame.timestamp.strftime(TIMESTAMP_FORMAT)
+        _, top, _, bottom = draw.textbbox((0, 0), title, font=self.font)
+        height = bottom + top + 8
+        width = frame.image.width
+        y = frame.image.height - height
+        draw.rectangle((0, y, width, frame.image.height), fill=self.colour)
+        draw.text((4, y + 4), title, fill='white', font=self.font)
+        text_width = draw.textlength(timestamp, font=self.font)
+        draw.text((width - text_width - 4, y + 4), timestamp, fill='white',
+                    font=self.font)
+        frame.modified = True
+
+
+class ResizeStage(Stage):
+    """Shrinks the frame to fit within a maximum size, keeping its aspect
+    ratio."""
+
+    def __init__(self, max_size: Tuple[int, int]):
+        self.max_size = max_size
+
+    def apply(self, frame: Frame):
+        if frame.image.width > self.max_size[0] or \
+                frame.image.height > self.max_size[1]:
+            image = frame.image.copy()
+            image.thumbnail(self.max_size, Image.BILINEAR)
+            frame.image = image
+            frame.modified = True
+
+
+class QualityStage(Stage):
+    """Sets the JPEG quality the frame is re-encoded at."""
+
+    def __init__(self, quality: int):
+        self.quality = quality
+
+    def apply(self, frame: Frame):
+        frame.quality = self.quality
+        frame.modified = True
+
+
+class ThumbnailStage(Stage):
+    """Writes a small copy of the frame to a separate folder and records its
+    path in the frame's 'thumbnail' output."""
+
+    def __init__(self, directory: str = './images/thumbnails/',
+                    size: Tuple[int, int] = (320, 180), quality: int = 70):
+        self.directory = directory
+        self.size = size
+        self.quality = quality
+
+    def apply(self, frame: Frame):
+        os.makedirs(self.directory, exist_ok=True)
+        thumbnail = frame.image.copy()
+        thumbnail.thumbnail(self.size, Image.BILINEAR)
+        thumbnail_path = os.path.join(self.directory,
+                                        os.path.basename(frame.path))
+        thumbnail.convert('RGB').save(thumbnail_path, 'JPEG',
+                                        quality=self.quality)
+        frame.outputs['thumbnail'] = thumbnail_path
+
+
+class Pipeline:
+    """Runs captured frames through a series of stages in a worker pool. Each
+    frame is decoded once, passed through every stage in memory and, if any
+    stage changed it, re-encoded over the original file."""
+
+    def __init__(self, stages: List[Stage], max_workers: int = 2):
+        """Create a pipeline.
+
+        Args:
+            stages (List[Stage]): the stages to run, in order
+            max_workers (int, optional): the number of frames to process at the
+            same time. Defaults to 2.
+        """
+        self.stages = stages
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='processing')
+
+    def process(self, device: str, image_path: str,
+                timestamp: Optional[datetime] = None) -> Frame:
+        """Run a frame through every stage.
+
+        Args:
+            device (str): the device the frame was captured on
+            image_path (str): the path to the frame
+            timestamp (datetime, optional): when the frame was captured.
+            Defaults to None, which uses the current time.
+
+        Returns:
+            Frame: the processed frame
+        """
+        start = time.perf_counter()
+        with Image.open(image_path) as image:
+            image.load()
+        frame = Frame(device, image_path, image,
+                        timestamp if timestamp else datetime.now())
+        for stage in self.stages:
+            stage.apply(frame)
+        # Frames that only had side outputs made aren't re-encoded
+        if frame.modified:
+            frame.image.convert('RGB').save(image_path, 'JPEG',
+                                            quality=frame.quality)
+        instrumentation.record('processing', 
+                                duration=time.perf_counter() - start,
+                                device=device, 
+                                size=os.path.getsize(image_path))
+        return frame
+
+    def submit(self, device: str, image_path: str,
+                timestamp: Optional[datetime] = None) -> Future:
+        """Queue a frame to be run through every stage in the worker pool.
+
+        Args:
+            device (str): the device the frame was captured on
+            image_path (str): the path to the frame
+            timestamp (datetime, optional): when the frame was captured.
+            Defaults to None, which uses the current time.
+
+        Returns:
+            Future: resolves to the processed Frame
+        """
+        if timestamp is None:
+            timestamp = datetime.now()
+        return self._executor.submit(self.process, device, image_path,
+                                        timestamp)
+
+    def close(self):
+        """Wait for queued frames to finish and stop the worker pool."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_default_pipeline(add_banner: bool = True,
+                            thumbnails_directory: Optional[str] = None,
+                            settings: Optional[Dict] = None) -> Pipeline:
+    """Get the pipeline used by the -p/--process-images and --thumbnails
+    options and the config file's "processing" section.
+
+    Args:
+        add_banner (bool, optional): whether to add a banner with the device
+        name and capture time to each frame. Defaults to True.
+        thumbnails_directory (str, optional): the path to the folder to write
+        a thumbnail of each frame to. Defaults to None, in which case no
+        thumbnails are made.
+        settings (Dict, optional): the config file's "processing" section,
+        which can set the largest size to shrink frames to, such as
+        "1280x720", under "max_size" and the JPEG quality to re-encode them at
+        under "quality". Defaults to None, which leaves frames at their
+        captured size and quality.
+
+    Returns:
+        Pipeline: the pipeline
+    """
+    settings = settings if settings else {}
+    stages: List[Stage] = []
+    if settings.get('max_size'):
+        width, height = settings['max_size'].split('x')
+        stages.append(ResizeStage((int(width), int(height))))
+    if settings.get('quality'):
+        stages.append(QualityStage(int(settings['quality'])))
+    if add_banner:
+        stages.append(BannerStage())
+    # Thumbnails are made last, so they show the frame as it is emailed
+    if thumbnails_directory is not None:
+        stages.append(ThumbnailStage(thumbnails_directory))
+    return Pipeline(stages)
@@ -0,0 +1,208 @@
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import instrumentation
+
+
+class CaptureProfile(NamedTuple):
+    """How a frame is captured: its resolution, JPEG quality, the number of
+    seconds the camera warms up for and the number of frames fswebcam
+    averages."""
+    name: str
+    resolution: Tuple[int, int]
+    quality: int
+    delay: float
+    frames: int
+
+
+# The profiles used when the config file doesn't list any, from the most to
+# the least costly. 'full' uses the resolution and delay of
+# photography.CAPTURE_ARGS, at a higher JPEG quality than fswebcam's default
+# of 90.
+DEFAULT_PROFILES: List[CaptureProfile] = [
+    CaptureProfile('full', (1280, 720), 95, 1.0, 1),
+    CaptureProfile('reduced', (960, 540), 80, 1.0, 1),
+    CaptureProfile('low', (640, 360), 65, 0.5, 1),
+    CaptureProfile('minimal', (320, 180), 50, 0.0, 1)
+]
+
+# The diagnostics the controller watches, with the values above which it
+# steps down a profile and below which it can step back up. The uplink
+# diagnostics come from the mail transport (see MailTransport.stats()):
+# uplink_latency is the latency of the last send, in seconds, and is only
+# watched when a send has finished since the previous sample, uplink_failures
+# is the number of sends that have failed in a row, which keeps growing while
+# the mail server is unreachable, and uplink_queue_depth is the number of
+# messages waiting in the spool.
+DEFAULT_THRESHOLDS: Dict[str, Tuple[float, float]] = {
+    'temperature': (160.0, 145.0),
+    'cpu_percent': (90.0, 70.0),
+    'memory_used_percent': (90.0, 75.0),
+    'uplink_latency': (20.0, 5.0),
+    'uplink_failures': (2.0, 1.0),
+    'uplink_queue_depth': (10.0, 1.0)
+}
+
+# The number of diagnostics samples in a row that must all be below their
+# low thresholds before stepping back up a profile
+DEFAULT_RECOVERY_SAMPLES: int = 3
+
+
+def _parse_profile(name: str, settings: Dict) -> CaptureProfile:
+    width, height = settings.get('resolution', '1280x720').split('x')
+    return CaptureProfile(name, (int(width), int(height)),
+                            int(settings.get('quality', 95)),
+                            float(settings.get('delay', 1)),
+                            int(settings.get('frames', 1)))
+
+
+class ProfileController:
+    """Chooses the capture profile for each device, stepping every device
+    down one profile when a watched diagnostic goes over its high threshold
+    and back up one profile once every watched diagnostic has stayed under
+    its low threshold for a few samples. The gap between the thresholds keeps
+    the profile from flapping around a single value.
+    """
+
+    def __init__(self, profiles: List[CaptureProfile] = DEFAULT_PROFILES,
+                    device_profiles: Optional[Dict[str, str]] = None,
+                    thresholds: Dict[str, Tuple[float, float]] =
+                        DEFAULT_THRESHOLDS,
+                    recovery_samples: int = DEFAULT_RECOVERY_SAMPLES):
+        """Create a controller.
+
+        Args:
+            profiles (List[CaptureProfile], optional): the profiles to choose
+            from, from the most to the least costly. Defaults to
+            DEFAULT_PROFILES.
+            device_profiles (Dict[str, str], optional): the name of the most
+            costly profile each device may use. Other devices may use every
+            profile. Defaults to None.
+            thresholds (Dict[str, Tuple[float, float]], optional): the high
+            and low threshold of each watched diagnostic. Defaults to
+            DEFAULT_THRESHOLDS.
+            recovery_samples (int, optional): the number of samples in a row
+            that must be under every low threshold before stepping back up.
+            Defaults to DEFAULT_RECOVERY_SAMPLES.
+
+        Raises:
+            ValueError: if a device is given a profile that isn't one of the
+            profiles to choose from
+        """
+        self.profiles = profiles
+        names = [profile.name for profile in profiles]
+        self.device_levels = {}
+        for device, name in (device_profiles or {}).items():
+            if name not in names:
+                raise ValueError(f'Unknown capture profile "{name}" for '
+                                    f'{device}, expected one of '
+                                    f'{", ".join(names)}')
+            self.device_levels[device] = names.index(name)
+        self.thresholds = thresholds
+        self.recovery_samples = recovery_samples
+        # How many profiles every device is stepped down from its best one
+        self.level = 0
+        self._recovered = 0
+        # The transport's sent count at the previous update, to tell whether
+        # its last latency is new
+        self._last_sent: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get_profile(self, device: str) -> CaptureProfile:
+        """Get the profile to capture on the given device with."""
+        level = self.device_levels.get(device, 0) + self.level
+        return self.profiles[min(level, len(self.profiles) - 1)]
+
+    def _get_uplink_values(self, uplink: Optional[Dict[str, float]]
+                            ) -> Dict[str, Optional[float]]:
+        """Get the watched uplink diagnostics from the mail transport's stats.
+        The last latency is left out unless a send has finished since the
+        previous update, so one slow send isn't counted again on every
+        sample."""
+        if uplink is None:
+            return {}
+        latency = None
+        if self._last_sent is not None and uplink['sent'] != self._last_sent:
+            latency = uplink['last_latency']
+        self._last_sent = uplink['sent']
+        return {
+            'uplink_latency': latency,
+            'uplink_failures': uplink['failures'],
+            'uplink_queue_depth': uplink['queue_depth']
+        }
+
+    def update(self, sample: Dict[str, any],
+                uplink: Optional[Dict[str, float]] = None) -> int:
+        """Step the profiles down or up for a new diagnostics sample.
+
+        Args:
+            sample (Dict[str, any]): a raw diagnostics sample (see
+            diagnostics.collect_diagnostics()). Diagnostics that couldn't be
+            collected are ignored.
+            uplink (Dict[str, float], optional): the mail transport's stats
+            (see MailTransport.stats()). Defaults to None, which ignores the
+            uplink.
+
+        Returns:
+            int: how many profiles every device is stepped down
+        """
+        with self._lock:
+            values = dict(sample, **self._get_uplink_values(uplink))
+        over = [
+            field for field, (high, _) in self.thresholds.items()
+                if values.get(field) is not None and values[field] > high
+        ]
+        recovered = all(
+            values.get(field) is None or values[field] < low
+                for field, (_, low) in self.thresholds.items()
+        )
+        with self._lock:
+            previous = self.level
+            if over:
+                self._recovered = 0
+                self.level = min(self.level + 1, len(self.profiles) - 1)
+            elif recovered and self.level > 0:
+                self._recovered += 1
+                if self._recovered >= self.recovery_samples:
+                    self._recovered = 0
+                    self.level -= 1
+            else:
+                self._recovered = 0
+            level = self.level
+
+        if level != previous:
+            instrumentation.record('profile_change', level=level,
+                                    profile=self.profiles[level].name,
+                                    reason=','.join(over) if over
+                                            else 'recovered')
+        instrumentation.gauge('satellite_capture_profile_level',
+                                'How many capture profiles devices are '
+                                'stepped down').set(level)
+        return level
+
+
+def load_controller(config: Dict) -> ProfileController:
+    """Create a controller from the config file's "profiles" section, which
+    can list the profiles from the most to the least costly under
+    "available", each device's most costly profile under "devices", and the
+    high and low thresholds of each watched diagnostic under "thresholds".
+
+    Args:
+        config (Dict): the loaded config file
+
+    Returns:
+        ProfileController: the controller
+    """
+    settings = config.get('profiles', {})
+    profiles = [
+        _parse_profile(name, profile)
+            for name, profile in settings.get('available', {}).items()
+    ] or DEFAULT_PROFILES
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(
+        (field, tuple(limits))
+            for field, limits in settings.get('thresholds', {}).items()
+    )
+    return ProfileController(profiles, settings.get('devices'), thresholds,
+                                settings.get('recovery_samples',
+                                                DEFAULT_RECOVERY_SAMPLES))
@@ -0,0 +1,127 @@
+import threading
+import time
+from typing import Callable, List, Optional
+
+import instrumentation
+
+
+class Job:
+    """A task that the Scheduler runs every interval seconds."""
+
+    def __init__(self, name: str, interval: float, func: Callable[[], None],
+                    delay: float = 0.0):
+        """Create a job.
+
+        Args:
+            name (str): the job's name, used in messages
+            interval (float): the number of seconds between runs
+            func (Callable[[], None]): the function to run
+            delay (float, optional): the number of seconds to wait before the
+            first run. Defaults to 0.0.
+
+        Raises:
+            ValueError: if the interval isn't a positive number of seconds
+        """
+        if not interval > 0:
+            raise ValueError(f'The {name} job\'s interval must be more than '
+                                f'0 seconds, not {interval}')
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = time.monotonic() + delay
+        self.skipped = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        """Return whether the job's previous run hasn't finished yet."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Run the job in its own thread."""
+        self._thread = threading.Thread(target=self._run, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        exit_code = 0
+        try:
+            self.func()
+        except Exception as err:
+            exit_code = 1
+            print(f'Job {self.name} failed:\n', err)
+        instrumentation.record('job', duration=time.perf_counter() - start,
+                                exit_code=exit_code, job=self.name)
+
+    def join(self, timeout: Optional[float] = None):
+        """Wait for the job's current run, if any, to finish."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+class Scheduler:
+    """Runs jobs on separate fixed intervals until a stop event is set. Each
+    job runs in its own thread so a slow job doesn't delay the others, and a
+    run that comes due while the job's previous run is still going is dropped
+    rather than queued, so a backlog of runs can never build up.
+    """
+
+    def __init__(self, stop_event: Optional[threading.Event] = None,
+                    verbose: bool = False):
+        """Create a scheduler with no jobs.
+
+        Args:
+            stop_event (threading.Event, optional): set to stop the scheduler.
+            Defaults to None, which creates a new event.
+            verbose (bool, optional): whether to show a message when a run is
+            dropped. Defaults to False.
+        """
+        self.stop_event = stop_event if stop_event else threading.Event()
+        self.verbose = verbose
+        self.jobs: List[Job] = []
+
+    def add_job(self, name: str, interval: float, func: Callable[[], None],
+                delay: float = 0.0) -> Job:
+        """Add a job that runs every interval seconds.
+
+        Args:
+            name (str): the job's name, used in messages
+            interval (float): the number of seconds between runs
+            func (Callable[[], None]): the function to run
+            delay (float, optional): the number of seconds to wait before the
+            first run. Defaults to 0.0.
+
+        Returns:
+            Job: the added job
+        """
+        job = Job(name, interval, func, delay)
+        self.jobs.append(job)
+        return job
+
+    def run(self):
+        """Run jobs as they come due until the stop event is set, then wait for
+        any running jobs to finish."""
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            for job in self.jobs:
+                if job.next_run > now:
+                    continue
+                if job.is_running():
+                    job.skipped += 1
+                    instrumentation.record('job_dropped', job=job.name)
+                    if self.verbose:
+                        print(f'Dropped a {job.name} run, the previous run '
+                                'is still going')
+                else:
+                    job.start()
+                # Skip over any runs that were missed entirely
+                while job.next_run <= now:
+                    job.next_run += job.interval
+            next_run = min((job.next_run for job in self.jobs), default=now + 1)
+            self.stop_event.wait(max(0.0, next_run - time.monotonic()))
+        for job in self.jobs:
+            job.join()
+
+    def stop(self):
+        """Ask the scheduler to stop after its current runs finish."""
+        self.stop_event.set()
@@ -0,0 +1,411 @@
+import io
+import os
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import photography
+from photography import CaptureResult
+
+# ffmpeg arguments used to stream frames from a V4L2 device as MJPEG
+STREAM_ARGS: List[str] = [
+    '-f', 'v4l2'
+]
+VIDEO_SIZE: str = '1280x720'
+FRAMERATE: int = 15
+ENCODE_ARGS: List[str] = [
+    '-f', 'image2pipe',
+    '-c:v', 'mjpeg'
+]
+# The MJPEG quantizer scale used when no JPEG quality is given, from 2 (best)
+# to 31 (worst)
+QSCALE: int = 5
+
+
+
+def get_qscale(quality: int) -> int:
+    """Convert a JPEG quality from 1 (worst) to 100 (best), as used by
+    fswebcam and the PiCamera, to the closest MJPEG quantizer scale."""
+    quality = min(max(quality, 1), 100)
+    return round(31 - (quality - 1) * 29 / 99)
+
+
+# JPEG start and end of image markers, used to split the MJPEG stream
+_JPEG_START = b'\xff\xd8'
+_JPEG_END = b'\xff\xd9'
+
+
+class V4L2Session:
+    """A long-lived capture session on a V4L2 device. An ffmpeg process keeps
+    the device open and streams frames as MJPEG, and a reader thread keeps the
+    most recent frame in memory so that it can be grabbed at any time without
+    paying for device setup or warm-up.
+    """
+
+    def __init__(self, device: str, channel: int = 0, 
+                    video_size: str = VIDEO_SIZE, framerate: int = FRAMERATE,
+                    quality: Optional[int] = None):
+        """Create a session for the given device. The device isn't opened
+        until start() is called.
+
+        Args:
+            device (str): the device to capture on, for example /dev/video0
+            channel (int, optional): the input (camera) on the device to
+            capture from. Defaults to 0.
+            video_size (str, optional): the resolution to capture at. Defaults
+            to VIDEO_SIZE.
+            framerate (int, optional): the number of frames to capture per
+            second. Defaults to FRAMERATE.
+            quality (int, optional): the JPEG quality to encode frames at,
+            from 1 to 100. Defaults to None, which encodes at QSCALE.
+        """
+        self.device = device
+        self.channel = channel
+        self.video_size = video_size
+        self.framerate = framerate
+        self.quality = quality
+        self._process: Optional[subprocess.Popen] = None
+        self._reader: Optional[threading.Thread] = None
+        self._condition = threading.Condition()
+        self._frame: Optional[bytes] = None
+        self._frame_count = 0
+
+    def _get_ffmpeg_args(self) -> List[str]:
+        """Build the command used to stream frames from the device.
+
+        Returns:
+            List[str]: the ffmpeg command and its arguments
+        """
+        args = ['ffmpeg', '-loglevel', 'error', '-nostdin']
+        args.extend(STREAM_ARGS)
+        args.extend(['-video_size', self.video_size, 
+                        '-framerate', str(self.framerate),
+                        '-channel', str(self.channel), '-i', self.device])
+        args.extend(ENCODE_ARGS)
+        args.extend(['-q:v', str(QSCALE if self.quality is None
+                                    else get_qscale(self.quality))])
+        args.append('-')
+        return args
+
+    def start(self):
+        """Open the device and start streaming frames from it."""
+        if self.is_alive():
+            return
+        with self._condition:
+            self._frame = None
+            self._frame_count = 0
+        self._process = subprocess.Popen(self._get_ffmpeg_args(),
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL)
+        self._reader = threading.Thread(target=self._read_frames,
+                                        args=(self._process.stdout,),
+                                        daemon=True)
+        self._reader.start()
+
+    def _read_frames(self, stream: io.BufferedReader):
+        """Split the MJPEG stream into frames, keeping only the latest one.
+
+        Args:
+            stream (io.BufferedReader): the stdout of the ffmpeg process
+        """
+        buffer = b''
+        while True:
+            chunk = stream.read1(65536)
+            if not chunk:
+                break
+            buffer += chunk
+            while True:
+                start = buffer.find(_JPEG_START)
+                if start < 0:
+                    buffer = b''
+                    break
+                end = buffer.find(_JPEG_END, start + 2)
+                if end < 0:
+                    break
+                frame = buffer[start:end + 2]
+                buffer = buffer[end + 2:]
+                with self._condition:
+                    self._frame = frame
+                    self._frame_count += 1
+                    self._condition.notify_all()
+        with self._condition:
+            self._condition.notify_all()
+
+    def is_alive(self) -> bool:
+        """Return whether the device is open and streaming frames."""
+        return self._process is not None and self._process.poll() is None
+
+    def grab(self, timeout: float = 5.0,
+                newer_than: Optional[int] = None) -> Optional[bytes]:
+        """Get the most recent frame from the device as JPEG data.
+
+        Args:
+            timeout (float, optional): how many seconds to wait for a frame.
+            Defaults to 5.0.
+            newer_than (int, optional): only return a frame whose number is
+            greater than this (see frame_count). Defaults to None, which returns
+            the latest frame, waiting only if none has arrived yet.
+
+        Returns:
+            Optional[bytes]: the frame's JPEG data, or None if no frame arrived
+            in time
+        """
+        minimum = newer_than if newer_than is not None else 0
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._frame_count > minimum or not self.is_alive(),
+                timeout)
+            if self._frame_count > minimum:
+                return self._frame
+            return None
+
+    @property
+    def frame_count(self) -> int:
+        """The number of frames received since the session started."""
+        return self._frame_count
+
+    def switch_channel(self, channel: int):
+        """Capture from another input on the device. ffmpeg selects the input
+        when it opens the device, so the stream is restarted if the input
+        changes.
+
+        Args:
+            channel (int): the input (camera) on the device to capture from
+        """
+        if channel == self.channel:
+            return
+        self.close()
+        self.channel = channel
+        self.start()
+
+    def set_profile(self, profile):
+        """Capture at a profile's resolution and JPEG quality. ffmpeg sets
+        both when it opens the device, so a running stream is restarted if
+        either changes.
+
+        Args:
+            profile (profiles.CaptureProfile): the profile to capture with
+        """
+        video_size = '{}x{}'.format(*profile.resolution)
+        if (video_size, profile.quality) == (self.video_size, self.quality):
+            return
+        running = self.is_alive()
+        self.close()
+        self.video_size = video_size
+        self.quality = profile.quality
+        if running:
+            self.start()
+
+    def close(self):
+        """Stop streaming and release the device."""
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        if self._reader is not None:
+            self._reader.join(timeout=5)
+        self._process = None
+        self._reader = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PiCameraSession:
+    """A capture session on the Raspberry Pi Camera Module. The PiCamera handle
+    in photography already stays open once connected, so frames are grabbed
+    straight from its video port, which skips the still port's mode switch.
+    """
+
+    device = 'RPi Camera Module'
+
+    def __init__(self, quality: Optional[int] = None):
+        """Create a session on the PiCamera.
+
+        Args:
+            quality (int, optional): the JPEG quality to capture frames at,
+            from 1 to 100. Defaults to None, which uses the PiCamera's default.
+        """
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._frame_count = 0
+
+    def start(self):
+        """Connect to the PiCamera if this process hasn't already."""
+        photography.get_pi_camera()
+
+    def is_alive(self) -> bool:
+        """Return whether the PiCamera is connected."""
+        return photography.get_pi_camera() is not None
+
+    def set_profile(self, profile):
+        """Capture at a profile's resolution and JPEG quality (see
+        photography.set_pi_camera_profile()).
+
+        Args:
+            profile (profiles.CaptureProfile): the profile to capture with
+        """
+        self.quality = profile.quality
+        camera = photography.get_pi_camera()
+        if camera is not None:
+            with self._lock:
+                photography.set_pi_camera_profile(camera, profile)
+
+    def grab(self, timeout: float = 5.0,
+                newer_than: Optional[int] = None) -> Optional[bytes]:
+        """Capture a frame from the PiCamera as JPEG data.
+
+        Args:
+            timeout (float, optional): unused, kept for compatibility with
+            V4L2Session.grab. Defaults to 5.0.
+            newer_than (int, optional): unused, every grab captures a new frame.
+            Defaults to None.
+
+        Returns:
+            Optional[bytes]: the frame's JPEG data, or None if the PiCamera
+            isn't connected
+        """
+        if not self.is_alive():
+            return None
+        stream = io.BytesIO()
+        options = {} if self.quality is None else {'quality': self.quality}
+        with self._lock:
+            photography.get_pi_camera().capture(stream, format='jpeg',
+                                                use_video_port=True,
+                                                **options)
+            self._frame_count += 1
+        return stream.getvalue()
+
+    @property
+    def frame_count(self) -> int:
+        """The number of frames captured since the session started."""
+        return self._frame_count
+
+    def close(self):
+        """The PiCamera is closed through photography.close_camera()."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SessionSupervisor:
+    """Keeps a session open on every detected device, restarting any session
+    whose device stops streaming, and grabs frames from all of them on demand
+    or on a fixed schedule. A device can only be opened once, so devices with
+    several inputs share one session that is switched between them.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, object] = {}
+        # The number of inputs on each device
+        self.inputs: Dict[str, int] = {}
+        self.get_profile: Optional[Callable] = None
+
+    def open(self, devices: Optional[Dict[str, int]] = None,
+                framerate: int = FRAMERATE,
+                get_profile: Optional[Callable] = None):
+        """Open a session on each of the given devices.
+
+        Args:
+            devices (Dict[str, int], optional): device names and their number
+            of inputs, as returned by photography.find_devices(). Defaults to
+            None, which uses every detected device.
+            framerate (int, optional): the number of frames each V4L2 device
+            captures per second. Defaults to FRAMERATE.
+            get_profile (Callable[[str], profiles.CaptureProfile], optional):
+            called with each device before every grab to get the profile to
+            capture with, such as profiles.ProfileController.get_profile.
+            Defaults to None, which captures at VIDEO_SIZE and QSCALE.
+        """
+        if devices is None:
+            devices = photography.find_devices()
+        self.get_profile = get_profile
+        for device, cameras in devices.items():
+            if device == 'RPi Camera Module':
+                self.sessions[device] = PiCameraSession()
+                self.inputs[device] = 1
+            else:
+                self.sessions[device] = V4L2Session(device,
+                                                    framerate=framerate)
+                self.inputs[device] = cameras
+        for device, session in self.sessions.items():
+            if get_profile is not None:
+                session.set_profile(get_profile(device))
+            session.start()
+
+    def grab_all(self, images_directory: str = './images/',
+                    timeout: float = 5.0,
+                    burst_frames: int = 1) -> List[CaptureResult]:
+        """Save the latest frame from every input of every session into the
+        given directory, restarting any session that has stopped.
+
+        Args:
+            images_directory (str, optional): the path to the folder to store
+            frames in. Defaults to './images/'.
+            timeout (float, optional): how many seconds to wait for each frame.
+            Defaults to 5.0.
+            burst_frames (int, optional): the number of new frames to grab from
+            each session, saving only the best (see burst.select_best()).
+            Defaults to 1, which saves the latest frame.
+
+        Returns:
+            List[CaptureResult]: the timing and status of each grab
+        """
+        os.makedirs(images_directory, exist_ok=True)
+        results = []
+        inputs = [
+            (device, channel)
+                for device in self.sessions
+                for channel in range(self.inputs.get(device, 1))
+        ]
+        for picture_num, (device, channel) in enumerate(inputs):
+            start = time.perf_counter()
+            session = self.sessions[device]
+            name = device if channel == 0 else f'{device}:{channel}'
+            image_path = os.path.join(images_directory,
+                                        f'image{picture_num}.jpg')
+            try:
+                if not session.is_alive():
+                    session.close()
+                    session.start()
+                if self.get_profile is not None:
+                    session.set_profile(self.get_profile(device))
+                if self.inputs.get(device, 1) > 1:
+                    session.switch_channel(channel)
+                if burst_frames > 1:
+                    import burst
+                    frame, _ = burst.select_best(session, burst_frames,
+                                                    timeout)
+                else:
+                    frame = session.grab(timeout)
+                if frame is None:
+                    returncode, log = 1, 'No frame received\n'
+                else:
+                    with open(image_path, 'wb') as image_file:
+                        image_file.write(frame)
+                    returncode, log = 0, ''
+            except Exception as err:
+                returncode, log = 1, f'{err}\n'
+            result = CaptureResult(name, image_path, returncode,
+                                    time.perf_counter() - start, log)
+            photography.record_capture(result)
+            results.append(result)
+        return results
+
+    def close(self):
+        """Close every session."""
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+        self.inputs = {}
@@ -0,0 +1,245 @@
+import math
+import os
+import struct
+import time
+import zlib
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+# Telemetry packets carry raw diagnostics and frame metadata in a few dozen
+# bytes, for slow or metered uplinks. They are only formatted for display
+# where they are read, for example with:
+#
+#     python3 telemetry.py PACKET [PACKET ...] [--html]
+MAGIC = b'STLM'
+VERSION = 1
+
+# Set in the header's flags when the body is compressed with zlib
+FLAG_COMPRESSED = 0x01
+
+# magic, version, flags, body length, CRC-32 of the body as sent
+_HEADER = struct.Struct('<4sBBIL')
+# timestamp, cpu_percent, memory_used_percent, temperature, wifi_strength,
+# memory_available, frame count. Floats are NaN and memory_available is -1
+# when they couldn't be collected.
+_DIAGNOSTICS = struct.Struct('<dffffqH')
+# timestamp, capture duration, size in bytes, fswebcam exit status
+_FRAME = struct.Struct('<dfIh')
+
+# The diagnostics stored as floats, in the order they are packed
+_FLOAT_FIELDS = ('cpu_percent', 'memory_used_percent', 'temperature',
+                    'wifi_strength')
+# The diagnostics stored as short strings, in the order they are packed
+_TEXT_FIELDS = ('system', 'processor', 'boot_time')
+
+
+class FrameTelemetry(NamedTuple):
+    """What is known about a captured frame, without the frame itself."""
+    device: str
+    timestamp: float
+    duration: float
+    size: int
+    returncode: int
+
+
+class Telemetry(NamedTuple):
+    """A decoded telemetry packet."""
+    satellite: str
+    timestamp: float
+    # Raw values, as returned by diagnostics.collect_diagnostics()
+    diagnostics: Dict[str, any]
+    frames: List[FrameTelemetry]
+
+
+def _pack_text(text: Optional[str]) -> bytes:
+    """Pack a string as its length and UTF-8 bytes, cut to 255 bytes. None is
+    packed the same as an empty string."""
+    data = (text or '').encode('utf-8')[:255]
+    return bytes((len(data),)) + data
+
+
+def _unpack_text(body: bytes, offset: int):
+    length = body[offset]
+    end = offset + 1 + length
+    if end > len(body):
+        raise ValueError('The telemetry packet is truncated')
+    return body[offset + 1:end].decode('utf-8', errors='replace'), end
+
+
+def get_frame_telemetry(results: Iterable) -> List[FrameTelemetry]:
+    """Get the metadata of each capture's frame.
+
+    Args:
+        results (Iterable): the photography.CaptureResult of each capture
+
+    Returns:
+        List[FrameTelemetry]: the metadata, with a size of 0 for frames that
+        are no longer on disk
+    """
+    frames = []
+    for result in results:
+        exists = result.returncode == 0 and os.path.exists(result.image_path)
+        frames.append(FrameTelemetry(
+            result.device,
+            os.path.getmtime(result.image_path) if exists else time.time(),
+            result.duration,
+            os.path.getsize(result.image_path) if exists else 0,
+            result.returncode))
+    return frames
+
+
+def encode(satellite: str, values: Dict[str, any],
+            frames: Iterable[FrameTelemetry] = (),
+            timestamp: Optional[float] = None, compress: bool = True) -> bytes:
+    """Encode a raw diagnostics sample and frame metadata as a telemetry
+    packet.
+
+    Args:
+        satellite (str): the satellite's name
+        values (Dict[str, any]): the raw diagnostics sample (see
+        diagnostics.collect_diagnostics())
+        frames (Iterable[FrameTelemetry], optional): the metadata of the
+        frames captured. Defaults to ().
+        timestamp (float, optional): when the sample was taken, in seconds
+        since the epoch. Defaults to None, which uses the current time.
+        compress (bool, optional): whether to compress the body with zlib.
+        Small packets that don't shrink are sent uncompressed either way.
+        Defaults to True.
+
+    Returns:
+        bytes: the packet
+    """
+    frames = list(frames)
+    memory_available = values.get('memory_available')
+    parts = [
+        _pack_text(satellite),
+        _DIAGNOSTICS.pack(
+            time.time() if timestamp is None else timestamp,
+            *(math.nan if values.get(field) is None else values[field]
+                for field in _FLOAT_FIELDS),
+            -1 if memory_available is None else memory_available,
+            len(frames))
+    ]
+    parts.extend(_pack_text(values.get(field)) for field in _TEXT_FIELDS)
+    for frame in frames:
+        parts.append(_pack_text(frame.device))
+        parts.append(_FRAME.pack(frame.timestamp, frame.duration,
+                                    frame.size, frame.returncode))
+    body = b''.join(parts)
+
+    flags = 0
+    if compress:
+        compressed = zlib.compress(body, 9)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+    return _HEADER.pack(MAGIC, VERSION, flags, len(body),
+                        zlib.crc32(body)) + body
+
+
+def decode(packet: bytes) -> Telemetry:
+    """Decode a telemetry packet made by encode().
+
+    Args:
+        packet (bytes): the packet
+
+    Returns:
+        Telemetry: the satellite's name, when the sample was taken, the raw
+        diagnostics and the frame metadata. Diagnostics that couldn't be
+        collected are None.
+
+    Raises:
+        ValueError: if the packet is damaged, truncated or from a newer
+        version
+    """
+    if len(packet) < _HEADER.size:
+        raise ValueError('The telemetry packet is truncated')
+    magic, version, flags, length, checksum = _HEADER.unpack_from(packet)
+    if magic != MAGIC:
+        raise ValueError('Not a telemetry packet')
+    if version > VERSION:
+        raise ValueError(f'Unsupported telemetry version {version}')
+    body = packet[_HEADER.size:_HEADER.size + length]
+    if len(body) < length or zlib.crc32(body) != checksum:
+        raise ValueError('The telemetry packet is damaged')
+    if flags & FLAG_COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error:
+            raise ValueError('The telemetry packet is damaged')
+
+    try:
+        satellite, offset = _unpack_text(body, 0)
+        timestamp, *floats, memory_available, frame_count = \
+            _DIAGNOSTICS.unpack_from(body, offset)
+        offset += _DIAGNOSTICS.size
+        values = {
+            field: None if math.isnan(value) else value
+                for field, value in zip(_FLOAT_FIELDS, floats)
+        }
+        values['memory_available'] = memory_available \
+                                        if memory_available >= 0 else None
+        for field in _TEXT_FIELDS:
+            values[field], offset = _unpack_text(body, offset)
+            values[field] = values[field] or None
+        frames = []
+        for _ in range(frame_count):
+            device, offset = _unpack_text(body, offset)
+            frames.append(FrameTelemetry(device,
+                                            *_FRAME.unpack_from(body, offset)))
+            offset += _FRAME.size
+    except (IndexError, struct.error):
+        raise ValueError('The telemetry packet is truncated')
+    return Telemetry(satellite, timestamp, values, frames)
+
+
+def format_telemetry(telemetry: Telemetry) -> Dict[str, str]:
+    """Format a decoded packet for display, as diagnostics.format_diagnostics()
+    does, adding when it was taken and a line for each frame."""
+    from diagnostics import format_diagnostics
+
+    formatted = {
+        'Satellite': telemetry.satellite,
+        'Sampled': time.strftime('%m/%d/%Y %I:%M:%S %p',
+                                    time.localtime(telemetry.timestamp)),
+        **format_diagnostics(telemetry.diagnostics)
+    }
+    for frame in telemetry.frames:
+        formatted[f'Frame {frame.device}'] = (
+            f'{frame.size} bytes in {frame.duration:.2f} seconds'
+            if frame.returncode == 0 else
+            f'failed with exit status {frame.returncode}')
+    return formatted
+
+
+def render(telemetry: Telemetry, template_path: Optional[str] = None) -> str:
+    """Render a decoded packet as an HTML report for reading, with the compact
+    report template unless another template path is given."""
+    import templates
+    return templates.render(template_path if template_path else
+                                templates.get_template_path('compact'),
+                            diagnostics=format_telemetry(telemetry))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Decode and show telemetry packets')
+    parser.add_argument('packets', nargs='+', metavar='PACKET',
+                        help='the path to a telemetry packet')
+    parser.add_argument('--html', action='store_true',
+                        help='print each packet as an HTML report')
+    args = parser.parse_args()
+    for packet_path in args.packets:
+        with open(packet_path, 'rb') as packet_file:
+            telemetry = decode(packet_file.read())
+        if args.html:
+            print(render(telemetry))
+            continue
+        for key, value in format_telemetry(telemetry).items():
+            print(f'{key}: {value}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import time
+from typing import Dict
+
+from jinja2 import (Environment, FileSystemBytecodeCache, FileSystemLoader,
+                    select_autoescape)
+
+import instrumentation
+
+# The folder report templates are kept in
+TEMPLATES_DIRECTORY: str = './static/'
+
+# The folder compiled templates are cached in between runs
+BYTECODE_CACHE_DIRECTORY: str = './.template-cache/'
+
+# The report templates available, by name
+REPORT_TEMPLATES: Dict[str, str] = {
+    # Diagnostics, history and thumbnails
+    'full': 'email-message.html',
+    # Diagnostics only, on one line each
+    'compact': 'email-compact.html',
+    # A short notice, such as for motion-triggered captures
+    'alert': 'email-alert.html',
+    # Every node's diagnostics, sent by the collector
+    'fleet': 'email-fleet.html'
+}
+
+# One environment per templates folder, kept for the life of the process
+_environments: Dict[str, Environment] = {}
+
+
+def get_environment(directory: str = TEMPLATES_DIRECTORY) -> Environment:
+    """Get the Jinja environment for the templates in the given folder,
+    creating it the first time it is used.
+
+    Compiled templates are kept in memory by the environment and on disk in
+    the bytecode cache, so a template is only parsed again when its file's
+    modification time changes.
+
+    Args:
+        directory (str, optional): the path to the folder containing the
+        templates. Defaults to TEMPLATES_DIRECTORY.
+
+    Returns:
+        Environment: the environment
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _environments:
+        os.makedirs(BYTECODE_CACHE_DIRECTORY, exist_ok=True)
+        # Values such as satellite and device names can come from other
+        # machines, so they are escaped in HTML templates. The cache files are
+        # named apart from ones compiled before escaping was turned on, which
+        # the cache would otherwise reuse.
+        _environments[directory] = Environment(
+            loader=FileSystemLoader(directory),
+            bytecode_cache=FileSystemBytecodeCache(
+                BYTECODE_CACHE_DIRECTORY, '__jinja2_escaped_%s.cache'),
+            autoescape=select_autoescape(['html']),
+            auto_reload=True)
+    return _environments[directory]
+
+
+def get_template_path(name: str,
+                        directory: str = TEMPLATES_DIRECTORY) -> str:
+    """Get the path to the report template with the given name (see
+    REPORT_TEMPLATES)."""
+    return os.path.join(directory, REPORT_TEMPLATES[name])
+
+
+def render(template_path: str, **context) -> str:
+    """Render the template with the given path, recording how long it took as
+    a 'template_render' event.
+
+    Args:
+        template_path (str): the path to the template file
+        **context: the values to render the template with
+
+    Returns:
+        str: the rendered template
+    """
+    directory, filename = os.path.split(template_path)
+    start = time.perf_counter()
+    template = get_environment(directory if directory else '.') \
+        .get_template(filename)
+    rendered = template.render(**context)
+    duration = time.perf_counter() - start
+    instrumentation.record('template_render', duration=duration, 
+                            size=len(rendered), template=filename)
+    return rendered
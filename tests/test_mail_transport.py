@@ -0,0 +1,174 @@
+"""Tests for mail_transport.MailTransport against a local SMTP sink. Run from
+the repository root:
+
+    python3 -m unittest discover tests
+"""
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mail_transport import MailTransport
+
+MESSAGE = [b'Subject: Test\r\n', b'\r\n', b'Hello\r\n', b'.leading dot\r\n']
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Answers every command with the server's configured replies, keeping
+    each message it accepts."""
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'RCPT':
+                self.reply(self.server.rcpt_reply)
+            elif command == b'DATA':
+                self.reply('354 go ahead')
+                data = b''.join(iter(lambda: self.rfile.readline(), b'.\r\n'))
+                if self.server.data_reply.startswith('250'):
+                    self.server.messages.append(data)
+                self.reply(self.server.data_reply)
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(('127.0.0.1', port), _SMTPSinkHandler)
+        self.connections = 0
+        self.messages = []
+        self.rcpt_reply = '250 OK'
+        self.data_reply = '250 OK'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MailTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = SMTPSink()
+        self.port = self.sink.server_address[1]
+        self.spool = tempfile.TemporaryDirectory()
+        self.transport = self._get_transport()
+
+    def tearDown(self):
+        self.transport.close()
+        if self.sink is not None:
+            self.sink.stop()
+        self.spool.cleanup()
+
+    def _get_transport(self) -> MailTransport:
+        config = {
+            'sender': {'username': 'sender@example.com',
+                        'server': '127.0.0.1', 'port': self.port,
+                        'ssl': False},
+            'recipient': {'username': 'recipient@example.com'}
+        }
+        return MailTransport(config, spool_directory=self.spool.name,
+                                timeout=5)
+
+    def _failed(self):
+        return os.listdir(self.transport.failed_directory)
+
+    def test_reuses_session_across_sends(self):
+        self.assertTrue(self.transport.send(MESSAGE))
+        self.assertTrue(self.transport.stream(MESSAGE))
+        self.assertTrue(self.transport.send(MESSAGE))
+        self.assertEqual(self.sink.connections, 1)
+        self.assertEqual(len(self.sink.messages), 3)
+        self.assertEqual(self.transport.stats()['sent'], 3)
+
+    def test_message_is_unchanged(self):
+        self.assertTrue(self.transport.send(MESSAGE))
+        # Lines starting with a dot are escaped on the wire
+        self.assertEqual(self.sink.messages[0],
+                            b'Subject: Test\r\n\r\nHello\r\n..leading dot\r\n')
+
+    def test_spools_while_server_is_down(self):
+        self.sink.stop()
+        self.sink = None
+        self.assertFalse(self.transport.send(MESSAGE))
+        self.assertFalse(self.transport.stream(MESSAGE))
+        stats = self.transport.stats()
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertGreater(stats['failures'], 0)
+        self.assertEqual(self._failed(), [])
+
+    def test_drains_spool_once_server_is_back(self):
+        self.sink.stop()
+        self.sink = None
+        self.assertFalse(self.transport.send(MESSAGE))
+        self.assertFalse(self.transport.send(MESSAGE))
+
+        self.sink = SMTPSink(self.port)
+        self.transport.drain(force=True)
+        self.assertEqual(self.transport.queue(), [])
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(self.transport.stats()['failures'], 0)
+
+    def test_refused_recipient_is_moved_to_failed(self):
+        self.sink.rcpt_reply = '550 No such user'
+        self.assertFalse(self.transport.send(MESSAGE))
+        self.assertEqual(self.transport.queue(), [])
+        self.assertEqual(len(self._failed()), 1)
+        self.assertEqual(self.transport.stats()['failures'], 0)
+
+        # The refused message doesn't hold up the ones after it
+        self.sink.rcpt_reply = '250 OK'
+        self.assertTrue(self.transport.send(MESSAGE))
+        self.assertEqual(len(self.sink.messages), 1)
+
+    def test_streamed_refused_recipient_is_moved_to_failed(self):
+        self.sink.rcpt_reply = '550 No such user'
+        self.assertFalse(self.transport.stream(MESSAGE))
+        self.assertEqual(self.transport.queue(), [])
+        self.assertEqual(len(self._failed()), 1)
+
+        self.sink.rcpt_reply = '250 OK'
+        self.assertTrue(self.transport.stream(MESSAGE))
+
+    def test_rejected_message_is_moved_to_failed(self):
+        self.sink.data_reply = '554 Message rejected'
+        self.assertFalse(self.transport.send(MESSAGE))
+        self.assertFalse(self.transport.stream(MESSAGE))
+        self.assertEqual(self.transport.queue(), [])
+        self.assertEqual(len(self._failed()), 2)
+
+    def test_temporary_failure_stays_spooled(self):
+        self.sink.rcpt_reply = '451 Try again later'
+        self.assertFalse(self.transport.send(MESSAGE))
+        self.assertEqual(len(self.transport.queue()), 1)
+        self.assertEqual(self._failed(), [])
+
+        self.sink.rcpt_reply = '250 OK'
+        self.transport.drain(force=True)
+        self.assertEqual(self.transport.queue(), [])
+        self.assertEqual(len(self.sink.messages), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
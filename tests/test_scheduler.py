@@ -0,0 +1,71 @@
+"""Tests for scheduler.py and main.py's checks of the interval and -j/--jobs
+options. Run from the repository root:
+
+    python3 -m unittest discover tests
+"""
+import contextlib
+import io
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+from scheduler import Job, Scheduler
+
+
+class JobIntervalTest(unittest.TestCase):
+
+    def test_zero_interval_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Job('capture', 0, lambda: None)
+
+    def test_negative_interval_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Job('capture', -5, lambda: None)
+        with self.assertRaises(ValueError):
+            Scheduler().add_job('capture', -0.5, lambda: None)
+
+    def test_positive_interval_runs(self):
+        ran = threading.Event()
+        scheduler = Scheduler()
+        scheduler.add_job('job', 0.01, ran.set)
+        thread = threading.Thread(target=scheduler.run, daemon=True)
+        thread.start()
+        self.assertTrue(ran.wait(5))
+        scheduler.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+class OptionTest(unittest.TestCase):
+
+    def _run_main(self, *args):
+        stderr = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['main.py', *args]), \
+                contextlib.redirect_stderr(stderr), \
+                self.assertRaises(SystemExit) as exit_context:
+            main.main()
+        return exit_context.exception.code, stderr.getvalue()
+
+    def test_zero_and_negative_intervals_are_rejected(self):
+        for option in ('--capture-interval', '--diagnostics-interval',
+                        '--report-interval'):
+            for value in ('0', '-1'):
+                code, error = self._run_main('--daemon', option, value)
+                self.assertEqual(code, 2)
+                self.assertIn(f'{option} must be more than 0', error)
+
+    def test_zero_and_negative_jobs_are_rejected(self):
+        for value in ('0', '-1'):
+            code, error = self._run_main('--jobs', value)
+            self.assertEqual(code, 2)
+            self.assertIn('--jobs must be >= 1', error)
+
+
+if __name__ == '__main__':
+    unittest.main()